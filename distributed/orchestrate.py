@@ -0,0 +1,373 @@
+'''
+Build and run the distributed simulation setup.
+
+Every component of the setup, the mosaik orchestrator and each simulator in
+``mosaik-docker.json``, gets an image and a container of its own on the
+Docker network of the setup (``mosaik-net``)::
+
+    python orchestrate.py build                          # build the images
+    python orchestrate.py up [--placement placement.json] [--wait]
+    python orchestrate.py measure ID -o loads.json       # measure the load of a running simulation
+    python orchestrate.py plan [loads.json] -o placement.json
+    python orchestrate.py down ID
+
+``up`` starts the simulator containers, waits until each of them listens on
+its port, and then starts the orchestrator container with the addresses of
+the simulators on the network (``SIM_ADDRS``, see ``main.py``). The results
+are written to ``results/<ID>/``. CPU sets, CPU quotas and memory limits of
+the containers come from a placement plan (see placement.py), planned from
+the hints in ``mosaik-docker.json`` unless a plan is given.
+
+Images are built incrementally like the orchestrator image of the monolithic
+setup (see ``../monolithic/build_sim_setup.py``), whose tools are shared.
+'''
+import json
+import os
+import pathlib
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SETUP_DIR = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(SETUP_DIR.parent / 'monolithic'))  # Tools shared with the monolithic setup
+
+from mosaik_docker.util.config_data import ConfigData
+from mosaik_docker.util.create_unique_id import create_unique_id
+from mosaik_docker.util.execute import execute, execute_and_capture_output, execute_and_stream_output
+
+from build_sim_setup import HASH_LABEL, content_hash, image_hash, sync_context
+from placement import parse_stats, plan_placement
+from sim_resources import cpu_topology, parse_listening
+from sim_startup import backoff
+
+
+# Docker CLI to use, can be replaced by a stand-in with the same interface (e.g. for testing).
+DOCKER = os.environ.get('DOCKER', 'docker')
+CONTEXT_DIR_NAME = '.context'
+RESULTS_DIR_NAME = 'results'
+RESULT_FILE = '/results/results.hdf5'  # Result file in the orchestrator container, RESULTS_DIR_NAME/<ID> on the host
+IMAGE_NAME_TEMPLATE = 'mosaik/dist/{}/{}'  # Setup ID, component
+ORCHESTRATOR = 'orchestrator'
+RUN_LABEL = 'mosaik.run'
+COMPONENT_LABEL = 'mosaik.component'
+DEFAULT_NETWORK = 'mosaik-net'
+READY_TIMEOUT = 60  # Seconds to wait for the simulators to listen
+READY_INTERVAL = 0.5  # Longest delay between readiness checks, which back off exponentially
+# cgroup directory of a container on the host (systemd cgroup driver), mounted into the orchestrator for
+# `up --resources`, see ../monolithic/resource_monitor.py
+HOST_CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_TEMPLATE = os.environ.get('CGROUP_TEMPLATE', 'system.slice/docker-{}.scope')  # Relative to HOST_CGROUP_ROOT
+CGROUP_MOUNT = '/host/cgroup'
+
+
+def components(config_data):
+    '''
+    Return the components of the setup, the orchestrator first.
+
+    :return: {component: configuration} (dict)
+    '''
+    result = {ORCHESTRATOR: config_data['orchestrator']}
+    result.update(config_data['simulators'])
+    return result
+
+
+def image_name(setup_id, component):
+    return IMAGE_NAME_TEMPLATE.format(setup_id.lower(), component.lower())
+
+
+def container_name(sim_id, component):
+    return '{}-{}'.format(sim_id, component.lower())
+
+
+def build_images(setup_dir=SETUP_DIR, out_stream=print, force=False, docker=DOCKER):
+    '''
+    Build the images of all components. Images that are up to date with their resources are not built again.
+
+    :return: {component: error message or None} (dict)
+    '''
+    config_data = ConfigData(setup_dir)
+    setup_id = config_data['id'].strip()
+    errors = {}
+    for name, component in components(config_data).items():
+        try:
+            docker_file_path = pathlib.Path(setup_dir, component['docker_file']).resolve(strict=True)
+            sources = {}
+            for path in component.get('files', []) + component.get('dirs', []):
+                path = pathlib.Path(setup_dir, path).resolve(strict=True)
+                sources[path.name] = path
+            context_dir = pathlib.Path(setup_dir, CONTEXT_DIR_NAME, name.lower())
+            entries = sync_context(context_dir, sources, out_stream)
+
+            build_args = {}
+            if 'module' in component:
+                build_args = {'MODULE': component['module'], 'PORT': str(component['port'])}
+            build_hash = content_hash(entries, docker_file_path, build_args)
+            docker_image_name = image_name(setup_id, name)
+            if not force and image_hash(docker_image_name, docker) == build_hash:
+                out_stream('{} is up to date ({})'.format(name, docker_image_name))
+                errors[name] = None
+                continue
+
+            cmd = [docker, 'build', '-t', docker_image_name, '--label', '{}={}'.format(HASH_LABEL, build_hash)]
+            for arg, value in build_args.items():
+                cmd += ['--build-arg', '{}={}'.format(arg, value)]
+            cmd += ['-f', docker_file_path, context_dir]
+            execute_and_stream_output(cmd, out_stream)
+            errors[name] = None
+
+        except Exception as err:
+            errors[name] = str(err)
+            out_stream('building {} failed: {}'.format(name, err))
+    return errors
+
+
+def default_demands(config_data):
+    '''
+    Return the demands of the components according to the hints in the configuration (see placement.py).
+    '''
+    return {name: {'cpu': component.get('cpu', 1.0), 'memory': component.get('memory', 0)}
+            for name, component in components(config_data).items()}
+
+
+def listening(container, port, docker=DOCKER):
+    '''
+    Return True if a process in *container* listens on TCP *port*.
+
+    The sockets are read from ``/proc/net`` instead of connecting, since the simulators accept only one connection.
+    '''
+    try:
+        out = execute_and_capture_output([docker, 'exec', container, 'sh', '-c', 'cat /proc/net/tcp*'])
+    except Exception:
+        return False  # Not running (yet)
+    return port in parse_listening(out)
+
+
+def wait_ready(ports, timeout=READY_TIMEOUT, docker=DOCKER):
+    '''
+    Wait until every container in *ports* ({container: port}) listens on its port.
+
+    :raise RuntimeError: if not all containers are ready after *timeout* seconds
+    '''
+    waiting = dict(ports)
+    delays = backoff(timeout, maximum=READY_INTERVAL)
+    while waiting:
+        waiting = {c: p for c, p in waiting.items() if not listening(c, p, docker)}
+        if not waiting:
+            break
+        delay = next(delays, None)
+        if delay is None:
+            raise RuntimeError('Simulators not ready after {} s: {}'.format(timeout, ', '.join(sorted(waiting))))
+        time.sleep(delay)
+
+
+def ensure_network(network, docker=DOCKER):
+    try:
+        execute_and_capture_output([docker, 'network', 'inspect', network])
+    except Exception:
+        execute([docker, 'network', 'create', network])
+
+
+def up(setup_dir=SETUP_DIR, id=None, placement=None, wait=False, resource_interval=None, out_stream=print,
+       docker=DOCKER):
+    '''
+    Start a simulation: the simulator containers, and as soon as they are ready the orchestrator container.
+
+    :param id: ID of the new simulation (string, default: generated)
+    :param placement: placement plan, see placement.plan_placement() (dict, default: planned from the hints)
+    :param wait: wait until the orchestrator is done and remove the containers (bool)
+    :param resource_interval: sample the resource usage of all containers every that many seconds into the results
+        (float, default: no sampling)
+    :return: simulation ID (string)
+    '''
+    config_data = ConfigData(setup_dir)
+    setup_id = config_data['id'].strip()
+    network = config_data['network'] if 'network' in config_data else DEFAULT_NETWORK
+    parts = components(config_data)
+    if placement is None:
+        placement = plan_placement(default_demands(config_data), cpu_topology())
+    missing = set(parts) - set(placement)
+    if missing:
+        raise ValueError('No placement for {}'.format(', '.join(sorted(missing))))
+
+    sim_id = id or 'mosaik_dist_' + create_unique_id()
+    results_dir = pathlib.Path(setup_dir, RESULTS_DIR_NAME, sim_id).resolve()
+    results_dir.mkdir(parents=True, exist_ok=True)
+    ensure_network(network, docker)
+
+    def run(name, extra=()):
+        resources = placement[name]
+        command = [
+            docker, 'run',
+            '--detach',
+            '--name', container_name(sim_id, name),
+            '--net', network,
+            '--label', '{}={}'.format(RUN_LABEL, sim_id),
+            '--label', '{}={}'.format(COMPONENT_LABEL, name),
+            '--cpuset-cpus', resources['cpuset'],
+            '--cpus', str(resources['cpus']),
+            '--memory', resources['memory'],
+        ]
+        command += list(extra)
+        command.append(image_name(setup_id, name))
+        out_stream('starting {} on CPUs {}'.format(container_name(sim_id, name), resources['cpuset']))
+        return execute_and_capture_output(command).strip()  # Container ID
+
+    simulators = [name for name in parts if name != ORCHESTRATOR]
+    try:
+        with ThreadPoolExecutor(max_workers=len(simulators) or 1) as executor:
+            futures = {name: executor.submit(run, name) for name in simulators}
+            container_ids = {name: future.result() for name, future in futures.items()}
+        wait_ready({container_name(sim_id, name): parts[name]['port'] for name in simulators if 'port' in parts[name]},
+                   docker=docker)
+
+        # Simulators are reached by container name on the network.
+        addrs = {name: '{}:{}'.format(container_name(sim_id, name), parts[name]['port'])
+                 for name in simulators if 'module' in parts[name]}
+        extra = [
+            '--env', 'SIM_ADDRS={}'.format(json.dumps(addrs)),
+            '--env', 'RESULT_FILE={}'.format(RESULT_FILE),
+            '--volume', '{}:{}'.format(results_dir, os.path.dirname(RESULT_FILE)),
+        ]
+        if resource_interval:
+            # The orchestrator samples the cgroups of the simulator containers and its own.
+            cgroups = {name: '{}/{}'.format(CGROUP_MOUNT, CGROUP_TEMPLATE.format(container_id))
+                       for name, container_id in container_ids.items()}
+            cgroups[ORCHESTRATOR] = '/sys/fs/cgroup'
+            extra += [
+                '--env', 'RESOURCE_INTERVAL={}'.format(resource_interval),
+                '--env', 'RESOURCE_CGROUPS={}'.format(json.dumps(cgroups)),
+                '--volume', '{}:{}:ro'.format(HOST_CGROUP_ROOT, CGROUP_MOUNT),
+            ]
+        run(ORCHESTRATOR, extra)
+    except Exception:
+        down(sim_id, docker=docker)
+        raise
+
+    if wait:
+        status = execute_and_capture_output([docker, 'wait', container_name(sim_id, ORCHESTRATOR)]).strip()
+        out_stream('orchestrator exited with status {}, results in {}'.format(status, results_dir))
+        down(sim_id, docker=docker)
+    return sim_id
+
+
+def containers(sim_id, docker=DOCKER):
+    '''
+    Return the containers of the simulation *sim_id*.
+
+    :return: {container name: component} (dict)
+    '''
+    out = execute_and_capture_output([
+        docker, 'ps', '--all',
+        '--filter', 'label={}={}'.format(RUN_LABEL, sim_id),
+        '--format', '{{{{.Names}}}}\t{{{{.Label "{}"}}}}'.format(COMPONENT_LABEL),
+    ])
+    return dict(line.split('\t', 1) for line in out.splitlines() if '\t' in line)
+
+
+def measure(sim_id, samples=10, interval=1.0, docker=DOCKER):
+    '''
+    Measure the CPU and memory usage of the containers of the running simulation *sim_id*.
+
+    :return: {component: {'cpu': mean cores, 'memory': peak bytes}} (dict)
+    '''
+    names = containers(sim_id, docker)
+    if not names:
+        raise RuntimeError('No containers of simulation {}'.format(sim_id))
+    lines = []
+    for i in range(samples):
+        if i:
+            time.sleep(interval)
+        out = execute_and_capture_output(
+            [docker, 'stats', '--no-stream', '--format', '{{json .}}'] + sorted(names))
+        lines += [json.loads(line) for line in out.splitlines() if line.strip()]
+    return {names[name]: demand for name, demand in parse_stats(lines).items() if name in names}
+
+
+def down(sim_id, docker=DOCKER):
+    '''
+    Stop and remove all containers of the simulation *sim_id*.
+    '''
+    names = containers(sim_id, docker)
+    if names:
+        execute([docker, 'rm', '--force'] + sorted(names))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build and run the distributed simulation setup.')
+    parser.add_argument('--setup-dir', default=str(SETUP_DIR), metavar='SETUP_DIR',
+                        help='path to simulation setup directory (default: %(default)s)')
+    parser.add_argument('--docker', default=DOCKER, metavar='DOCKER',
+                        help='Docker CLI executable (default: $DOCKER or "docker")')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build', help='build the images of all components')
+    build_parser.add_argument('--force', action='store_true', help='build images even if they are up to date')
+
+    up_parser = commands.add_parser('up', help='start a simulation')
+    up_parser.add_argument('id', nargs='?', metavar='ID', help='simulation ID (default: generated)')
+    up_parser.add_argument('--placement', metavar='JSON', help='placement plan (default: planned from the hints)')
+    up_parser.add_argument('--wait', action='store_true',
+                           help='wait until the simulation is done and remove its containers')
+    up_parser.add_argument('--resources', type=float, metavar='SECONDS',
+                           help='sample the CPU and memory usage of the containers at this interval into the results')
+
+    measure_parser = commands.add_parser('measure', help='measure the load of the containers of a simulation')
+    measure_parser.add_argument('id', metavar='ID', help='simulation ID')
+    measure_parser.add_argument('-n', '--samples', type=int, default=10, help='samples (default: %(default)s)')
+    measure_parser.add_argument('-o', '--output', metavar='JSON', help='write the loads to this file')
+
+    plan_parser = commands.add_parser('plan', help='plan CPU sets and memory limits of the components')
+    plan_parser.add_argument('loads', nargs='?', metavar='JSON',
+                             help='measured loads (default: hints in mosaik-docker.json)')
+    plan_parser.add_argument('-o', '--output', metavar='JSON', help='write the plan to this file')
+
+    down_parser = commands.add_parser('down', help='stop and remove the containers of a simulation')
+    down_parser.add_argument('id', metavar='ID', help='simulation ID')
+
+    args = parser.parse_args()
+
+    def output(data, filename):
+        text = json.dumps(data, indent=2)
+        if filename:
+            with open(filename, 'w') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+
+    try:
+        if args.command == 'build':
+            errors = build_images(args.setup_dir, force=args.force, docker=args.docker)
+            sys.exit(1 if any(errors.values()) else 0)
+        elif args.command == 'up':
+            placement = None
+            if args.placement:
+                with open(args.placement) as f:
+                    placement = json.load(f)
+            sim_id = up(args.setup_dir, args.id, placement, wait=args.wait, resource_interval=args.resources,
+                        docker=args.docker)
+            print('Started new simulation with ID = {}'.format(sim_id))
+        elif args.command == 'measure':
+            output(measure(args.id, args.samples, docker=args.docker), args.output)
+        elif args.command == 'plan':
+            config_data = ConfigData(args.setup_dir)
+            demands = default_demands(config_data)
+            if args.loads:
+                with open(args.loads) as f:
+                    demands.update(json.load(f))
+            output(plan_placement(demands, cpu_topology()), args.output)
+        elif args.command == 'down':
+            down(args.id, docker=args.docker)
+        sys.exit(0)
+
+    except Exception as err:
+
+        print(str(err))
+        sys.exit(3)
+
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\.pyw|\.exe)?$', '', sys.argv[0])
+    sys.exit(main())
@@ -0,0 +1,132 @@
+'''
+Placement of the containers of a distributed simulation on the CPUs and the memory of a host.
+
+Every component (the orchestrator and each simulator) has a demand: the CPU
+cores it keeps busy and the memory it uses, either measured on a previous run
+(``orchestrate.py measure``, see :func:`parse_stats`) or the hints in
+``mosaik-docker.json``. :func:`plan_placement` adds some headroom and assigns
+
+* components that need at least one core an exclusive CPU set of as many
+  CPUs, hyper-threads of the same core first,
+* all other components a CPU shared with other light components (first fit,
+  heaviest first), one thread of every core before using the hyper-threads,
+
+with a CPU quota (``--cpus``) of their demand and a memory limit
+(``--memory``). If the demands exceed the host, the remaining components share
+the least loaded CPUs. CPUs that are not needed stay free for other
+simulations.
+'''
+import logging
+import math
+import re
+
+from sim_resources import format_cpuset
+
+
+logger = logging.getLogger('placement')
+
+HEADROOM = 1.25  # Planned resources per measured resources
+MIN_CPU = 0.1  # Smallest CPU quota [cores]
+MIN_MEMORY = 64 * 2 ** 20  # Smallest memory limit [bytes]
+MEMORY_UNITS = {
+    '': 1, 'b': 1,
+    'k': 2 ** 10, 'kb': 10 ** 3, 'kib': 2 ** 10,
+    'm': 2 ** 20, 'mb': 10 ** 6, 'mib': 2 ** 20,
+    'g': 2 ** 30, 'gb': 10 ** 9, 'gib': 2 ** 30,
+}
+
+
+def parse_memory(value):
+    '''
+    Parse a memory size like '512m' (Docker) or '45.3MiB' (``docker stats``).
+
+    :return: size [bytes] (int)
+    '''
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([a-zA-Z]*)\s*', str(value))
+    if match is None or match.group(2).lower() not in MEMORY_UNITS:
+        raise ValueError('Invalid memory size: {}'.format(value))
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()])
+
+
+def format_memory(size):
+    '''
+    Format *size* [bytes] as memory limit for ``--memory``, rounded up to MiB, e.g. '96m'.
+    '''
+    return '{}m'.format(math.ceil(size / 2 ** 20))
+
+
+def parse_stats(lines):
+    '''
+    Return the demands measured by ``docker stats --no-stream --format '{{json .}}'``.
+
+    :param lines: output lines of one or more calls, one JSON object per container and call (list of dicts)
+    :return: {container name: {'cpu': mean cores, 'memory': peak bytes}} (dict)
+    '''
+    samples = {}
+    for stats in lines:
+        cpu = float(stats['CPUPerc'].rstrip('%')) / 100
+        memory = parse_memory(stats['MemUsage'].split('/')[0])
+        samples.setdefault(stats['Name'], []).append((cpu, memory))
+    return {
+        name: {'cpu': sum(cpu for cpu, _ in values) / len(values), 'memory': max(memory for _, memory in values)}
+        for name, values in samples.items()
+    }
+
+
+def plan_placement(demands, cores, headroom=HEADROOM):
+    '''
+    Assign CPU sets, CPU quotas and memory limits to components.
+
+    :param demands: {component: {'cpu': cores, 'memory': bytes or size string}} (dict)
+    :param cores: CPUs of the host grouped by physical core (list of CPU lists, see sim_resources.cpu_topology())
+    :param headroom: planned resources per demanded resources (float)
+    :return: {component: {'cpuset': CPU list, 'cpus': quota, 'memory': limit}} (dict)
+    :raise RuntimeError: if the host has no CPUs
+    '''
+    if not any(cores):
+        raise RuntimeError('No CPUs to place the components on')
+    needs = {name: max(float(d.get('cpu', 0)) * headroom, MIN_CPU) for name, d in demands.items()}
+    order = sorted(needs, key=lambda name: (-needs[name], name))
+
+    # Exclusive CPU sets: whole cores first, so the sets do not share execution units.
+    free = [cpu for core in cores for cpu in core]
+    cpusets = {}
+    for name in order:
+        if needs[name] >= 1 and free:
+            count = min(math.ceil(needs[name]), len(free))
+            cpusets[name], free = free[:count], free[count:]
+            if count < needs[name]:
+                logger.warning('%s needs %.1f CPUs, only %d are left', name, needs[name], count)
+
+    # Shared CPUs for the rest: one thread of every core before the hyper-threads.
+    free_set = set(free)
+    depth = max(len(core) for core in cores)
+    spread = [core[i] for i in range(depth) for core in cores if i < len(core) and core[i] in free_set]
+    bins = []  # [cpu, planned load]
+    exclusive = [[cpus[0], needs[name] / len(cpus)] for name, cpus in cpusets.items()]
+    for name in order:
+        if name in cpusets:
+            continue
+        need = min(needs[name], 1.0)
+        fit = next((b for b in bins if b[1] + need <= 1.0), None)
+        if fit is None and spread:
+            fit = [spread.pop(0), 0.0]
+            bins.append(fit)
+        elif fit is None:
+            # Oversubscribed: share the least loaded CPU.
+            fit = min(bins + exclusive, key=lambda b: b[1])
+            logger.warning('Not enough CPUs, %s shares CPU %d', name, fit[0])
+        fit[1] += need
+        cpusets[name] = [fit[0]]
+
+    plan = {}
+    for name in sorted(demands):
+        memory = parse_memory(demands[name].get('memory', 0))
+        plan[name] = {
+            'cpuset': format_cpuset(cpusets[name]),
+            'cpus': round(min(needs[name], len(cpusets[name])), 2),
+            'memory': format_memory(max(memory * headroom, MIN_MEMORY)),
+        }
+    return plan
@@ -0,0 +1,199 @@
+'''
+In-process battery simulator for mosaik.
+
+Python implementation of the remote ``BatterySimulator``. Each battery
+receives a command from the grid, either as numeric ``battery_setpoint``
+(positive for charging) or as ``battery_action`` string (``'charge:<W>'`` or
+``'discharge:<W>'``, understood by the remote simulator as well), and reports
+the power it actually draws as ``current_load`` (positive while charging,
+negative while discharging).
+'''
+import logging
+
+import mosaik_api
+
+from checkpoint import open_checkpoints
+from rpc_batch import BATCH_METHOD, BatchedStep
+from step_plan import StepPlan
+from wire import CODECS, accept_codecs
+
+
+logger = logging.getLogger('battery_sim')
+
+CHARGE = 'charge'
+DISCHARGE = 'discharge'
+
+META = {
+    'type': 'time-based',
+    'codecs': CODECS,
+    'extra_methods': [BATCH_METHOD],
+    'models': {
+        'Battery': {
+            'public': True,
+            'params': [
+                'max_capacity',  # Usable capacity [Wh]
+                'initial_soc',  # Initial state of charge [0..1]
+            ],
+            'attrs': [
+                'battery_action',  # Command from the grid, e.g. 'charge:250' (input)
+                'battery_setpoint',  # Command from the grid, positive for charging [W] (input)
+                'current_load',  # Power drawn by the battery [W] (output)
+                'soc',  # State of charge [0..1] (output)
+                'stored_energy',  # Stored energy [Wh] (output)
+            ],
+            'attr_types': {
+                'battery_action': 'str',
+                'battery_setpoint': 'float',
+                'current_load': 'float',
+                'soc': 'float',
+                'stored_energy': 'float',
+            },
+        },
+    },
+}
+
+
+def parse_action(action):
+    '''
+    Convert a battery command into a signed power value.
+
+    :param action: command of the form '<charge|discharge>:<power in W>' (string)
+    :return: requested power, positive for charging (float)
+    '''
+    kind, _, power = action.partition(':')
+    power = float(power) if power else 0.0
+    if kind == CHARGE:
+        return power
+    if kind == DISCHARGE:
+        return -power
+    raise ValueError('Unknown battery action "{}"'.format(action))
+
+
+def format_action(power):
+    '''
+    Convert a signed power value into a battery command.
+
+    :param power: requested power, positive for charging (float)
+    :return: command of the form '<charge|discharge>:<power in W>' (string)
+    '''
+    if power >= 0:
+        return '{}:{}'.format(CHARGE, power)
+    return '{}:{}'.format(DISCHARGE, -power)
+
+
+class Battery:
+    '''
+    Simple energy-balance battery model without losses.
+    '''
+
+    def __init__(self, max_capacity, initial_soc=0.5):
+        self.max_capacity = float(max_capacity)
+        self.stored_energy = self.max_capacity * initial_soc
+        self.current_load = 0.0
+        self.setpoint = 0.0  # Last command [W]
+
+    @property
+    def battery_action(self):
+        return format_action(self.setpoint)
+
+    @property
+    def soc(self):
+        return self.stored_energy / self.max_capacity if self.max_capacity else 0.0
+
+    def step(self, power, duration):
+        '''
+        Charge (positive *power*) or discharge (negative *power*) the battery
+        for *duration* seconds, limited by the stored energy and the capacity.
+
+        :param power: requested power [W] (float)
+        :param duration: step duration [s] (int)
+        :return: power actually drawn by the battery [W] (float)
+        '''
+        hours = duration / 3600
+        energy = min(max(power * hours, -self.stored_energy), self.max_capacity - self.stored_energy)
+        self.stored_energy += energy
+        self.current_load = energy / hours if hours else 0.0
+        return self.current_load
+
+
+class BatterySimulator(BatchedStep, mosaik_api.Simulator):
+    def __init__(self):
+        super().__init__(META)
+        self.step_size = None
+        self.plan = None
+        self.entities = {}
+        self.checkpoints = None
+        self.restored = None
+        self.pending = None  # Restored battery commands for the first step
+
+    def init(self, sid, time_resolution=1., step_size=900, step_times=None, checkpoint_dir=None, checkpoint_every=0,
+             restore=None):
+        accept_codecs(self)
+        self.step_size = step_size
+        self.plan = StepPlan(step_size, step_times)
+        self.checkpoints, self.restored = open_checkpoints(sid, checkpoint_dir, checkpoint_every, restore)
+        return self.meta
+
+    def create(self, num, model, max_capacity=7500, initial_soc=0.5):
+        start_idx = len(self.entities)
+        entities = []
+        for i in range(num):
+            eid = '%s_%s' % (model, i + start_idx)
+            self.entities[eid] = Battery(max_capacity, initial_soc)
+            entities.append({'eid': eid, 'type': model, 'rel': []})
+        return entities
+
+    def setup_done(self):
+        if self.restored is not None:
+            for eid, (stored_energy, current_load, setpoint) in self.restored['batteries'].items():
+                battery = self.entities[eid]
+                battery.stored_energy = stored_energy
+                battery.current_load = current_load
+                battery.setpoint = parse_action(setpoint) if isinstance(setpoint, str) else setpoint
+            self.pending = self.restored['pending']
+            self.restored = None
+
+    def step(self, time, inputs, max_advance):
+        powers = {}
+        for eid in self.entities:
+            attrs = inputs.get(eid, {})
+            powers[eid] = sum(attrs.get('battery_setpoint', {}).values()) + \
+                sum(parse_action(a) for a in attrs.get('battery_action', {}).values())
+        if self.pending is not None:
+            # The time-shifted commands for the first step after a restore come from the checkpoint.
+            powers.update(self.pending)
+            self.pending = None
+
+        if self.checkpoints is not None and self.checkpoints.due(time):
+            self.checkpoints.save(time, {
+                'batteries': {eid: [b.stored_energy, b.current_load, b.setpoint]
+                              for eid, b in self.entities.items()},
+                'pending': powers,
+            })
+
+        duration = self.plan.duration(time)
+        for eid, battery in self.entities.items():
+            power = powers[eid]
+            battery.setpoint = power
+            battery.step(power, duration)
+
+        return time + duration
+
+    def get_data(self, outputs):
+        data = {}
+        for eid, attrs in outputs.items():
+            battery = self.entities[eid]
+            data[eid] = {attr: getattr(battery, attr) for attr in attrs}
+        return data
+
+    def finalize(self):
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+
+
+def main():
+    return mosaik_api.start_simulation(BatterySimulator(), 'In-process battery simulator')
+
+
+if __name__ == '__main__':
+    main()
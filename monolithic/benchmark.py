@@ -0,0 +1,367 @@
+'''
+End-to-end benchmark of the demo scenario.
+
+Runs ``main.py`` headless for every combination of fleet size (number of
+compute nodes, PV units and batteries), horizon (``END``) and step size, and
+writes one machine-readable report::
+
+    python benchmark.py -n 1 10 50 --horizons 86400 604800 -o bench-<commit>.json
+    python benchmark.py --compare bench-old.json bench-new.json
+
+In ``connect`` mode (default), PyPower, BatterySimulator and
+ComputeNodeSimulator run as local stand-in processes of the simulators of this
+package on the addresses configured in ``sim_config``, like the simulator
+containers would; in ``python`` mode they run in-process. Every cell runs in
+processes of its own and records:
+
+* ``wall_time``: time from starting the simulators until the scenario is done
+  [s], ``setup_time``: time to create the scenario [s], ``run_time``: time of
+  ``world.run()`` [s],
+* ``steps`` and ``steps_per_s``: scenario steps and steps per second of
+  ``run_time`` (cells always use fixed stepping, ``ADAPTIVE_TOLERANCE`` is
+  ignored),
+* ``peak_rss``: peak resident memory of the orchestrator and of every
+  stand-in simulator [bytes],
+* ``output_size``: size of the result file [bytes].
+'''
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Simulators started as local stand-ins in 'connect' mode
+STAND_INS = ('PyPower', 'BatterySimulator', 'ComputeNodeSimulator')
+READY_TIMEOUT = 30  # Seconds to wait for the stand-ins to listen
+STOP_TIMEOUT = 10  # Seconds to wait for the stand-ins to exit after the scenario
+REPORT_VERSION = 1
+MONOLITHIC_DIR = pathlib.Path(__file__).resolve().parent
+
+
+def commit():
+    '''
+    Return the current git commit of the package or None.
+    '''
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=MONOLITHIC_DIR, capture_output=True, text=True)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def _wait(proc, block=True):
+    '''
+    Reap the child *proc* (subprocess.Popen) and return (exit code, peak RSS [bytes]).
+
+    Unlike Popen.wait(), this keeps the resource usage of the child. With *block* False, return None if the child
+    is still running.
+    '''
+    pid, status, rusage = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return proc.returncode, rusage.ru_maxrss * 1024  # ru_maxrss is in KiB on Linux
+
+
+def start_stand_ins(names=STAND_INS):
+    '''
+    Start the simulators *names* of main.sim_config as local processes listening on their 'connect' addresses.
+
+    :return: {name: subprocess.Popen} (dict)
+    '''
+    import main as scenario
+    from sim_resources import listening_ports
+
+    procs = {}
+    ports = {}
+    for name in names:
+        entry = scenario.sim_config[name]
+        module = entry['python'].split(':', 1)[0]
+        procs[name] = subprocess.Popen(
+            [sys.executable, str(MONOLITHIC_DIR / (module + '.py')), entry['connect'], '--remote'],
+            cwd=MONOLITHIC_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        ports[name] = int(entry['connect'].rsplit(':', 1)[1])
+
+    deadline = time.monotonic() + READY_TIMEOUT
+    while not set(ports.values()) <= listening_ports():
+        failed = [name for name, proc in procs.items() if _wait(proc, block=False) is not None]
+        if failed or time.monotonic() > deadline:
+            stop_stand_ins(procs, timeout=0)
+            raise RuntimeError('Stand-in simulators not ready: {}'.format(', '.join(
+                failed or sorted(name for name, port in ports.items() if port not in listening_ports()))))
+        time.sleep(0.05)
+    return procs
+
+
+def stop_stand_ins(procs, timeout=STOP_TIMEOUT):
+    '''
+    Wait for the stand-in simulators to exit (they do when mosaik closes the connection), kill them after *timeout*.
+
+    :return: {name: peak RSS [bytes]} (dict)
+    '''
+    deadline = time.monotonic() + timeout
+    rss = {}
+    for name, proc in procs.items():
+        if proc.returncode is not None:
+            rss[name] = None  # Reaped while starting
+            continue
+        status = _wait(proc, block=False)
+        while status is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+            status = _wait(proc, block=False)
+        if status is None:
+            proc.kill()
+            status = _wait(proc)
+        rss[name] = status[1]
+    return rss
+
+
+def run_cell(cell, report_file):
+    '''
+    Run one cell of the benchmark in this process and write its timings to *report_file*.
+
+    :param cell: {'entities', 'horizon', 'step_size', 'mode', 'pv_data', 'result_file'} (dict)
+    '''
+    import mosaik
+
+    import main as scenario
+    from sim_resources import free_ports
+
+    scenario.HEADLESS = True
+    scenario.TELEMETRY = None
+    scenario.PROFILE = None
+    scenario.CHECKPOINT_DIR = None
+    scenario.RESTORE = None
+    scenario.KPI_FILE = None
+    scenario.RESOURCE_INTERVAL = None
+    # Fixed stepping, so that 'steps' is the number of steps actually run
+    scenario.ADAPTIVE_TOLERANCE = None
+    scenario.ADAPTIVE_MAX_ERROR = None
+    scenario.END = cell['horizon']
+    scenario.STEP_SIZE = cell['step_size']
+    scenario.N_COMPUTE_NODES = scenario.N_PV = scenario.N_BATTERIES = cell['entities']
+    scenario.PV_DATA = cell['pv_data']
+    scenario.RESULT_FILE = cell['result_file']
+
+    port = free_ports(1, host='127.0.0.1')[0]
+    t0 = time.perf_counter()
+    config, startup = scenario.prestart_sims(scenario.get_sim_config(cell['mode']))
+    with startup:
+        world = mosaik.World(config, {'addr': ('127.0.0.1', port)})
+        scenario.create_scenario(world)
+    t1 = time.perf_counter()
+    world.run(until=cell['horizon'])
+    t2 = time.perf_counter()
+    with open(report_file, 'w') as f:
+        json.dump({'setup_time': t1 - t0, 'run_time': t2 - t1}, f)
+
+
+def benchmark_cell(entities, horizon, step_size, mode, pv_data, work_dir):
+    '''
+    Run one cell in fresh processes and measure it.
+
+    :return: results of the cell, see the module docstring (dict)
+    '''
+    cell = {
+        'entities': entities,
+        'horizon': horizon,
+        'step_size': step_size,
+        'mode': mode,
+        'pv_data': pv_data,
+        'result_file': str(pathlib.Path(work_dir, 'results.hdf5')),
+    }
+    report_file = pathlib.Path(work_dir, 'report.json')
+    log_file = pathlib.Path(work_dir, 'orchestrator.log')
+
+    t0 = time.perf_counter()
+    stand_ins = start_stand_ins() if mode == 'connect' else {}
+    try:
+        with open(log_file, 'w') as log:
+            proc = subprocess.Popen([sys.executable, __file__, '--cell', json.dumps(cell), str(report_file)],
+                                    cwd=MONOLITHIC_DIR, stdout=subprocess.DEVNULL, stderr=log)
+            code, rss = _wait(proc)
+        wall_time = time.perf_counter() - t0
+    finally:
+        stand_in_rss = stop_stand_ins(stand_ins)
+
+    result = dict(cell)
+    del result['result_file']
+    if code != 0:
+        result['error'] = log_file.read_text()[-2000:]
+        return result
+
+    with open(report_file) as f:
+        timings = json.load(f)
+    steps = -(-horizon // step_size)
+    result.update(
+        wall_time=wall_time,
+        setup_time=timings['setup_time'],
+        run_time=timings['run_time'],
+        steps=steps,
+        steps_per_s=steps / timings['run_time'] if timings['run_time'] else None,
+        peak_rss=dict(orchestrator=rss, **stand_in_rss),
+        output_size=os.path.getsize(cell['result_file']),
+    )
+    return result
+
+
+def run_benchmark(entities, horizons, step_sizes, mode='connect', pv_data=None, repeat=1, out_stream=print):
+    '''
+    Run all cells and return the report (dict).
+    '''
+    import main as scenario
+
+    pv_data = pv_data or scenario.PV_DATA
+    results = []
+    for n in entities:
+        for horizon in horizons:
+            for step_size in step_sizes:
+                for _ in range(repeat):
+                    with tempfile.TemporaryDirectory(prefix='bench-') as work_dir:
+                        result = benchmark_cell(n, horizon, step_size, mode, pv_data, work_dir)
+                    results.append(result)
+                    if 'error' in result:
+                        out_stream('n={} horizon={} step_size={}: failed\n{}'.format(n, horizon, step_size,
+                                                                                   result['error']))
+                    else:
+                        out_stream('n={} horizon={} step_size={}: {:.2f} s, {:.0f} steps/s, {:.0f} MiB'.format(
+                            n, horizon, step_size, result['wall_time'], result['steps_per_s'],
+                            result['peak_rss']['orchestrator'] / 2 ** 20))
+    return {
+        'version': REPORT_VERSION,
+        'commit': commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+
+
+def compare(old, new, out_stream=print):
+    '''
+    Print the ratio new/old of the wall time, steps per second and peak RSS of the cells of two reports.
+    '''
+    def key(result):
+        return result['entities'], result['horizon'], result['step_size'], result['mode']
+
+    def mean(results, metric):
+        values = [metric(r) for r in results if 'error' not in r]
+        return sum(values) / len(values) if values else None
+
+    def group(report):
+        groups = {}
+        for result in report['results']:
+            groups.setdefault(key(result), []).append(result)
+        return groups
+
+    metrics = {
+        'wall_time': lambda r: r['wall_time'],
+        'steps_per_s': lambda r: r['steps_per_s'],
+        'peak_rss': lambda r: r['peak_rss']['orchestrator'],
+    }
+    old_groups, new_groups = group(old), group(new)
+    out_stream('entities\thorizon\tstep_size\tmode\t' + '\t'.join(metrics))
+    for cell in sorted(set(old_groups) & set(new_groups)):
+        ratios = []
+        for metric in metrics.values():
+            a, b = mean(old_groups[cell], metric), mean(new_groups[cell], metric)
+            ratios.append('{:.2f}'.format(b / a) if a and b is not None else '-')
+        out_stream('\t'.join(str(v) for v in cell) + '\t' + '\t'.join(ratios))
+
+
+def main():
+    import argparse
+
+    if len(sys.argv) == 4 and sys.argv[1] == '--cell':
+        # Worker process of one cell, see benchmark_cell()
+        return run_cell(json.loads(sys.argv[2]), sys.argv[3])
+
+    import main as scenario
+
+    parser = argparse.ArgumentParser(description='Benchmark the demo scenario.')
+
+    parser.add_argument(
+        '-n', '--entities',
+        type=int,
+        nargs='+',
+        default=[scenario.N_COMPUTE_NODES],
+        metavar='N',
+        help='numbers of compute nodes, PV units and batteries (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--horizons',
+        type=int,
+        nargs='+',
+        default=[scenario.END],
+        metavar='SECONDS',
+        help='simulated horizons (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--step-sizes',
+        type=int,
+        nargs='+',
+        default=[scenario.STEP_SIZE],
+        metavar='SECONDS',
+        help='step sizes (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--mode',
+        choices=('connect', 'python'),
+        default='connect',
+        help='run the simulators as local stand-in processes or in-process (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--pv-data',
+        metavar='CSV',
+        help='PV data file (default: PV_DATA of main.py)'
+    )
+
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int,
+        default=1,
+        help='runs per cell (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        default='benchmark.json',
+        metavar='JSON',
+        help='report file (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--compare',
+        nargs=2,
+        metavar=('OLD', 'NEW'),
+        help='compare two reports instead of running the benchmark'
+    )
+
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        compare(old, new)
+        return 0
+
+    report = run_benchmark(args.entities, args.horizons, args.step_sizes, args.mode, args.pv_data, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report written to {}'.format(args.output))
+    return 3 if any('error' in r for r in report['results']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,179 @@
+import hashlib
+import json
+import os
 import pathlib
 import shutil
 import re
 import sys
 from mosaik_docker._config import ORCH_CONTEXT_DIR_NAME, ORCH_CONTEXT_EXTRA_DIR_NAME, ORCH_IMAGE_NAME_TEMPLATE
-from mosaik_docker.util.execute import execute_and_stream_output
+from mosaik_docker.util.execute import execute_and_capture_output, execute_and_stream_output
 from mosaik_docker.util.config_data import ConfigData
 
+# Docker CLI to use, can be replaced by a stand-in with the same interface (e.g. for testing).
+DOCKER = os.environ.get('DOCKER', 'docker')
+# Manifest in the context directory with the content hashes of the copied resources.
+MANIFEST_NAME = '.manifest.json'
+MANIFEST_VERSION = 1
+# Image label holding the content hash the image was built from.
+HASH_LABEL = 'mosaik.content_hash'
 
-def build_sim_setup(setup_dir, out_stream=print):
+
+def hash_file(path, stamps):
+    '''
+    Return the SHA-256 of the file *path*. Files whose size and modification time are unchanged since the last call
+    are not read again, their hash is taken from *stamps* (updated in place).
+
+    :param path: file (pathlib.Path)
+    :param stamps: path -> [size:mtime stamp, hash] from the last build (dict)
+    :return: hex digest (string)
+    '''
+    stat = path.stat()
+    stamp = '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+    cached = stamps.get(str(path))
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    stamps[str(path)] = [stamp, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def hash_path(path, stamps):
+    '''
+    Return the SHA-256 of a file or of a directory tree (relative paths and contents of all files).
+    '''
+    if not path.is_dir():
+        return hash_file(path, stamps)
+
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = pathlib.Path(root, name)
+            digest.update('{}\0{}\n'.format(file_path.relative_to(path).as_posix(),
+                                              hash_file(file_path, stamps)).encode())
+    return digest.hexdigest()
+
+
+def read_manifest(context_dir):
+    '''
+    Return the manifest of the last build in *context_dir* or None if there is no valid one.
+    '''
+    try:
+        with open(pathlib.Path(context_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(context_dir, entries, stamps):
+    with open(pathlib.Path(context_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(dict(version=MANIFEST_VERSION, entries=entries, stamps=stamps), f, indent=2)
+
+
+def sync_context(context_dir, sources, out_stream=print):
+    '''
+    Make *context_dir* contain exactly the resources in *sources*. Only entries whose content hash changed since the
+    last call are copied again, entries that are no longer needed are removed.
+
+    :param context_dir: context directory (pathlib.Path)
+    :param sources: path relative to the context directory -> source file or directory (dict)
+    :param out_stream: progress messages are sent to this stream (callable)
+    :return: path relative to the context directory -> content hash (dict)
+    '''
+    manifest = read_manifest(context_dir)
+    if manifest is None:
+        # Unknown state (first build or built by an older version): start from scratch.
+        if context_dir.is_dir():
+            shutil.rmtree(context_dir)
+        manifest = dict(entries={}, stamps={})
+    context_dir.mkdir(parents=True, exist_ok=True)
+
+    old_entries = manifest['entries']
+    old_stamps = manifest['stamps']
+    stamps = {}
+    entries = {}
+    for name, source in sorted(sources.items()):
+        # Reuse the stamps of the last build, but only keep those of files that still exist.
+        for key in [k for k in old_stamps if k == str(source) or k.startswith(str(source) + os.sep)]:
+            stamps[key] = old_stamps[key]
+        entries[name] = hash_path(source, stamps)
+
+    for name in old_entries:
+        if name not in entries:
+            _remove(pathlib.Path(context_dir, name))
+            out_stream('removed from context: {}'.format(name))
+
+    for name, source in sorted(sources.items()):
+        target = pathlib.Path(context_dir, name)
+        if old_entries.get(name) == entries[name] and target.exists():
+            continue
+        _remove(target)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if source.is_dir():
+            shutil.copytree(source, target)
+        else:
+            shutil.copy(source, target)
+        out_stream('updated in context: {}'.format(name))
+
+    write_manifest(context_dir, entries, stamps)
+    return entries
+
+
+def content_hash(entries, docker_file_path, build_args):
+    '''
+    Return the hash of everything the orchestrator image is built from: the context entries, the Dockerfile and the
+    build arguments.
+    '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(dict(
+        entries=entries,
+        docker_file=hash_file(docker_file_path, {}),
+        build_args=build_args,
+    ), sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def image_hash(docker_image_name, docker=DOCKER):
+    '''
+    Return the content hash the image *docker_image_name* was built from or None if there is no such image.
+    '''
+    try:
+        out = execute_and_capture_output([
+            docker, 'image', 'inspect',
+            '--format', '{{{{ index .Config.Labels "{}" }}}}'.format(HASH_LABEL),
+            docker_image_name
+        ])
+    except Exception:
+        return None
+    return out.strip() or None
+
+
+def _remove(path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    elif path.exists() or path.is_symlink():
+        path.unlink()
+
+
+def build_sim_setup(setup_dir, out_stream=print, force=False, docker=DOCKER):
     '''
     Build simulation setup as preparation for running the simulation.
     This includes building the Docker image of the mosaik orchestrator.
 
+    The build is incremental: only resources that changed since the last build are copied to the context directory,
+    and the image is not built again if it already exists with the same content hash (see :func:`content_hash`).
+
     :param setup_dir: path to simulation setup (string)
     :param out_stream: output from the build process to stderr will be piped to this stream (callable)
+    :param force: build the image even if it is up to date (boolean)
+    :param docker: Docker CLI executable (string)
     :return: return dict with status of build process:
         {
             'valid': flag indicating if build succeded (boolean)
@@ -50,34 +210,46 @@ def build_sim_setup(setup_dir, out_stream=print):
         orch_context_dir = pathlib.Path(setup_dir, ORCH_CONTEXT_DIR_NAME).resolve(strict=False)
         orch_context_extra_dir = pathlib.Path(orch_context_dir, ORCH_CONTEXT_EXTRA_DIR_NAME).resolve(strict=False)
 
-        # Check if context directory already exists. If yes, delete it.
-        if orch_context_dir.is_dir():
-            shutil.rmtree(orch_context_dir)
-
-        # Create new context directory.
-        orch_context_dir.mkdir(exist_ok=False)
-        orch_context_extra_dir.mkdir(exist_ok=False)
-
-        # Copy resources to context directory.
-        shutil.copy(start_file_path, orch_context_dir)  # <-- Yazan
-        shutil.copy(server_jar_path, orch_context_dir)  # <-- Yazan
-        shutil.copy(app_jar_path, orch_context_dir)  # <-- Yazan
+        # Resources in the context directory and where they are copied from.
+        sources = {
+            start_file_path.name: start_file_path,  # <-- Yazan
+            server_jar_path.name: server_jar_path,  # <-- Yazan
+            app_jar_path.name: app_jar_path,  # <-- Yazan
+        }
         for f in extra_file_paths:
-            shutil.copy(f, orch_context_extra_dir)
+            sources['{}/{}'.format(ORCH_CONTEXT_EXTRA_DIR_NAME, f.name)] = f
         for d in extra_dir_paths:
-            shutil.copytree(d, pathlib.Path(orch_context_dir, d.name))
+            sources[d.name] = d
+
+        # Copy changed resources to the context directory.
+        entries = sync_context(orch_context_dir, sources, out_stream)
+        orch_context_extra_dir.mkdir(exist_ok=True)
 
         # Define Docker image name.
         docker_image_name = ORCH_IMAGE_NAME_TEMPLATE.format(sim_setup_id.lower())
 
+        build_args = {
+            'START_FILE': start_file,  # <-- Yazan
+            'SERVER_JAR': server_jar,  # <-- Yazan
+            'APP_JAR': app_jar,  # <-- Yazan
+            'EXTRA': ORCH_CONTEXT_EXTRA_DIR_NAME,  # Specify directory with extra files and directories.
+        }
+        build_hash = content_hash(entries, docker_file_path, build_args)
+
+        if not force and image_hash(docker_image_name, docker) == build_hash:
+            return dict(
+                valid=True,
+                status='simulation setup is up to date: {} ({})'.format(config_data.path.parent, docker_image_name)
+            )
+
         cmd = [
-            'docker', 'build',  # Docker build command.
+            docker, 'build',  # Docker build command.
             '-t', docker_image_name,  # Specify image name.
-            '--build-arg', 'START_FILE={}'.format(start_file),  # <-- Yazan
-            '--build-arg', 'SERVER_JAR={}'.format(server_jar),  # <-- Yazan
-            '--build-arg', 'APP_JAR={}'.format(app_jar),  # <-- Yazan
-            '--build-arg', 'EXTRA={}'.format(ORCH_CONTEXT_EXTRA_DIR_NAME),
-            # Specify directory with extra files and directories.
+            '--label', '{}={}'.format(HASH_LABEL, build_hash),  # Content hash for incremental builds.
+        ]
+        for name, value in build_args.items():
+            cmd += ['--build-arg', '{}={}'.format(name, value)]
+        cmd += [
             '-f', docker_file_path,  # Specify the Dockerfile.
             orch_context_dir  # Specify the build context.
         ]
@@ -113,10 +285,23 @@ def main():
         help='path to simulation setup directory (default: current working directory)'
     )
 
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='build the orchestrator image even if it is up to date'
+    )
+
+    parser.add_argument(
+        '--docker',
+        default=DOCKER,
+        metavar='DOCKER',
+        help='Docker CLI executable (default: $DOCKER or "docker")'
+    )
+
     args = parser.parse_args()
 
     try:
-        build_status = build_sim_setup(args.setup_dir)
+        build_status = build_sim_setup(args.setup_dir, force=args.force, docker=args.docker)
 
         print(build_status['status'])
         if True == build_status['valid']:
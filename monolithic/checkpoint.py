@@ -0,0 +1,167 @@
+'''
+Checkpoints of the simulator states for resuming and forking long runs.
+
+Every stateful simulator gets a :class:`CheckpointWriter` and saves its state
+at the start of every step whose scenario time is a multiple of ``every``, i.e.
+after all steps before that time and before any step at that time. Writing
+(JSON, gzip-compressed) happens on a background thread.
+
+Layout of a checkpoint directory::
+
+    <dir>/scenario.json             simulators and settings of the run (written by the scenario)
+    <dir>/<time>/<sid>.json.gz      state of simulator <sid> at scenario time <time> [s]
+
+A checkpoint is complete when the states of all simulators listed in
+``scenario.json`` exist. A run restored from ``<dir>/<time>`` starts mosaik at
+time 0, which corresponds to scenario time ``<time>``. Restoring into the same
+directory resumes the run, restoring into another one forks it (possibly with
+changed parameters); the source checkpoint is never modified.
+'''
+import gzip
+import json
+import logging
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger('checkpoint')
+
+SCENARIO_FILE_NAME = 'scenario.json'
+STATE_SUFFIX = '.json.gz'
+TIME_DIGITS = 10  # Checkpoint directories are named by their zero-padded time so that they sort by time
+
+
+def checkpoint_path(directory, time):
+    return pathlib.Path(directory, '{:0{}d}'.format(time, TIME_DIGITS))
+
+
+def checkpoint_time(checkpoint):
+    '''
+    Return the scenario time [s] of the checkpoint directory *checkpoint*.
+    '''
+    return int(pathlib.Path(checkpoint).name)
+
+
+def _write_json(path, data, compress=False):
+    tmp_path = path.with_name(path.name + '.tmp')
+    opener = gzip.open if compress else open
+    with opener(tmp_path, 'wt') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    '''
+    Writes the states of one simulator.
+
+    :param directory: checkpoint directory (string)
+    :param sid: simulator ID (string)
+    :param every: checkpoint interval in scenario time [s] (int)
+    :param time_offset: scenario time of mosaik time 0 (int)
+    '''
+
+    def __init__(self, directory, sid, every, time_offset=0):
+        self.directory = pathlib.Path(directory)
+        self.sid = sid
+        self.every = int(every)
+        self.time_offset = time_offset
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self.future = None
+
+    def due(self, time):
+        '''
+        Return True if a checkpoint has to be saved before the step at mosaik time *time*. The start of a run is
+        never checkpointed.
+        '''
+        return self.every > 0 and time > 0 and (self.time_offset + time) % self.every == 0
+
+    def save(self, time, state):
+        '''
+        Save *state* (JSON-serialisable, must not be modified afterwards) as state at mosaik time *time*.
+        '''
+        if self.future is not None:
+            self.future.result()  # Keep at most one checkpoint in memory, report errors of the previous one
+        self.future = self.executor.submit(self._write, self.time_offset + time, state)
+
+    def _write(self, time, state):
+        path = checkpoint_path(self.directory, time)
+        path.mkdir(parents=True, exist_ok=True)
+        _write_json(pathlib.Path(path, self.sid + STATE_SUFFIX), state, compress=True)
+        logger.debug('Saved state of %s at %d', self.sid, time)
+
+    def close(self):
+        if self.future is not None:
+            self.future.result()
+        self.executor.shutdown(wait=True)
+
+
+def load_state(checkpoint, sid):
+    '''
+    Return the state of simulator *sid* in the checkpoint directory *checkpoint*.
+
+    :raise FileNotFoundError: if the checkpoint has no state of *sid*
+    '''
+    with gzip.open(pathlib.Path(checkpoint, sid + STATE_SUFFIX), 'rt') as f:
+        return json.load(f)
+
+
+def write_scenario(directory, sids, **info):
+    '''
+    Write the list of simulators *sids* whose states make up a checkpoint and further information on the run.
+    '''
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    _write_json(pathlib.Path(directory, SCENARIO_FILE_NAME), dict(info, sids=sorted(sids)))
+
+
+def read_scenario(directory):
+    with open(pathlib.Path(directory, SCENARIO_FILE_NAME)) as f:
+        return json.load(f)
+
+
+def list_checkpoints(directory):
+    '''
+    Return the complete checkpoints in *directory*, oldest first.
+
+    :return: checkpoint directories (list of pathlib.Path)
+    '''
+    directory = pathlib.Path(directory)
+    sids = read_scenario(directory)['sids']
+    checkpoints = []
+    for path in sorted(directory.iterdir()):
+        if path.is_dir() and path.name.isdigit() and \
+                all(pathlib.Path(path, sid + STATE_SUFFIX).is_file() for sid in sids):
+            checkpoints.append(path)
+    return checkpoints
+
+
+def resolve_checkpoint(path):
+    '''
+    Return the checkpoint *path* refers to: a checkpoint directory itself or a
+    directory with checkpoints, of which the latest complete one is taken.
+
+    :raise ValueError: if there is no complete checkpoint
+    '''
+    path = pathlib.Path(path)
+    if path.name.isdigit() and not pathlib.Path(path, SCENARIO_FILE_NAME).exists():
+        return path
+    checkpoints = list_checkpoints(path)
+    if not checkpoints:
+        raise ValueError('No complete checkpoint in "{}"'.format(path))
+    return checkpoints[-1]
+
+
+def open_checkpoints(sid, checkpoint_dir=None, checkpoint_every=0, restore=None):
+    '''
+    Set up checkpointing for simulator *sid* from the init parameters of the simulators.
+
+    :param checkpoint_dir: directory to write checkpoints to, None to disable checkpoints (string)
+    :param checkpoint_every: checkpoint interval in scenario time [s] (int)
+    :param restore: checkpoint directory to restore from (string)
+    :return: tuple of (CheckpointWriter or None, restored state or None)
+    '''
+    time_offset = checkpoint_time(restore) if restore else 0
+    writer = CheckpointWriter(checkpoint_dir, sid, checkpoint_every, time_offset) if checkpoint_dir else None
+    state = load_state(restore, sid) if restore else None
+    return writer, state
@@ -0,0 +1,178 @@
+'''
+In-process compute node simulator for mosaik.
+
+Python implementation of the remote ``ComputeNodeSimulator``. Every compute
+node draws a base power between ``min_consumption`` and ``max_consumption``
+for the containers it runs. Deferrable work is pulled forward while locally
+generated power (PV feed-in and battery discharge) exceeds the base demand,
+so the node follows the available green power up to ``max_consumption``.
+'''
+import logging
+import random
+
+import mosaik_api
+
+from checkpoint import open_checkpoints
+from rpc_batch import BATCH_METHOD, BatchedStep
+from step_plan import StepPlan
+from wire import CODECS, accept_codecs
+
+
+logger = logging.getLogger('compute_sim')
+
+META = {
+    'type': 'time-based',
+    'codecs': CODECS,
+    'extra_methods': [BATCH_METHOD],
+    'models': {
+        'ComputeNode': {
+            'public': True,
+            'params': [],
+            'attrs': [
+                'pv_power',  # PV power at the node, negative for feed-in [W] (input)
+                'battery_power',  # Battery power, negative while discharging [W] (input)
+                'container_need',  # Power drawn by the containers [W] (output)
+                'cpu_level',  # CPU utilisation [%] (output)
+            ],
+            'attr_types': {
+                'pv_power': 'float',
+                'battery_power': 'float',
+                'container_need': 'float',
+                'cpu_level': 'float',
+            },
+        },
+    },
+}
+
+
+class ComputeNode:
+    '''
+    Compute node whose consumption adapts to the locally available power.
+    '''
+
+    def __init__(self, min_consumption, max_consumption, rng):
+        self.min_consumption = min_consumption
+        self.max_consumption = max_consumption
+        self.rng = rng
+        self.pv_power = 0.0
+        self.battery_power = 0.0
+        self.container_need = float(min_consumption)
+        self.cpu_level = self._cpu_level()
+
+    def draw(self):
+        '''
+        Return a random base power [W] (float).
+        '''
+        return self.rng.uniform(self.min_consumption, self.max_consumption)
+
+    def step(self, pv_power, battery_power, bases=None):
+        '''
+        Compute the consumption for the next step from the local PV and
+        battery power (both using the load convention: negative values are
+        power fed into the node).
+
+        :param pv_power: summed PV power [W] (float)
+        :param battery_power: summed battery power [W] (float)
+        :param bases: base powers of the base steps of a merged step, the consumption is their mean (list of floats,
+                      default: one draw)
+        :return: power drawn by the containers [W] (float)
+        '''
+        self.pv_power = pv_power
+        self.battery_power = battery_power
+        if bases is None:
+            bases = [self.draw()]
+        green = max(-pv_power, 0.0) + max(-battery_power, 0.0)
+        self.container_need = sum(min(max(base, green), self.max_consumption) for base in bases) / len(bases)
+        self.cpu_level = self._cpu_level()
+        return self.container_need
+
+    def _cpu_level(self):
+        if not self.max_consumption:
+            return 0.0
+        return 100.0 * self.container_need / self.max_consumption
+
+
+class ComputeNodeSimulator(BatchedStep, mosaik_api.Simulator):
+    def __init__(self):
+        super().__init__(META)
+        self.step_size = None
+        self.plan = None
+        self.min_consumption = None
+        self.max_consumption = None
+        self.rng = None
+        self.entities = {}
+        self.checkpoints = None
+        self.restored = None
+
+    def init(self, sid, time_resolution=1., step_size=900, min_consumption=40, max_consumption=200, seed=None,
+             step_times=None, checkpoint_dir=None, checkpoint_every=0, restore=None):
+        if min_consumption > max_consumption:
+            raise ValueError('min_consumption must not be larger than max_consumption')
+
+        accept_codecs(self)
+        self.step_size = step_size
+        self.plan = StepPlan(step_size, step_times)
+        self.min_consumption = min_consumption
+        self.max_consumption = max_consumption
+        self.rng = random.Random(seed)
+        self.checkpoints, self.restored = open_checkpoints(sid, checkpoint_dir, checkpoint_every, restore)
+        return self.meta
+
+    def create(self, num, model):
+        start_idx = len(self.entities)
+        entities = []
+        for i in range(num):
+            eid = '%s_%s' % (model, i + start_idx)
+            self.entities[eid] = ComputeNode(self.min_consumption, self.max_consumption, self.rng)
+            entities.append({'eid': eid, 'type': model, 'rel': []})
+        return entities
+
+    def setup_done(self):
+        if self.restored is not None:
+            version, internal_state, gauss_next = self.restored['rng']
+            self.rng.setstate((version, tuple(internal_state), gauss_next))
+            for eid, values in self.restored['nodes'].items():
+                node = self.entities[eid]
+                node.pv_power, node.battery_power, node.container_need, node.cpu_level = values
+            self.restored = None
+
+    def step(self, time, inputs, max_advance):
+        if self.checkpoints is not None and self.checkpoints.due(time):
+            self.checkpoints.save(time, {
+                'rng': self.rng.getstate(),
+                'nodes': {eid: [n.pv_power, n.battery_power, n.container_need, n.cpu_level]
+                          for eid, n in self.entities.items()},
+            })
+
+        # One draw per node and base step, in the order of fixed stepping, so that merged steps keep the random
+        # sequence of the following steps
+        bases = {eid: [] for eid in self.entities}
+        for _ in range(self.plan.base_steps(time)):
+            for eid, node in self.entities.items():
+                bases[eid].append(node.draw())
+        for eid, node in self.entities.items():
+            attrs = inputs.get(eid, {})
+            pv_power = sum(attrs.get('pv_power', {}).values())
+            battery_power = sum(attrs.get('battery_power', {}).values())
+            node.step(pv_power, battery_power, bases[eid])
+
+        return self.plan.next(time)
+
+    def get_data(self, outputs):
+        data = {}
+        for eid, attrs in outputs.items():
+            node = self.entities[eid]
+            data[eid] = {attr: getattr(node, attr) for attr in attrs}
+        return data
+
+    def finalize(self):
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+
+
+def main():
+    return mosaik_api.start_simulation(ComputeNodeSimulator(), 'In-process compute node simulator')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,573 @@
+'''
+Parameter sweeps of the demo scenario on several hosts.
+
+Takes a queue of scenario configurations, either a parameter grid like
+sweep.py or a list of configurations (a JSON list or a file with one JSON
+object per line, parameters that are not given keep the values of
+``main.py``), and runs every cell on one of the worker slots of the hosts::
+
+    python dispatch.py grid.json -o sweep -H 4*local -H 8*ssh:node1 -H 8*docker:tcp://node2:2375 \\
+        --image mosaik/dist/distributed-test-sim/orchestrator
+
+Every slot is a worker process (``dispatch.py --worker``) started by the
+command of its host kind:
+
+* ``local``: a process on this host,
+* ``ssh:HOST``: a process on *HOST* over ssh, in ``--remote-dir`` (a copy of
+  this directory, default: the same path as here),
+* ``docker:DOCKER_HOST``: a container of ``--image`` (the orchestrator image of
+  the distributed setup, see ../distributed/orchestrate.py) on the Docker
+  daemon *DOCKER_HOST* (``local`` for the local daemon).
+
+Workers read one cell at a time from stdin, run it in a fresh process with
+:func:`sweep.run_cell` and send back its output directory. Messages are JSON
+lines, everything the cells print goes to ``<out>/.workers/<slot>.log``.
+
+Scheduling: the cells are planned longest first onto one queue per slot by
+their estimated duration. A cell takes its number of steps (``end`` /
+``step_size``) times the seconds per step of the host, measured on the cells
+the host completed (and on the completed cells in ``<out>`` before the first
+measurement). A slot runs the cells of its own queue and, when it is empty,
+steals the last cell of the queue with the most estimated work left if it can
+finish the cell earlier than that slot would start it. Failed cells are
+retried up to ``--retries`` times, on another host if there is one. A worker
+that exits is restarted, a slot whose worker cannot be started is given up
+and its queue is handed to the other slots.
+
+Results are gathered into one store with the layout of sweep.py, so cells
+that are done are skipped and a sweep can be continued with either tool.
+Every attempt is appended to ``<out>/dispatch.jsonl`` (cell, slot, wall time,
+error).
+'''
+import base64
+import collections
+import io
+import json
+import os
+import pathlib
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+import sweep
+
+
+DOCKER = os.environ.get('DOCKER', 'docker')
+MONOLITHIC_DIR = pathlib.Path(__file__).resolve().parent
+HOST_KINDS = ('local', 'ssh', 'docker')
+WORKERS_DIR_NAME = '.workers'
+LOG_FILE_NAME = 'dispatch.jsonl'
+MAX_RESTARTS = 3  # Consecutive worker failures after which a slot is given up
+STEAL_INTERVAL = 1.0  # Seconds between checks of an idle slot for cells worth stealing
+
+
+def load_configs(path, defaults=None):
+    '''
+    Return the cells of the queue file *path*: a parameter grid ({param: [values]}), a JSON list of configurations
+    or one JSON configuration per line.
+
+    :param defaults: values of the parameters not given (default: :func:`sweep.default_params`)
+    :return: complete parameters of every cell (list of dicts)
+    '''
+    with open(path) as f:
+        text = f.read()
+    try:
+        queue = json.loads(text)
+    except ValueError:
+        queue = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(queue, dict):
+        return sweep.expand_grid(queue, defaults)
+    defaults = sweep.default_params() if defaults is None else defaults
+    cells = []
+    for config in queue:
+        unknown = set(config) - set(sweep.PARAMS)
+        if unknown:
+            raise ValueError('Unknown sweep parameters: {}, expected some of {}'.format(
+                ', '.join(sorted(unknown)), ', '.join(sweep.PARAMS)))
+        cells.append(dict(defaults, **config))
+    return cells
+
+
+def parse_host(spec):
+    '''
+    Parse the host *spec* ``[N*]KIND[:TARGET]``.
+
+    :return: tuple of (number of slots, kind, target or None)
+    '''
+    count, _, host = spec.rpartition('*')
+    kind, _, target = host.partition(':')
+    if kind not in HOST_KINDS:
+        raise ValueError('Unknown host kind "{}" in "{}", expected one of {}'.format(kind, spec, ', '.join(HOST_KINDS)))
+    if kind != 'local' and not target:
+        raise ValueError('Host "{}" needs a target ({}:HOST)'.format(spec, kind))
+    return int(count or 1), kind, target or None
+
+
+def worker_command(kind, target, image=None, remote_dir=None, remote_python='python3', docker=DOCKER):
+    '''
+    Return the command that starts a worker on a host (list of strings).
+    '''
+    if kind == 'local':
+        return [sys.executable, str(MONOLITHIC_DIR / 'dispatch.py'), '--worker']
+    if kind == 'ssh':
+        return ['ssh', '-o', 'BatchMode=yes', target, 'cd {} && {} dispatch.py --worker'.format(
+            shlex.quote(str(remote_dir or MONOLITHIC_DIR)), remote_python)]
+    if image is None:
+        raise ValueError('Docker hosts need an image (--image)')
+    command = [docker] + (['-H', target] if target != 'local' else [])
+    return command + ['run', '-i', '--rm', '--entrypoint', 'python', image, 'dispatch.py', '--worker']
+
+
+def steps(params):
+    return max(1, -(-params['end'] // params['step_size']))
+
+
+class CostModel:
+    '''
+    Seconds per step of every host, from the measured wall times of its cells.
+    '''
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.steps = collections.defaultdict(int)
+
+    def add(self, host, params, elapsed):
+        self.seconds[host] += elapsed
+        self.steps[host] += steps(params)
+
+    def rate(self, host=None):
+        if self.steps.get(host):
+            return self.seconds[host] / self.steps[host]
+        total = sum(self.steps.values())
+        return sum(self.seconds.values()) / total if total else 1.0
+
+    def estimate(self, params, host=None):
+        return steps(params) * self.rate(host)
+
+
+class Scheduler:
+    '''
+    Queues of the worker slots with work stealing and retries. Thread-safe, every slot runs in a thread of its own.
+
+    :param tasks: {hash: parameters} of the cells to run (dict)
+    :param slots: {slot name: host} (dict)
+    '''
+
+    def __init__(self, tasks, slots, model, retries=2):
+        self.tasks = tasks
+        self.slots = slots
+        self.model = model
+        self.retries = retries
+        self.queues = {slot: collections.deque() for slot in slots}
+        self.running = {}  # slot -> (hash, start time)
+        self.dropped = set()
+        self.attempts = collections.Counter()
+        self.failed_on = collections.defaultdict(set)  # hash -> hosts
+        self.results = {}  # hash -> error message or None
+        self.steals = 0
+        self.cond = threading.Condition()
+        loads = dict.fromkeys(slots, 0.0)
+        for key in sorted(tasks, key=lambda k: -model.estimate(tasks[k])):
+            slot = min(loads, key=loads.get)
+            self.queues[slot].append(key)
+            loads[slot] += model.estimate(tasks[key], slots[slot])
+
+    def _left(self, slot, now):
+        '''
+        Return the estimated seconds until *slot* has finished its running cell and its queue.
+        '''
+        host = self.slots[slot]
+        left = sum(self.model.estimate(self.tasks[key], host) for key in self.queues[slot])
+        if slot in self.running:
+            key, started = self.running[slot]
+            # A cell that runs longer than estimated is assumed to run as much longer again, so that the queue of a
+            # stuck slot is stolen eventually
+            left += abs(self.model.estimate(self.tasks[key], host) - (now - started))
+        return left
+
+    def _steal(self, thief):
+        now = time.monotonic()
+        victims = [slot for slot, queue in self.queues.items() if queue and slot != thief]
+        if not victims:
+            return None
+        victim = max(victims, key=lambda slot: self._left(slot, now))
+        key = self.queues[victim][-1]
+        # The victim would start its last cell when it has finished everything before it
+        starts = self._left(victim, now) - self.model.estimate(self.tasks[key], self.slots[victim])
+        if self.model.estimate(self.tasks[key], self.slots[thief]) >= starts:
+            return None
+        self.steals += 1
+        return self.queues[victim].pop()
+
+    def next(self, slot):
+        '''
+        Return the hash of the next cell for *slot*, waiting while other slots run cells that may be retried or
+        stolen. Return None when all cells are done or the slot is given up.
+        '''
+        with self.cond:
+            while slot not in self.dropped:
+                if self.queues[slot]:
+                    key = self.queues[slot].popleft()
+                else:
+                    key = self._steal(slot)
+                if key is not None:
+                    self.running[slot] = (key, time.monotonic())
+                    return key
+                if not self.running and not any(self.queues.values()):
+                    return None
+                self.cond.wait(STEAL_INTERVAL)
+            return None
+
+    def done(self, slot, key, elapsed):
+        with self.cond:
+            self.running.pop(slot, None)
+            self.model.add(self.slots[slot], self.tasks[key], elapsed)
+            self.results[key] = None
+            self.cond.notify_all()
+
+    def failed(self, slot, key, error):
+        '''
+        Queue the cell *key* again, on a host it has not failed on if possible, or record the error after the last
+        retry.
+
+        :return: True if the cell will be retried
+        '''
+        with self.cond:
+            self.running.pop(slot, None)
+            self.attempts[key] += 1
+            self.failed_on[key].add(self.slots[slot])
+            live = [s for s in self.slots if s not in self.dropped]
+            retry = self.attempts[key] <= self.retries and bool(live)
+            if retry:
+                others = [s for s in live if self.slots[s] not in self.failed_on[key]] or live
+                now = time.monotonic()
+                self.queues[min(others, key=lambda s: self._left(s, now))].appendleft(key)
+            else:
+                self.results[key] = error
+            self.cond.notify_all()
+            return retry
+
+    def drop(self, slot):
+        '''
+        Give up *slot* and hand its queue to the other slots.
+        '''
+        with self.cond:
+            self.dropped.add(slot)
+            queue, self.queues[slot] = self.queues[slot], collections.deque()
+            live = [s for s in self.slots if s not in self.dropped]
+            now = time.monotonic()
+            for key in queue:
+                if live:
+                    self.queues[min(live, key=lambda s: self._left(s, now))].append(key)
+                else:
+                    self.results[key] = 'No worker left'
+            self.cond.notify_all()
+
+
+class Worker:
+    '''
+    Worker process of a slot, see :func:`serve`.
+    '''
+
+    def __init__(self, command, log):
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log,
+                                     universal_newlines=True, bufsize=1)
+        self.hello = self.receive()
+
+    def receive(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            raise OSError('Worker exited with code {}'.format(self.proc.wait()))
+        return json.loads(line)
+
+    def run(self, key, params):
+        self.proc.stdin.write(json.dumps({'key': key, 'params': params}) + '\n')
+        self.proc.stdin.flush()
+        return self.receive()
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def pack(directory):
+    '''
+    Return the contents of *directory* as base64 encoded tar.gz archive (string).
+    '''
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        tar.add(str(directory), arcname='.')
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+def unpack(archive, directory):
+    '''
+    Extract the archive of :func:`pack` into *directory*.
+    '''
+    with tarfile.open(fileobj=io.BytesIO(base64.b64decode(archive)), mode='r:gz') as tar:
+        for member in tar.getmembers():
+            path = pathlib.PurePosixPath(member.name)
+            if path.is_absolute() or '..' in path.parts or not (member.isfile() or member.isdir()):
+                raise ValueError('Unexpected archive member {}'.format(member.name))
+        tar.extractall(str(directory))
+
+
+def store(out_dir, key, archive):
+    '''
+    Move the results of the cell *key* into the store *out_dir*, atomically like sweep.run_cell().
+    '''
+    partial_dir = pathlib.Path(out_dir, key + '.partial')
+    final_dir = pathlib.Path(out_dir, key)
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    partial_dir.mkdir(parents=True)
+    unpack(archive, partial_dir)
+    if not pathlib.Path(partial_dir, sweep.CELL_FILE_NAME).is_file():
+        raise ValueError('No {} in the results'.format(sweep.CELL_FILE_NAME))
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(partial_dir, final_dir)
+
+
+def run_slot(slot, command, scheduler, out_dir, log_lock, out_stream):
+    '''
+    Run cells of *scheduler* on a worker started with *command* until there are none left. Runs in a thread.
+    '''
+    worker = None
+    failures = 0
+    log_path = pathlib.Path(out_dir, WORKERS_DIR_NAME, re.sub(r'[^\w.-]', '_', slot) + '.log')
+    with open(log_path, 'a') as log:
+        while True:
+            if worker is None:
+                try:
+                    worker = Worker(command, log)
+                    if worker.hello.get('hash_version') != sweep.HASH_VERSION:
+                        raise OSError('Worker runs hash version {} instead of {}'.format(
+                            worker.hello.get('hash_version'), sweep.HASH_VERSION))
+                except (OSError, ValueError) as err:
+                    if worker is not None:
+                        worker.close()
+                        worker = None
+                    failures += 1
+                    out_stream('{}: worker failed to start: {}'.format(slot, err))
+                    if failures >= MAX_RESTARTS:
+                        out_stream('{}: giving up'.format(slot))
+                        scheduler.drop(slot)
+                        return
+                    continue
+            key = scheduler.next(slot)
+            if key is None:
+                break
+            try:
+                reply = worker.run(key, scheduler.tasks[key])
+                error, elapsed = reply['error'], reply['elapsed']
+                if error is None:
+                    store(out_dir, key, reply['archive'])
+            except (OSError, ValueError, KeyError) as err:
+                error, elapsed = '{}: {}'.format(type(err).__name__, err), None
+                worker.close()
+                worker = None
+                failures += 1
+            else:
+                failures = 0
+            with log_lock:
+                with open(pathlib.Path(out_dir, LOG_FILE_NAME), 'a') as f:
+                    f.write(json.dumps({'time': time.time(), 'hash': key, 'slot': slot, 'host': scheduler.slots[slot],
+                                        'wall_time': elapsed, 'error': error}) + '\n')
+            if error is None:
+                scheduler.done(slot, key, elapsed)
+                out_stream('{} done on {} ({:.1f} s)'.format(key[:12], slot, elapsed))
+            else:
+                retry = scheduler.failed(slot, key, error)
+                out_stream('{} failed on {}{}: {}'.format(key[:12], slot, ', retrying' if retry else '', error))
+            if failures >= MAX_RESTARTS:
+                out_stream('{}: giving up'.format(slot))
+                scheduler.drop(slot)
+                break
+    if worker is not None:
+        worker.close()
+
+
+def run_dispatch(cells, out_dir, hosts, retries=2, force=False, image=None, remote_dir=None, remote_python='python3',
+                 out_stream=print):
+    '''
+    Run all *cells* that have no results in *out_dir* yet on the worker slots of *hosts*.
+
+    :param cells: complete parameters of every cell (list of dicts), see :func:`load_configs`
+    :param hosts: host specs ``[N*]KIND[:TARGET]`` (list of strings)
+    :param retries: number of times a failed cell is run again
+    :param force: also re-run cells that are done (bool)
+    :return: {hash: error message or None} for the cells that were run (dict)
+    '''
+    out_dir = pathlib.Path(out_dir).resolve()
+    pathlib.Path(out_dir, WORKERS_DIR_NAME).mkdir(parents=True, exist_ok=True)
+    settings = sweep.settings()
+    digests = {}
+    tasks = {}
+    for params in cells:
+        key = sweep.cell_hash(params, settings, digests)
+        if key not in tasks and (force or not sweep.is_done(out_dir, key)):
+            tasks[key] = params
+    out_stream('{} cells, {} done, {} to run'.format(len(cells), len(cells) - len(tasks), len(tasks)))
+    if not tasks:
+        return {}
+
+    slots = {}
+    commands = {}
+    for spec in hosts:
+        count, kind, target = parse_host(spec)
+        host = kind if target is None else '{}:{}'.format(kind, target)
+        for i in range(count):
+            slot = '{}/{}'.format(host, sum(1 for s in slots.values() if s == host))
+            slots[slot] = host
+            commands[slot] = worker_command(kind, target, image, remote_dir, remote_python)
+
+    # Seconds per step measured on earlier cells of the store, until the hosts have measured their own
+    model = CostModel()
+    for cell in sweep.load_cells(out_dir):
+        if cell.get('wall_time'):
+            model.add(None, dict(sweep.default_params(), **cell['params']), cell['wall_time'])
+    scheduler = Scheduler(tasks, slots, model, retries)
+
+    log_lock = threading.Lock()
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=run_slot, args=(slot, commands[slot], scheduler, out_dir, log_lock, out_stream),
+                                name=slot, daemon=True)
+               for slot in slots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results = {key: scheduler.results.get(key, 'Not run') for key in tasks}
+    out_stream('{} cells in {:.1f} s on {} slots: {} done, {} failed, {} stolen, {} retried'.format(
+        len(tasks), time.perf_counter() - t0, len(slots), sum(1 for e in results.values() if e is None),
+        sum(1 for e in results.values() if e is not None), scheduler.steals,
+        sum(min(n, retries) for n in scheduler.attempts.values())))
+    return results
+
+
+def serve(in_stream=sys.stdin, out_stream=None):
+    '''
+    Worker: run the cells read from *in_stream* and write their results to *out_stream* (default: stdout), see the
+    module docstring. Everything else written to stdout goes to stderr.
+    '''
+    import multiprocessing
+    import tempfile
+
+    if out_stream is None:
+        out_stream = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def send(message):
+        out_stream.write(json.dumps(message) + '\n')
+        out_stream.flush()
+
+    send({'host': socket.gethostname(), 'pid': os.getpid(), 'hash_version': sweep.HASH_VERSION})
+    with tempfile.TemporaryDirectory(prefix='dispatch-') as work_dir:
+        # One fresh process per cell like sweep.run_sweep(), the next one is started while the cell is sent back
+        with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+            for line in in_stream:
+                task = json.loads(line)
+                key, error, elapsed = pool.apply(sweep.run_cell, ((work_dir, task['key'], task['params']),))
+                reply = {'key': key, 'error': error, 'elapsed': elapsed}
+                if error is None:
+                    cell_dir = pathlib.Path(work_dir, key)
+                    reply['archive'] = pack(cell_dir)
+                    shutil.rmtree(cell_dir)
+                send(reply)
+
+
+def main():
+    import argparse
+
+    if sys.argv[1:] == ['--worker']:
+        return serve()
+
+    # Command line parser.
+    parser = argparse.ArgumentParser(
+        description='Run a parameter sweep of the demo scenario on several hosts.'
+    )
+
+    parser.add_argument(
+        'queue',
+        metavar='QUEUE',
+        help='JSON file with a parameter grid ({param: [values]}) or a list of configurations, or a file with one '
+             'JSON configuration per line (params: %s)' % ', '.join(sweep.PARAMS)
+    )
+
+    parser.add_argument(
+        '-o', '--out-dir',
+        default='sweep',
+        metavar='DIR',
+        help='result store (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-H', '--host',
+        action='append',
+        metavar='[N*]KIND[:TARGET]',
+        help='N worker slots on a host: local, ssh:HOST or docker:DOCKER_HOST (default: one local slot per CPU)'
+    )
+
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=2,
+        metavar='N',
+        help='number of times a failed cell is run again (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--image',
+        metavar='IMAGE',
+        help='worker image of docker hosts (the orchestrator image of ../distributed)'
+    )
+
+    parser.add_argument(
+        '--remote-dir',
+        metavar='DIR',
+        help='copy of this directory on ssh hosts (default: %s)' % MONOLITHIC_DIR
+    )
+
+    parser.add_argument(
+        '--remote-python',
+        default='python3',
+        metavar='PYTHON',
+        help='Python interpreter on ssh hosts (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='re-run cells that already have results'
+    )
+
+    args = parser.parse_args()
+
+    try:
+        cells = load_configs(args.queue)
+        hosts = args.host or ['{}*local'.format(os.cpu_count() or 1)]
+        errors = run_dispatch(cells, args.out_dir, hosts, retries=args.retries, force=args.force, image=args.image,
+                              remote_dir=args.remote_dir, remote_python=args.remote_python)
+        sys.exit(3 if any(errors.values()) else 0)
+
+    except Exception as err:
+
+        print(str(err))
+        sys.exit(3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+'''
+Vectorised ensemble of parameter variants of the demo scenario.
+
+Sensitivity studies over the battery capacity and the consumption range of
+the compute nodes would need one full co-simulation per variant, most of
+which repeats the same work (reading the PV data, stepping the simulators,
+exchanging data through mosaik). The :class:`Ensemble` runs M variants of one
+site (a PV unit, a compute node and a battery at one power node, the default
+fleet of ``main.py``) in one process: the states of the batteries, compute
+nodes and power nodes are NumPy arrays of shape (M,) that are advanced
+together, and the PV stream is read only once and shared by all variants.
+
+Every step follows the data flow of the co-simulation:
+
+1. the battery executes the command the power node decided in the previous
+   step (``battery_sim.Battery``),
+2. the compute node draws its base consumption and follows the available
+   green power (``compute_sim.ComputeNode``),
+3. the power node balances the site, meters the grid energy and decides on the
+   next battery command (``grid_sim.PowerNode``).
+
+The power flow of the grid is not computed, since it does not feed back into
+the site. All variants share one uniform random number per step (common
+random numbers), so differences between variants are caused by their
+parameters and not by different random draws. With the same seed, a variant
+reproduces the co-simulation with the same parameters.
+'''
+import itertools
+import logging
+import random
+import sys
+import time as time_mod
+from datetime import datetime
+
+import numpy as np
+
+from pv_sim import DATE_FORMAT, open_profile
+from step_plan import StepPlan
+
+
+logger = logging.getLogger('ensemble')
+
+PARAMS = ('battery_capacity', 'min_consumption', 'max_consumption')
+ATTRS = ('pv_power', 'current_load', 'stored_energy', 'container_need', 'net_metering_power', 'grid_energy')
+
+
+def make_variants(battery_capacities, consumption_ranges):
+    '''
+    Return the variants for all combinations of *battery_capacities* and *consumption_ranges*.
+
+    :param battery_capacities: battery capacities [Wh] (list of floats)
+    :param consumption_ranges: (min_consumption, max_consumption) tuples [W] (list)
+    :return: {param: array of shape (M,)} for the params in PARAMS (dict)
+    '''
+    rows = [(capacity, low, high) for capacity, (low, high) in itertools.product(battery_capacities,
+                                                                                 consumption_ranges)]
+    if not rows:
+        raise ValueError('No variants')
+    columns = np.asarray(rows, dtype=float).T
+    return dict(zip(PARAMS, columns))
+
+
+class Ensemble:
+    '''
+    M variants of one site, advanced together.
+
+    :param variants: {param: values} with one value per variant for every param in PARAMS (dict)
+    :param initial_soc: initial state of charge of the batteries [0..1] (float)
+    :param seed: seed of the random consumption (int or None)
+    '''
+
+    def __init__(self, variants, initial_soc=0.5, seed=None):
+        self.battery_capacity = np.asarray(variants['battery_capacity'], dtype=float)
+        self.min_consumption = np.asarray(variants['min_consumption'], dtype=float)
+        self.max_consumption = np.asarray(variants['max_consumption'], dtype=float)
+        self.size = len(self.battery_capacity)
+        if not (len(self.min_consumption) == len(self.max_consumption) == self.size):
+            raise ValueError('All variant parameters need the same number of values')
+        if np.any(self.min_consumption > self.max_consumption):
+            raise ValueError('min_consumption must not be larger than max_consumption')
+
+        self.rng = random.Random(seed)
+        self.stored_energy = self.battery_capacity * initial_soc
+        self.current_load = np.zeros(self.size)
+        self.container_need = self.min_consumption.copy()
+        self.net_metering_power = np.zeros(self.size)
+        self.grid_energy = np.zeros(self.size)
+        self.battery_power = np.zeros(self.size)  # Command for the next step, positive for charging [W]
+
+    def step(self, pv_power, duration):
+        '''
+        Advance all variants by one step.
+
+        :param pv_power: PV power of the step, negative for feed-in [W] (float)
+        :param duration: step duration [s] (int)
+        '''
+        hours = duration / 3600
+
+        # Battery
+        energy = np.minimum(np.maximum(self.battery_power * hours, -self.stored_energy),
+                            self.battery_capacity - self.stored_energy)
+        self.stored_energy += energy
+        self.current_load = energy / hours if hours else np.zeros(self.size)
+
+        # Compute node
+        base = self.min_consumption + (self.max_consumption - self.min_consumption) * self.rng.random()
+        green = max(-pv_power, 0.0) + np.maximum(-self.current_load, 0.0)
+        self.container_need = np.minimum(np.maximum(base, green), self.max_consumption)
+
+        # Power node
+        residual = self.container_need + pv_power
+        max_battery_power = self.battery_capacity * 3600 / duration if duration else np.zeros(self.size)
+        self.battery_power = np.minimum(np.maximum(-residual, -max_battery_power), max_battery_power)
+        self.net_metering_power = residual + self.current_load
+        self.grid_energy += np.maximum(self.net_metering_power, 0.0) * hours
+
+    def state(self, attr, pv_power):
+        if attr == 'pv_power':
+            return np.full(self.size, pv_power)
+        return getattr(self, attr)
+
+
+def run_ensemble(variants, datafile, start, until, step_size, step_times=None, attrs=ATTRS, seed=None,
+                 aggregate='mean', pv_profile='data', pv_seed=0):
+    '''
+    Run the *variants* with the PV data of *datafile* from the date *start* for *until* seconds.
+
+    :param step_times: planned step times, see step_plan.py (list of ints, optional)
+    :param attrs: recorded attributes, see ATTRS (iterable of strings)
+    :param pv_profile: PV input beyond the end of the data and its seed, see pv_sim.open_profile() (string)
+    :return: {'time': array (T,), <attr>: array (T, M) for every recorded attr, <param>: array (M,)} (dict)
+    '''
+    table = open_profile(datafile, pv_profile, pv_seed)
+    start_date = datetime.strptime(start, DATE_FORMAT)
+    offset = int((start_date - table.start).total_seconds())
+    if not 0 <= offset < table.rows * table.resolution:
+        raise ValueError('Start date "{}" not in PV data file.'.format(start))
+
+    plan = StepPlan(step_size, step_times)
+    times = [0]
+    while plan.next(times[-1]) < until:
+        times.append(plan.next(times[-1]))
+    times = np.asarray(times)
+    next_times = np.append(times[1:], plan.next(int(times[-1])))
+    times, first, last = table.step_rows(offset, times, next_times)
+    if len(times) < len(next_times):
+        logger.warning('PV data ends after %d of %d steps', len(times), len(next_times))
+    pv_power = table.windows('P', first, last, aggregate)
+    durations = next_times[:len(times)] - times
+
+    ensemble = Ensemble(variants, seed=seed)
+    results = {attr: np.empty((len(times), ensemble.size)) for attr in attrs}
+    for i, (pv, duration) in enumerate(zip(pv_power.tolist(), durations.tolist())):
+        ensemble.step(pv, duration)
+        for attr, values in results.items():
+            values[i] = ensemble.state(attr, pv)
+
+    results['time'] = times
+    for param in PARAMS:
+        results[param] = np.asarray(variants[param], dtype=float)
+    return results
+
+
+def write_results(filename, results):
+    '''
+    Write the *results* of :func:`run_ensemble` to the HDF5 file *filename*: the datasets ``time`` (T,), one dataset
+    per param (M,) and one dataset per attribute (T x M).
+    '''
+    import h5py
+
+    with h5py.File(filename, 'w') as f:
+        for name, values in results.items():
+            f.create_dataset(name, data=values, compression='gzip' if values.ndim > 1 else None)
+
+
+def main():
+    import argparse
+
+    import main as scenario
+
+    def consumption_range(value):
+        low, sep, high = value.partition(':')
+        if not sep:
+            raise argparse.ArgumentTypeError('expected MIN:MAX, got "{}"'.format(value))
+        return float(low), float(high)
+
+    parser = argparse.ArgumentParser(
+        description='Run parameter variants of the demo scenario as vectorised ensemble.'
+    )
+
+    parser.add_argument(
+        '-b', '--battery-capacity',
+        type=float,
+        nargs='+',
+        default=[scenario.BATTERY_CAPACITY],
+        metavar='WH',
+        help='battery capacities [Wh] (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-c', '--consumption-range',
+        type=consumption_range,
+        nargs='+',
+        default=[(scenario.MIN_CONSUMPTION, scenario.MAX_CONSUMPTION)],
+        metavar='MIN:MAX',
+        help='consumption ranges of the compute node [W] (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--datafile',
+        default=scenario.PV_DATA,
+        metavar='CSV',
+        help='PV data file (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help='seed of the random consumption'
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help='write the results to this HDF5 file'
+    )
+
+    args = parser.parse_args()
+    logger.setLevel(logging.INFO)
+
+    variants = make_variants(args.battery_capacity, args.consumption_range)
+    logger.info('Running %d variants ...', len(variants['battery_capacity']))
+    t0 = time_mod.perf_counter()
+    results = run_ensemble(variants, args.datafile, scenario.START, scenario.END, scenario.STEP_SIZE,
+                           seed=args.seed, pv_profile=scenario.PV_PROFILE, pv_seed=scenario.PV_SEED)
+    logger.info('%d variants x %d steps in %.2f s', len(variants['battery_capacity']), len(results['time']),
+                time_mod.perf_counter() - t0)
+
+    print('battery_capacity\tmin_consumption\tmax_consumption\tgrid_energy')
+    for i in range(len(variants['battery_capacity'])):
+        print('{:g}\t{:g}\t{:g}\t{:.1f}'.format(*(results[param][i] for param in PARAMS),
+                                                 results['grid_energy'][-1, i]))
+    if args.output:
+        write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+'''
+Index over the entities of a grid.
+
+The grid simulator returns all buses, branches, transformers and power nodes
+as one flat list of children. :class:`GridIndex` sorts them once by type,
+entity ID and node ID so that the scenario does not have to scan the list
+again for every lookup.
+'''
+from collections import defaultdict
+from types import MappingProxyType
+
+
+def node_id(eid):
+    '''
+    Return the node ID of a grid entity ID, i.e. the part after the grid
+    index ('0-node_a1' and '0-node_a1-pn' both belong to node 'node_a1').
+
+    :param eid: entity ID (string)
+    :return: node ID (string)
+    '''
+    parts = eid.split('-', 2)
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+class GridIndex:
+    '''
+    Lookup tables for the children of a grid entity, built in a single pass.
+
+    :param entities: children of the grid entity (list of mosaik entities)
+    '''
+
+    def __init__(self, entities):
+        self.entities = list(entities)
+        self._by_type = defaultdict(list)
+        self._by_eid = {}
+        self._by_node = defaultdict(dict)
+
+        for entity in self.entities:
+            self._by_type[entity.type].append(entity)
+            self._by_eid[entity.eid] = entity
+            self._by_node[entity.type][node_id(entity.eid)] = entity
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def __contains__(self, eid):
+        return eid in self._by_eid
+
+    def types(self):
+        return list(self._by_type)
+
+    def of_type(self, *etypes):
+        '''
+        Return all entities of the given types, in the order of the grid.
+
+        :param etypes: entity types, e.g. 'PQBus' (strings)
+        :return: entities (list)
+        '''
+        if len(etypes) == 1:
+            return list(self._by_type.get(etypes[0], ()))
+        # Entities of several types are interleaved in the grid
+        etypes = set(etypes)
+        return [e for e in self.entities if e.type in etypes]
+
+    def get(self, eid):
+        '''
+        Return the entity with the ID *eid*.
+
+        :param eid: entity ID (string)
+        :return: entity (mosaik entity)
+        :raise KeyError: if the grid has no such entity
+        '''
+        return self._by_eid[eid]
+
+    def node(self, etype, nid):
+        '''
+        Return the entity of type *etype* at node *nid*.
+
+        :param etype: entity type, e.g. 'PowerNode' (string)
+        :param nid: node ID, e.g. 'node_a1' (string)
+        :return: entity (mosaik entity)
+        :raise KeyError: if there is no such entity
+        '''
+        return self._by_node[etype][nid]
+
+    def nodes(self, etype):
+        '''
+        Return a read-only mapping of node IDs to the entities of type *etype*.
+
+        :param etype: entity type, e.g. 'PQBus' (string)
+        :return: node ID -> entity (mapping)
+        '''
+        return MappingProxyType(self._by_node.get(etype, {}))
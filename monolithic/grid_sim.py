@@ -0,0 +1,229 @@
+'''
+In-process grid simulator for mosaik.
+
+Python implementation of the remote ``PyPower`` simulator. It extends the
+``mosaik_pypower`` adapter by a ``PowerNode`` for every PQ bus. A power node
+is the metering point of a site: it sums up the consumption of the compute
+nodes (``container_need``) and the feed-in/consumption of PV and batteries
+(``P``), feeds the net load into its bus, meters the energy drawn from the
+grid and tells the battery what to do in the next step (``battery_setpoint``,
+or as string ``battery_action`` for the remote battery simulator).
+'''
+import copy
+import logging
+
+import mosaik_api
+from mosaik_pypower import model
+from mosaik_pypower.mosaik import PyPower as _PyPower, meta as _pypower_meta
+
+from battery_sim import format_action, parse_action
+from checkpoint import open_checkpoints
+from power_flow import PowerFlow
+from rpc_batch import BATCH_METHOD, BatchedStep
+from step_plan import StepPlan
+from wire import CODECS, accept_codecs
+
+
+logger = logging.getLogger('grid_sim')
+
+POWER_NODE_SUFFIX = 'pn'
+BATTERY_MODEL = 'Battery'  # P inputs from entities of this model are battery power
+POWER_FLOW_SOLVERS = ('cached', 'pypower')  # See power_flow.py, 'pypower' runs runpf() in every step
+
+META = copy.deepcopy(_pypower_meta)
+META['type'] = 'time-based'
+META['codecs'] = CODECS
+META['extra_methods'] = [BATCH_METHOD]
+META['models']['PowerNode'] = {
+    'public': False,
+    'params': [],
+    'attrs': [
+        'P',  # Net active power of the site, inputs: PV and battery power [W]
+        'Q',  # Reactive power of the bus [VAr]
+        'Vl',  # Nominal bus voltage [V]
+        'Vm',  # Voltage magnitude [V]
+        'Va',  # Voltage angle [deg]
+        'container_need',  # Consumption of the compute nodes [W] (input)
+        'net_metering_power',  # Power drawn from (positive) or fed into (negative) the grid [W]
+        'grid_energy',  # Energy drawn from the grid since the start [Wh]
+        'battery_action',  # Command for the battery in the next step, e.g. 'charge:250'
+        'battery_setpoint',  # Command for the battery in the next step, positive for charging [W]
+    ],
+    'attr_types': dict({attr: 'float' for attr in (
+        'P', 'Q', 'Vl', 'Vm', 'Va', 'container_need', 'net_metering_power', 'grid_energy', 'battery_setpoint')},
+        battery_action='str'),
+}
+
+
+def make_power_node_eid(bus_eid):
+    return '{}-{}'.format(bus_eid, POWER_NODE_SUFFIX)
+
+
+class PowerNode:
+    '''
+    Metering point attached to a PQ bus.
+    '''
+
+    def __init__(self, bus, battery_capacity):
+        self.bus = bus
+        self.battery_capacity = battery_capacity
+        self.P = 0.0
+        self.container_need = 0.0
+        self.net_metering_power = 0.0
+        self.grid_energy = 0.0
+        self.battery_setpoint = 0.0
+
+    @property
+    def battery_action(self):
+        return format_action(self.battery_setpoint)
+
+    def step(self, inputs, duration):
+        '''
+        Balance the inputs of one step and decide on the next battery action.
+
+        :param inputs: inputs of this node as passed to ``step()`` (dict)
+        :param duration: step duration [s] (int)
+        :return: net load of the site [W] (float)
+        '''
+        battery_power = 0.0
+        batteries = 0
+        other_power = 0.0
+        for src, value in inputs.get('P', {}).items():
+            if src.split('.', 1)[-1].startswith(BATTERY_MODEL):
+                battery_power += value
+                batteries += 1
+            else:
+                other_power += value
+        self.container_need = sum(inputs.get('container_need', {}).values())
+
+        # Power each battery should take (surplus) or deliver (deficit), every battery of the site gets the same command.
+        residual = self.container_need + other_power
+        target = -residual / max(batteries, 1)
+        max_battery_power = self.battery_capacity * 3600 / duration if duration else 0.0
+        target = min(max(target, -max_battery_power), max_battery_power)
+        self.battery_setpoint = target
+
+        self.P = residual + battery_power
+        self.net_metering_power = self.P
+        self.grid_energy += max(self.net_metering_power, 0.0) * duration / 3600
+        return self.P
+
+
+class PyPower(BatchedStep, _PyPower):
+    '''
+    ``mosaik_pypower`` adapter with metering ``PowerNode`` entities.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.meta = copy.deepcopy(self.meta)
+        self.meta.update(META)
+        self.battery_capacity = None
+        self.plan = None
+        self._power_nodes = {}
+        self._solvers = []
+        self.power_flow = None
+        self.checkpoints = None
+        self.restored = None
+
+    def init(self, sid, time_resolution=1., step_size=900, battery_capacity=0, pos_loads=True, step_times=None,
+             power_flow='cached', checkpoint_dir=None, checkpoint_every=0, restore=None):
+        if power_flow not in POWER_FLOW_SOLVERS:
+            raise ValueError('Unknown power flow solver "{}", expected one of {}'.format(power_flow, POWER_FLOW_SOLVERS))
+        accept_codecs(self)
+        self.battery_capacity = battery_capacity
+        self.power_flow = power_flow
+        self.plan = StepPlan(step_size, step_times)
+        self.checkpoints, self.restored = open_checkpoints(sid, checkpoint_dir, checkpoint_every, restore)
+        return super().init(sid, step_size, pos_loads)
+
+    def create(self, num, model, gridfile, sheetnames=None):
+        grids = super().create(num, model, gridfile, sheetnames)
+        self._solvers.extend(PowerFlow(ppc) for ppc in self._ppcs[len(self._solvers):])
+        for grid in grids:
+            nodes = []
+            for child in grid['children']:
+                if child['type'] != 'PQBus':
+                    continue
+                eid = make_power_node_eid(child['eid'])
+                self._power_nodes[eid] = PowerNode(child['eid'], self.battery_capacity)
+                nodes.append({'eid': eid, 'type': 'PowerNode', 'rel': [child['eid']]})
+            grid['children'].extend(nodes)
+            grid['children'].sort(key=lambda c: c['eid'])
+        return grids
+
+    def setup_done(self):
+        if self.restored is not None:
+            for eid, values in self.restored['power_nodes'].items():
+                node = self._power_nodes[eid]
+                node.P, node.container_need, node.net_metering_power, node.grid_energy, setpoint = values
+                node.battery_setpoint = parse_action(setpoint) if isinstance(setpoint, str) else setpoint
+            self.restored = None
+
+    def step(self, time, inputs, max_advance):
+        if self.checkpoints is not None and self.checkpoints.due(time):
+            self.checkpoints.save(time, {
+                'power_nodes': {eid: [n.P, n.container_need, n.net_metering_power, n.grid_energy, n.battery_setpoint]
+                                for eid, n in self._power_nodes.items()},
+            })
+
+        bus_inputs = {}
+        for eid, attrs in inputs.items():
+            if eid not in self._power_nodes:
+                bus_inputs[eid] = attrs
+
+        duration = self.plan.duration(time)
+        for eid, node in self._power_nodes.items():
+            load = node.step(inputs.get(eid, {}), duration)
+            bus_inputs.setdefault(node.bus, {}).setdefault('P', {})[eid] = load
+
+        if self.power_flow == 'pypower':
+            super().step(time, bus_inputs)
+        else:
+            self._solve(bus_inputs)
+        return time + duration
+
+    def _solve(self, inputs):
+        # Same as _PyPower.step(), but with the cached solvers instead of runpf().
+        for ppc in self._ppcs:
+            model.reset_inputs(ppc)
+
+        for eid, attrs in inputs.items():
+            ppc = model.case_for_eid(eid, self._ppcs)
+            entity = self._entities[eid]
+            values = {}
+            for name, sources in attrs.items():
+                values[name] = sum(float(v) for v in sources.values())
+                if name == 'P':
+                    values[name] *= self.pos_loads
+            model.set_inputs(ppc, entity['etype'], entity['idx'], values, entity['static'])
+
+        results = [solver.solve(ppc) for solver, ppc in zip(self._solvers, self._ppcs)]
+        self._cache = model.get_cache_entries(results, self._entities)
+
+    def get_data(self, outputs):
+        data = {}
+        bus_outputs = {}
+        for eid, attrs in outputs.items():
+            node = self._power_nodes.get(eid)
+            if node is None:
+                bus_outputs[eid] = attrs
+                continue
+            bus_attrs = [a for a in attrs if a in ('Q', 'Vl', 'Vm', 'Va')]
+            bus_data = super().get_data({node.bus: bus_attrs})[node.bus] if bus_attrs else {}
+            data[eid] = {attr: bus_data[attr] if attr in bus_data else getattr(node, attr) for attr in attrs}
+
+        data.update(super().get_data(bus_outputs))
+        return data
+
+    def finalize(self):
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+
+
+def main():
+    return mosaik_api.start_simulation(PyPower(), 'In-process PyPower simulator')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+'''
+Per-simulator step latency instrumentation.
+
+:class:`StepProfiler` wraps the proxies mosaik uses to talk to the simulators
+and measures, for every simulator and step:
+
+* ``step``: duration of the ``step()`` call (request until response, so for
+  remote simulators this includes the network round-trip),
+* ``get_data``: duration of the ``get_data()`` calls for that step,
+* ``wait``: time between the end of the previous step (including its
+  ``get_data()`` calls) and the next ``step()`` request, i.e. the time the
+  simulator is idle waiting for its inputs.
+
+The report contains percentiles per simulator and phase, the ratio of
+simulated time to wall-clock time and a flame-style breakdown in the folded
+stack format understood by ``flamegraph.pl`` and speedscope.
+'''
+import csv
+import json
+import logging
+import time
+
+
+logger = logging.getLogger('instrumentation')
+
+PHASES = ('step', 'get_data', 'wait')
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values, p):
+    '''
+    Return the *p*-th percentile (nearest rank) of *sorted_values*.
+
+    :param sorted_values: values in ascending order (list)
+    :param p: percentile between 0 and 100 (number)
+    :return: percentile or None if there are no values (float)
+    '''
+    if not sorted_values:
+        return None
+    rank = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class _TimedProxy:
+    '''
+    Stand-in for a simulator proxy that times ``step()`` and ``get_data()``.
+    '''
+
+    def __init__(self, proxy, sim, profiler):
+        self._proxy = proxy
+        self._sim = sim
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        func = getattr(self._proxy, name)
+        if name not in ('step', 'get_data'):
+            return func
+
+        profiler = self._profiler
+        sid = self._sim.sid
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            sim_time = args[0] if name == 'step' else self._sim.last_step
+            if name == 'step':
+                profiler.record_wait(sid, sim_time, start)
+            event = func(*args, **kwargs)
+            if event.triggered:
+                # In-process simulators are done when the call returns.
+                profiler.record(sid, sim_time, name, start, time.perf_counter())
+            else:
+                event.callbacks.append(
+                    lambda _: profiler.record(sid, sim_time, name, start, time.perf_counter()))
+            return event
+
+        return timed
+
+
+class StepProfiler:
+    '''
+    Collects step, get_data and wait times of all simulators of a world.
+
+    Usage::
+
+        profiler = StepProfiler(world)
+        profiler.install()
+        profiler.run(until=END)
+        profiler.write('profile')  # profile.json, profile.csv, profile.folded
+    '''
+
+    def __init__(self, world):
+        self.world = world
+        self.samples = []  # (sid, sim time, phase, duration [s])
+        self.names = {}  # sid -> simulator name
+        self._last_end = {}
+        self.wall_time = None
+        self.sim_time = None
+
+    def install(self):
+        '''
+        Wrap the proxies of all simulators started so far.
+        '''
+        for sid, sim in self.world.sims.items():
+            if not isinstance(sim.proxy, _TimedProxy):
+                sim.proxy = _TimedProxy(sim.proxy, sim, self)
+                self.names[sid] = sim.name
+
+    def run(self, until, **kwargs):
+        '''
+        Run the world until *until* and measure the wall-clock time.
+        '''
+        start = time.perf_counter()
+        for sid in self.names:
+            self._last_end[sid] = start
+        try:
+            self.world.run(until=until, **kwargs)
+        finally:
+            self.wall_time = time.perf_counter() - start
+            self.sim_time = until * self.world.time_resolution
+
+    def record(self, sid, sim_time, phase, start, end):
+        self.samples.append((sid, sim_time, phase, end - start))
+        self._last_end[sid] = end
+
+    def record_wait(self, sid, sim_time, now):
+        last_end = self._last_end.get(sid)
+        if last_end is not None:
+            self.samples.append((sid, sim_time, 'wait', now - last_end))
+
+    def report(self):
+        '''
+        Return the statistics per simulator and phase.
+
+        :return: report (dict)
+        '''
+        durations = {}
+        for sid, _, phase, duration in self.samples:
+            durations.setdefault(sid, {}).setdefault(phase, []).append(duration)
+
+        simulators = {}
+        for sid, phases in sorted(durations.items()):
+            stats = {}
+            for phase in PHASES:
+                values = sorted(phases.get(phase, []))
+                total = sum(values)
+                entry = {
+                    'count': len(values),
+                    'total': total,
+                    'mean': total / len(values) if values else None,
+                    'max': values[-1] if values else None,
+                }
+                for p in PERCENTILES:
+                    entry['p%d' % p] = percentile(values, p)
+                stats[phase] = entry
+            simulators[sid] = {'name': self.names.get(sid, sid), 'phases': stats}
+
+        ratio = self.sim_time / self.wall_time if self.wall_time else None
+        return {
+            'wall_time': self.wall_time,
+            'sim_time': self.sim_time,
+            'sim_wall_ratio': ratio,
+            'simulators': simulators,
+        }
+
+    def folded(self):
+        '''
+        Return the total time per simulator and phase as folded stacks
+        ('mosaik;<name>;<sid>;<phase> <microseconds>').
+
+        :return: lines (list of strings)
+        '''
+        totals = {}
+        for sid, _, phase, duration in self.samples:
+            totals[(sid, phase)] = totals.get((sid, phase), 0.0) + duration
+        return ['mosaik;{};{};{} {}'.format(self.names.get(sid, sid), sid, phase, int(total * 1e6))
+                for (sid, phase), total in sorted(totals.items())]
+
+    def write(self, prefix):
+        '''
+        Write the report (``<prefix>.json``), the raw samples
+        (``<prefix>.csv``) and the flame-style breakdown (``<prefix>.folded``).
+
+        :param prefix: path prefix of the output files (string)
+        '''
+        with open(prefix + '.json', 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        with open(prefix + '.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('sid', 'sim_time', 'phase', 'duration'))
+            writer.writerows(self.samples)
+        with open(prefix + '.folded', 'w') as f:
+            f.write('\n'.join(self.folded()) + '\n')
+        logger.info('Profile written to %s.{json,csv,folded}', prefix)
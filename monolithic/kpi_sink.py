@@ -0,0 +1,371 @@
+'''
+Streaming KPIs of the scenario, computed while it runs.
+
+Instead of reading the KPIs back from the full result file, this simulator
+keeps constant-size statistics of the fleet totals of its inputs and writes a
+small JSON summary at the end of the run:
+
+* per entity type and attribute: count, sum, mean, min, max, a histogram
+  with a fixed number of bins (:class:`Histogram`) and quantiles from a relative-error quantile sketch
+  (:class:`QuantileSketch`),
+* KPIs of the site from the powers integrated over the step durations:
+
+  - ``pv_energy``: PV energy produced [Wh]
+  - ``consumption``: energy drawn by the compute nodes [Wh]
+  - ``grid_import`` / ``grid_export``: energy drawn from / fed into the grid [Wh]
+  - ``grid_energy``: final meter reading of the power nodes [Wh]
+  - ``self_consumption``: share of the PV energy used on site
+  - ``self_sufficiency``: share of the compute demand met by PV and battery
+  - ``battery_charged`` / ``battery_discharged``: battery throughput [Wh]
+  - ``battery_cycles``: equivalent full cycles of the batteries
+
+Inputs are identified by entity type and attribute (see INPUTS). The memory
+used does not depend on the number of steps or entities.
+
+All statistics are part of the checkpoints (see checkpoint.py), so the KPIs of
+a restored run cover the whole run since its start. If the checkpoint has no
+KPI state (it was written without KPIs), they only cover the steps after it;
+``start`` in the summary is the time the KPIs start at.
+'''
+import json
+import logging
+import math
+
+import mosaik_api
+
+from checkpoint import CheckpointWriter, open_checkpoints
+from step_plan import StepPlan
+
+
+logger = logging.getLogger('kpi_sink')
+
+# (entity type, attribute) of the inputs the KPIs are computed from
+PV_POWER = ('PV', 'P')  # Negative for feed-in [W]
+BATTERY_POWER = ('Battery', 'current_load')  # Positive while charging [W]
+COMPUTE_POWER = ('ComputeNode', 'container_need')  # [W]
+NET_POWER = ('PowerNode', 'net_metering_power')  # Positive while drawing from the grid [W]
+GRID_ENERGY = ('PowerNode', 'grid_energy')  # Meter reading [Wh]
+INPUTS = (PV_POWER, BATTERY_POWER, COMPUTE_POWER, NET_POWER, GRID_ENERGY)
+QUANTILES = (0.05, 0.5, 0.95, 0.99)
+HISTOGRAM_BINS = 50  # Bins per histogram, the width grows as needed
+RELATIVE_ACCURACY = 0.01  # Of the quantile sketches
+
+META = {
+    'type': 'time-based',
+    'models': {
+        'Aggregator': {
+            'public': True,
+            'any_inputs': True,
+            'params': [
+                'filename',  # Summary file (JSON)
+                'battery_capacity',  # Capacity of all batteries [Wh], for the equivalent full cycles
+            ],
+            'attrs': [],
+        },
+    },
+}
+
+
+class QuantileSketch:
+    '''
+    Quantiles of a stream with bounded relative error.
+
+    Values are counted in logarithmic buckets of width *relative_accuracy*, so
+    every quantile is off by at most that fraction of its value (like
+    DDSketch). The number of buckets only grows with the logarithm of the range
+    of the values.
+    '''
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = 1e-9  # Smaller magnitudes count as zero
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def add(self, value):
+        self.count += 1
+        if value > self.min_value:
+            key = self._key(value)
+            self.positive[key] = self.positive.get(key, 0) + 1
+        elif value < -self.min_value:
+            key = self._key(-value)
+            self.negative[key] = self.negative.get(key, 0) + 1
+        else:
+            self.zeros += 1
+
+    def get_state(self):
+        return [sorted(self.positive.items()), sorted(self.negative.items()), self.zeros, self.count]
+
+    def set_state(self, state):
+        positive, negative, self.zeros, self.count = state
+        self.positive = dict(positive)
+        self.negative = dict(negative)
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (1 + self.gamma)
+
+    def quantile(self, q):
+        '''
+        Return the *q*-quantile (0 <= q <= 1) or None if no values were added.
+        '''
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+
+class Histogram:
+    '''
+    Histogram with at most *bins* bins of equal width, starting at the first value.
+
+    If a value falls outside of the bins, the width is doubled and neighbouring bins are merged until it fits.
+    '''
+
+    def __init__(self, bins=HISTOGRAM_BINS):
+        self.bins = bins
+        self.origin = None
+        self.width = None
+        self.counts = {}
+
+    def add(self, value):
+        if self.origin is None:
+            self.origin = value
+            self.width = 0.0
+            self.counts = {0: 1}
+            return
+        if self.width == 0.0:
+            if value == self.origin:
+                self.counts[0] += 1
+                return
+            # Second distinct value: start with a width that spans both values.
+            self.width = abs(value - self.origin) / (self.bins - 1)
+            self.origin = min(self.origin, value)
+            self.counts = {0 if value > self.origin else self.bins - 1: self.counts[0]}
+        index = math.floor((value - self.origin) / self.width)
+        while not 0 <= index < self.bins:
+            self._widen(index)
+            index = math.floor((value - self.origin) / self.width)
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+    def _widen(self, index):
+        if index < 0:
+            # Grow to the left: the new origin is the start of the merged bins.
+            self.origin -= self.width * self.bins
+            counts = {}
+            for i, n in self.counts.items():
+                j = (i + self.bins) // 2
+                counts[j] = counts.get(j, 0) + n
+        else:
+            counts = {}
+            for i, n in self.counts.items():
+                counts[i // 2] = counts.get(i // 2, 0) + n
+        self.counts = counts
+        self.width *= 2
+
+    def get_state(self):
+        return [self.origin, self.width, sorted(self.counts.items())]
+
+    def set_state(self, state):
+        self.origin, self.width, counts = state
+        self.counts = dict(counts)
+
+    def as_dict(self):
+        return {
+            'origin': self.origin,
+            'width': self.width,
+            'counts': [self.counts.get(i, 0) for i in range(max(self.counts, default=-1) + 1)],
+        }
+
+
+class Stats:
+    '''
+    Streaming statistics of one attribute of one entity type (fleet total per step).
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.histogram = Histogram()
+        self.sketch = QuantileSketch()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.histogram.add(value)
+        self.sketch.add(value)
+
+    def get_state(self):
+        # min and max are infinite until the first value, which JSON cannot store
+        return [self.count, self.total, self.min if self.count else None, self.max if self.count else None,
+                self.histogram.get_state(), self.sketch.get_state()]
+
+    def set_state(self, state):
+        self.count, self.total, min_, max_, histogram, sketch = state
+        if self.count:
+            self.min, self.max = min_, max_
+        self.histogram.set_state(histogram)
+        self.sketch.set_state(sketch)
+
+    def as_dict(self):
+        return {
+            'n': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'quantiles': {str(q): self.sketch.quantile(q) for q in QUANTILES},
+            'histogram': self.histogram.as_dict(),
+        }
+
+
+class KpiSink(mosaik_api.Simulator):
+    def __init__(self):
+        super().__init__(META)
+        self.eid = 'kpis'
+        self.plan = None
+        self.time_offset = None
+        self.filename = None
+        self.battery_capacity = 0
+        self.types = {}
+        self.stats = {}
+        self.energy = dict(pv_energy=0.0, consumption=0.0, grid_import=0.0, grid_export=0.0, battery_charged=0.0,
+                           battery_discharged=0.0)
+        self.grid_energy = {}  # Last meter reading per power node
+        self.first_time = None
+        self.last_time = None
+        self.checkpoints = None
+        self.restored = None
+
+    def init(self, sid, time_resolution=1., step_size=900, step_times=None, time_offset=0, checkpoint_dir=None,
+             checkpoint_every=0, restore=None):
+        self.plan = StepPlan(step_size, step_times)
+        self.time_offset = time_offset
+        try:
+            self.checkpoints, self.restored = open_checkpoints(sid, checkpoint_dir, checkpoint_every, restore)
+        except FileNotFoundError:
+            logger.warning('Checkpoint %s has no KPI state, the KPIs only cover the steps after it', restore)
+            self.checkpoints = (CheckpointWriter(checkpoint_dir, sid, checkpoint_every, time_offset)
+                                if checkpoint_dir else None)
+        return self.meta
+
+    def create(self, num, model, filename, battery_capacity=0):
+        if num != 1 or self.filename is not None:
+            raise ValueError('Can only create one aggregator.')
+        self.filename = filename
+        self.battery_capacity = battery_capacity
+        return [{'eid': self.eid, 'type': model, 'rel': []}]
+
+    def setup_done(self):
+        data = yield self.mosaik.get_related_entities()
+        self.types = {full_id: node['type'] for full_id, node in data['nodes'].items()}
+        if self.restored is not None:
+            for etype, attr, state in self.restored['stats']:
+                stats = self.stats[(etype, attr)] = Stats()
+                stats.set_state(state)
+            self.energy.update(self.restored['energy'])
+            self.grid_energy = self.restored['grid_energy']
+            # Scenario time of the first step, before the checkpoint
+            self.first_time = self.restored['start'] - self.time_offset
+            self.restored = None
+
+    def step(self, time, inputs, max_advance):
+        if self.checkpoints is not None and self.checkpoints.due(time):
+            self.checkpoints.save(time, {
+                'stats': [[etype, attr, stats.get_state()] for (etype, attr), stats in sorted(self.stats.items())],
+                'energy': dict(self.energy),
+                'grid_energy': dict(self.grid_energy),
+                'start': self.time_offset + (time if self.first_time is None else self.first_time),
+            })
+
+        totals = {}
+        for attr, values in inputs.get(self.eid, {}).items():
+            for src_id, value in values.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value):
+                    continue
+                key = (self.types.get(src_id, src_id.split('.', 1)[0]), attr)
+                totals[key] = totals.get(key, 0.0) + value
+                if key == GRID_ENERGY:
+                    self.grid_energy[src_id] = value
+        for key, total in totals.items():
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = Stats()
+            stats.add(total)
+
+        duration = self.plan.duration(time)
+        hours = duration / 3600
+        energy = self.energy
+        energy['pv_energy'] += max(-totals.get(PV_POWER, 0.0), 0.0) * hours
+        energy['consumption'] += totals.get(COMPUTE_POWER, 0.0) * hours
+        battery = totals.get(BATTERY_POWER, 0.0)
+        energy['battery_charged'] += max(battery, 0.0) * hours
+        energy['battery_discharged'] += max(-battery, 0.0) * hours
+        net = totals.get(NET_POWER, 0.0)
+        energy['grid_import'] += max(net, 0.0) * hours
+        energy['grid_export'] += max(-net, 0.0) * hours
+
+        if self.first_time is None:
+            self.first_time = time
+        self.last_time = time + duration
+        return time + duration
+
+    def kpis(self):
+        '''
+        Return the KPIs of the steps so far (dict).
+        '''
+        kpis = dict(self.energy)
+        kpis['grid_energy'] = sum(self.grid_energy.values())
+        pv, consumption = kpis['pv_energy'], kpis['consumption']
+        kpis['self_consumption'] = (pv - kpis['grid_export']) / pv if pv else None
+        kpis['self_sufficiency'] = 1 - kpis['grid_import'] / consumption if consumption else None
+        kpis['battery_cycles'] = ((kpis['battery_charged'] + kpis['battery_discharged']) / 2 / self.battery_capacity
+                                  if self.battery_capacity else None)
+        return kpis
+
+    def summary(self):
+        return {
+            'start': None if self.first_time is None else self.first_time + self.time_offset,
+            'end': None if self.last_time is None else self.last_time + self.time_offset,
+            'kpis': self.kpis(),
+            'stats': {'{}.{}'.format(*key): stats.as_dict() for key, stats in sorted(self.stats.items())},
+        }
+
+    def finalize(self):
+        if self.filename is not None:
+            with open(self.filename, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+            logger.info('KPIs written to %s', self.filename)
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+
+
+def main():
+    return mosaik_api.start_simulation(KpiSink(), 'Streaming KPI aggregator')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,130 +1,305 @@
+import contextlib
+import json
 import logging
+import os
 
 import mosaik
-from mosaik.util import connect_many_to_one
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from checkpoint import checkpoint_time, resolve_checkpoint, write_scenario
+from rpc_batch import enable_batching
+from scenario_spec import load_scenario, load_spec, simulator_names
+from scenario_util import connect_many_to_one
+from sim_startup import prestart
+from step_plan import pv_error_rate
+from wire import is_numeric, negotiate_codecs
 
 
 logging.basicConfig()
 logger = logging.getLogger('demo')
 logger.setLevel(logging.INFO)
 
+# Simulators that are available in-process ('python') and as remote process ('connect') are started according to
+# SIM_MODE, see get_sim_config(). All other simulators are started the only way they are configured.
+SIM_MODE = os.environ.get('SIM_MODE', 'python')  # 'python' or 'connect'
+# Set SIM_ADDRS to a JSON object {simulator name: 'host:port'} to connect to simulators at other addresses than in
+# sim_config, e.g. to the simulator containers of the distributed setup (see ../distributed).
+SIM_ADDRS = json.loads(os.environ['SIM_ADDRS']) if os.environ.get('SIM_ADDRS') else {}
+# Set to a path prefix to write a per-simulator step latency report (<prefix>.json, .csv and .folded)
+PROFILE = os.environ.get('PROFILE')
+# Set HEADLESS=1 to run without the web visualization, e.g. for batch runs
+HEADLESS = os.environ.get('HEADLESS', '').lower() in ('1', 'true', 'yes')
+# Set to 'udp://<host>:<port>' or 'file://<path>' to stream aggregated values of TELEMETRY_ATTRS, see telemetry_sink.py
+TELEMETRY = os.environ.get('TELEMETRY')
+# Set CHECKPOINT_DIR to save the simulator states every CHECKPOINT_EVERY seconds of simulated time. Set RESTORE to a
+# checkpoint (<dir>/<time>) or a checkpoint directory (latest checkpoint) to continue from there: into the same
+# CHECKPOINT_DIR to resume a run, into another one (or none) to fork a what-if branch, see checkpoint.py.
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR')
+RESTORE = os.environ.get('RESTORE')
+# Set KPI_FILE to a path to write the KPIs of the run (self-consumption, grid energy, battery cycles, ...) and
+# streaming statistics of KPI_ATTRS there at the end of the run, see kpi_sink.py. The KPI state is part of the
+# checkpoints, so the KPIs of a restored run cover the whole run; restored from a checkpoint without KPI state, they
+# only cover the steps after it ('start' in KPI_FILE).
+KPI_FILE = os.environ.get('KPI_FILE')
+# Set RESOURCE_INTERVAL to a number of seconds to sample the CPU and memory usage of the containers at that interval
+# into <result file>.resources.csv, tagged with simulated time, see resource_monitor.py. RESOURCE_CGROUPS is a JSON
+# object {container name: cgroup directory}, default: the container the scenario runs in.
+RESOURCE_INTERVAL = float(os.environ['RESOURCE_INTERVAL']) if os.environ.get('RESOURCE_INTERVAL') else None
+RESOURCE_CGROUPS = json.loads(os.environ['RESOURCE_CGROUPS']) if os.environ.get('RESOURCE_CGROUPS') else None
+# Set ADAPTIVE_TOLERANCE to a PV power [W] to merge steps as long as the PV input changes by at most that much, see
+# step_plan.py. ADAPTIVE_MAX_ERROR bounds the deviation of the grid energy from fixed stepping that is driven by the PV
+# input [Wh]: merging is limited until the summed worst-case error of the merged steps is within it. The battery's lag
+# behind the compute nodes' draws within merged steps is not included, ADAPTIVE_MAX_STEP limits it. The planned number
+# of steps, the error bound and the largest PV deviation are logged.
+ADAPTIVE_TOLERANCE = float(os.environ['ADAPTIVE_TOLERANCE']) if os.environ.get('ADAPTIVE_TOLERANCE') else None
+ADAPTIVE_MAX_ERROR = float(os.environ['ADAPTIVE_MAX_ERROR']) if os.environ.get('ADAPTIVE_MAX_ERROR') else None
+# Remote simulators are connected to in parallel while the scenario is built, retrying until they are ready, and
+# 'cmd' simulators (WebVis) are spawned before, see sim_startup.py. Set PRESTART=0 to start them one by one in
+# world.start() instead.
+PRESTART = os.environ.get('PRESTART', '1').lower() not in ('0', 'false', 'no')
+
 sim_config = {
     'CSV': {
-        'python': 'mosaik_csv:CSV',
+        # 'python': 'mosaik_csv:CSV',
+        'python': 'pv_sim:PVSim',
     },
     'DB': {
         # 'cmd': 'mosaik-hdf5 %(addr)s',
-        'python': 'mosaik_hdf5:MosaikHdf5',
+        # 'python': 'mosaik_hdf5:MosaikHdf5',
+        'python': 'result_sink:ResultSink',
     },
     'PyPower': {
         # 'python': 'mosaik_pypower.mosaik:PyPower',
         # 'cmd': 'mosaik-pypower %(addr)s',
+        'python': 'grid_sim:PyPower',
         'connect': '127.0.0.1:5677',
     },
     'WebVis': {
         #'python': 'mosaik_web.mosaik:MosaikWeb',
         'cmd': 'mosaik-web -s 0.0.0.0:8000 %(addr)s',
     },
+    'Telemetry': {
+        'python': 'telemetry_sink:TelemetrySink',
+    },
+    'KPI': {
+        'python': 'kpi_sink:KpiSink',
+    },
+    'Resources': {
+        'python': 'resource_monitor:ResourceMonitor',
+    },
     'BatterySimulator': {
         # 'connect': '0.0.0.0:8080',
+        'python': 'battery_sim:BatterySimulator',
         'connect': '127.0.0.1:5678',
     },
     'ComputeNodeSimulator': {
         # 'connect': '0.0.0.0:8080',
+        'python': 'compute_sim:ComputeNodeSimulator',
         'connect': '127.0.0.1:5676',
     },
 }
 
+# Simulators, entities, connections and recorded groups, see scenario_spec.py. Variants of the scenario are scenario
+# files, with the constants of this module as variables. The optional features below use the groups 'power_nodes',
+# 'buses', 'ref_buses', 'compute', 'pv', 'battery' and 'sites' if the scenario has them.
+SCENARIO = os.environ.get('SCENARIO', 'scenarios/demo.json')
 START = '2014-01-01 00:00:00'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 END = 31 * 24 * 3600  # 1 month
-PV_DATA = 'data/pv_10kw.csv'
+PV_DATA = 'data/pv_10kw_1week.csv'
+# PV input beyond the end of PV_DATA: 'data' (none, the simulation has to end with the data), 'tile' (repeat the data),
+# 'season' (repeat the data scaled to the season) or 'synthetic' (seeded stochastic profile, PV_DATA is not used), see
+# pv_sim.py. Values are computed per step, in constant memory for any horizon.
+PV_PROFILE = 'season'
+PV_SEED = 0  # Of the synthetic profile
 GRID_NAME = 'demo_lv_grid'
 GRID_FILE = '%s.json' % GRID_NAME
 STEP_SIZE = 60 * 15
 BATTERY_CAPACITY=7500
+POWER_FLOW = 'cached'  # 'cached' (warm-started, see power_flow.py) or 'pypower' (runpf() in every step)
+MIN_CONSUMPTION = 40  # Consumption range of the compute nodes [W]
+MAX_CONSUMPTION = 200
+COMPUTE_SEED = 0  # Of the base power draws of the compute nodes, so that runs of the same settings are reproducible
+CHECKPOINT_EVERY = 24 * 3600  # 1 day
+ADAPTIVE_MAX_STEP = 2 * 3600  # Longest merged step in adaptive mode, bounds the error of the battery's one-step lag
+ADAPTIVE_SETTLE_STEPS = 2  # Steps at STEP_SIZE after every change before steps are merged
+# Fleet size. Compute nodes are spread over the power nodes (PQ buses) of the grid, PV units and batteries over the
+# compute nodes. Every unit is metered at the power node of its compute node.
+N_COMPUTE_NODES = 1
+N_PV = 1
+N_BATTERIES = 1
+# Results: 'hdf5' or 'parquet'. RESULT_RECORD lists the recorded attributes per entity type and optionally records only
+# every n-th step ('every'). Entity types that are not listed are not recorded.
+RESULT_FORMAT = 'hdf5'
+RESULT_FILE = os.environ.get('RESULT_FILE')  # Default: db_<date>.<format>
+RESULT_RECORD = {
+    'PV': {'attrs': ['P']},
+    'ComputeNode': {'attrs': ['container_need', 'cpu_level']},
+    'Battery': {'attrs': ['current_load']},
+    'PowerNode': {'attrs': ['P', 'Q', 'Vl', 'Vm', 'Va', 'net_metering_power', 'grid_energy']},
+    'PQBus': {'attrs': ['P', 'Q', 'Vl', 'Vm', 'Va']},
+    'RefBus': {'attrs': ['P', 'Q', 'Vl', 'Vm', 'Va']},
+    'Transformer': {'attrs': ['P_from', 'Q_from', 'P_to', 'Q_to']},
+    'Branch': {'attrs': ['P_from', 'Q_from', 'P_to', 'Q_to']},
+}
+# Telemetry: streamed attributes per entity type. 'sample' sends a snapshot every TELEMETRY_EVERY steps, 'aggregate'
+# sends the statistics of all steps in between. At most one message per TELEMETRY_MIN_INTERVAL wall-clock seconds.
+TELEMETRY_ATTRS = {
+    'PV': ['P'],
+    'ComputeNode': ['container_need'],
+    'Battery': ['current_load'],
+    'PowerNode': ['P', 'Vm', 'grid_energy'],
+    'RefBus': ['P'],
+}
+# KPIs: inputs of the KPI aggregator per entity type
+KPI_ATTRS = {
+    'PV': ['P'],
+    'ComputeNode': ['container_need'],
+    'Battery': ['current_load'],
+    'PowerNode': ['net_metering_power', 'grid_energy'],
+}
+TELEMETRY_MODE = 'sample'
+TELEMETRY_EVERY = 4
+TELEMETRY_MIN_INTERVAL = 0.0
 
 
-def main():
+def main(mosaik_config=None):
     logger.info("Starting demo ...")
-    world = mosaik.World(sim_config)
-    create_scenario(world)
+    config, startup = prestart_sims(get_sim_config(SIM_MODE))
+    with startup:
+        world = mosaik.World(config, mosaik_config)
+        restore = str(resolve_checkpoint(RESTORE)) if RESTORE else None
+        create_scenario(world, restore)
+    # mosaik time 0 is the time of the checkpoint for restored runs
+    until = END - (checkpoint_time(restore) if restore else 0)
     logger.info("Running world ...")
-    world.run(until=END)  # As fast as possilbe
+    if PROFILE:
+        from instrumentation import StepProfiler
+
+        profiler = StepProfiler(world)
+        profiler.install()
+        profiler.run(until=until)
+        profiler.write(PROFILE)
+        return
+    world.run(until=until)  # As fast as possilbe
     # world.run(until=END, rt_factor=1 / 6000)  # Real_time_factor -- 1/60 means 1 simulation minute = 1 wall-clock second
 
 
-def create_scenario(world):
-    # Start simulatorscount=5
-    logger.info("Creating scenario ...")
-    pvsim = world.start('CSV', sim_start=START, datafile=PV_DATA) # step size is 60, comes from the pv data sample file (pv_10kw.csv)
-    pypower = world.start('PyPower', step_size=STEP_SIZE, battery_capacity=BATTERY_CAPACITY)
-    battery_simulator = world.start('BatterySimulator', step_size=STEP_SIZE)
-    compute_simulator = world.start('ComputeNodeSimulator', step_size=STEP_SIZE, min_consumption=40, max_consumption=200)
-    webvis = world.start('WebVis', start_date=START, step_size=STEP_SIZE)
+def get_sim_config(mode=SIM_MODE):
+    '''
+    Return the sim config with every simulator that offers *mode* ('python' or 'connect') restricted to that mode.
+    '''
+    config = {}
+    for name, entry in sim_config.items():
+        if name in SIM_ADDRS:
+            entry = dict(entry, connect=SIM_ADDRS[name])
+        config[name] = {mode: entry[mode]} if mode in entry else entry
+    return config
 
-    # ######## Instantiate models
-    logger.info("Instantiating models ...")
 
-    # pyPower
-    grid = pypower.Grid(gridfile=GRID_FILE).children
-    # buses = get_buses(grid)
-    grid_node = list(get_power_nodes(grid).values())[0]
+def prestart_sims(config):
+    '''
+    Pre-start the remote simulators of SCENARIO and WebVis (unless HEADLESS) if PRESTART, see sim_startup.py.
 
-    # pv
-    pv_nodes = pvsim.PV.create(1)
+    :return: tuple of (sim config for the world, context manager that closes the simulators the scenario did not use)
+    '''
+    if not PRESTART:
+        return config, contextlib.nullcontext()
+    names = simulator_names(load_spec(SCENARIO)) + ([] if HEADLESS else ['WebVis'])
+    return prestart(config, names)
 
-    # compute
-    compute_nodes = compute_simulator.ComputeNode.create(1)
 
-    # battery
-    battery_nodes = battery_simulator.Battery.create(1, max_capacity=BATTERY_CAPACITY)
+def create_scenario(world, restore=None):
+    # Start simulatorscount=5
+    logger.info("Creating scenario %s ...", SCENARIO)
+    time_offset = checkpoint_time(restore) if restore else 0
+    start = (datetime.strptime(START, DATE_FORMAT) + timedelta(seconds=time_offset)).strftime(DATE_FORMAT)
+    if restore:
+        logger.info("Restoring checkpoint %s (%s) ...", restore, start)
+    # Stateful simulators save their state to CHECKPOINT_DIR and restore it from *restore*
+    checkpoints = dict(checkpoint_dir=CHECKPOINT_DIR, checkpoint_every=CHECKPOINT_EVERY, restore=restore)
+    # The constants of this module are the variables of the scenario file, see scenario_spec.py
+    variables = {name: value for name, value in globals().items() if name.isupper()}
+    variables.update(SIM_START=start, STEP_TIMES=None)
+    scenario = load_scenario(world, SCENARIO, variables, checkpoints)
+    # PV data is converted once into a memory-mapped cache (data/.cache) and served pre-aggregated at STEP_SIZE
+    pvsim = scenario.start('pv')
+    if ADAPTIVE_TOLERANCE is not None:
+        variables['STEP_TIMES'] = plan_steps(pvsim, END - time_offset, time_offset, scenario.count('pv'))
+    step_times = variables['STEP_TIMES']
+    scenario.start_all()
+    # Remote simulators that support a binary encoding get their messages in it, see wire.py
+    codecs = negotiate_codecs(world)
+    if codecs:
+        logger.info("Message encoding: %s", ', '.join('%s: %s' % item for item in sorted(codecs.items())))
+    # ... and are stepped with one request per step (step, outputs and set_data() calls), see rpc_batch.py
+    batched = enable_batching(world)
+    if batched:
+        logger.info("Batched steps: %s", ', '.join(sorted(batched)))
+    # ######## Instantiate models
+    logger.info("Instantiating models ...")
+    groups = scenario.create_entities()
+    variables['BATTERY_COMMAND'], variables['BATTERY_COMMAND_INITIAL'] = battery_command(
+        world, groups.get('battery', []), groups.get('power_nodes', []))
 
-    # ######## Connect entities
     logger.info("Connecting entities ...")
-
-    # compute node to grid node
-    connect_compute_node_to_grid(world, compute_nodes[0], grid_node)
-
-    # PV connections
-    connect_pv_to_compute_node(world, pv_nodes[0], compute_nodes[0])
-    connect_pv_to_grid(world, pv_nodes[0], grid_node)
-
-    # Battery connections
-    connect_battery_to_compute_node(world, battery_nodes[0], compute_nodes[0])
-    connect_battery_to_grid(world, battery_nodes[0], grid_node)
+    groups = scenario.connect()
+    power_nodes = groups.get('power_nodes', [])
+    grid_power_nodes = groups.get('buses', [])
+    grid_transformers = groups.get('ref_buses', [])
+    compute_nodes = groups.get('compute', [])
+    pv_nodes = groups.get('pv', [])
+    battery_nodes = groups.get('battery', [])
+    site_nodes = groups.get('sites', [])
 
     # ######## Database
     logger.info("Creating database ...")
-    db = world.start('DB', step_size=STEP_SIZE, duration=END)
-    dt_string = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
-    hdf5 = db.Database(filename='db_' + dt_string + '.hdf5')
-
-    connect_many_to_one(world, pv_nodes, hdf5, 'P', 'Date')
-
-    connect_many_to_one(world, compute_nodes, hdf5, 'container_need', 'cpu_level')
+    db = world.start('DB', step_size=STEP_SIZE, duration=END, time_offset=time_offset, step_times=step_times)
+    filename = RESULT_FILE
+    if filename is None:
+        dt_string = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+        extension = 'hdf5' if RESULT_FORMAT == 'hdf5' else 'parquet'
+        filename = 'db_' + dt_string + '.' + extension
+    hdf5 = db.Database(filename=filename, format=RESULT_FORMAT, record=RESULT_RECORD)
+    scenario.connect_results(hdf5)
+
+    # ######## Container resources
+    if RESOURCE_INTERVAL:
+        create_resource_monitor(world, os.path.splitext(filename)[0] + '.resources.csv', time_offset, step_times,
+                                grid_transformers)
+
+    # ######## KPIs
+    stateful = scenario.stateful()
+    if KPI_FILE:
+        stateful.append(create_kpis(world, KPI_FILE, time_offset, step_times, checkpoints, pv_nodes, compute_nodes,
+                                    battery_nodes, site_nodes))
+    if CHECKPOINT_DIR:
+        write_scenario(CHECKPOINT_DIR, stateful, start=START, end=END, step_size=STEP_SIZE, every=CHECKPOINT_EVERY,
+                       restored_from=restore)
+
+    # ######## Telemetry
+    if TELEMETRY:
+        create_telemetry(world, TELEMETRY, time_offset, step_times, power_nodes, grid_transformers, compute_nodes,
+                         pv_nodes, battery_nodes)
 
-    connect_many_to_one(world, battery_nodes, hdf5, 'current_load')
-
-    world.connect(grid_node, hdf5, 'P', 'Q', 'Vl', 'Vm', 'Va', 'net_metering_power', 'grid_energy')
-    grid_power_nodes = [e for e in grid if e.type == 'PQBus' and e.eid != grid_node.eid]
-    connect_many_to_one(world, grid_power_nodes, hdf5, 'P', 'Q', 'Vl', 'Vm', 'Va')
-
-    grid_transformers = [e for e in grid if e.type == 'RefBus']
-    connect_many_to_one(world, grid_transformers, hdf5, 'P', 'Q', 'Vl', 'Vm', 'Va')
+    # ######## Web visualization
+    # Started last, so that a pre-spawned WebVis has the most time to start up
+    if not HEADLESS:
+        create_webvis(world, start, power_nodes, grid_power_nodes, grid_transformers, compute_nodes, pv_nodes,
+                      battery_nodes)
 
-    grid_branches = [e for e in grid if e.type in ('Transformer', 'Branch')]
-    connect_many_to_one(world, grid_branches, hdf5,'P_from', 'Q_from', 'P_to', 'P_from')
 
-    # ######## Web visualization
+def create_webvis(world, start, power_nodes, grid_power_nodes, grid_transformers, compute_nodes, pv_nodes,
+                  battery_nodes):
     logger.info("Creating web visualization ...")
+    webvis = world.start('WebVis', start_date=start, step_size=STEP_SIZE)
 
     webvis.set_config(ignore_types=['Topology', 'ResidentialLoads', 'Grid', 'Database'])
     vis_topo = webvis.Topology()
 
     logger.info("Connecting entities to web visualization ...")
 
-    world.connect(grid_node, vis_topo, 'P', 'Vm')
+    connect_many_to_one(world, power_nodes, vis_topo, 'P', 'Vm')
     webvis.set_etypes({
         'PowerNode': {
             'cls': 'powerNode',
@@ -197,49 +372,95 @@ def create_scenario(world):
     })
 
 
-def connect_buildings_to_grid(world, houses, buses):
+def create_telemetry(world, target, time_offset, step_times, *entity_groups):
+    '''
+    Stream the attributes listed in TELEMETRY_ATTRS for the types of the entities in *entity_groups* to *target*.
+    '''
+    logger.info("Creating telemetry sink (%s) ...", target)
+    telemetry = world.start('Telemetry', step_size=STEP_SIZE, step_times=step_times, every=TELEMETRY_EVERY,
+                            mode=TELEMETRY_MODE, min_interval=TELEMETRY_MIN_INTERVAL, time_offset=time_offset)
+    monitor = telemetry.Monitor(target=target)
+    for entities in entity_groups:
+        by_type = {}
+        for entity in entities:
+            by_type.setdefault(entity.type, []).append(entity)
+        for etype, group in by_type.items():
+            if etype in TELEMETRY_ATTRS:
+                connect_many_to_one(world, group, monitor, *TELEMETRY_ATTRS[etype])
+
+
+def create_kpis(world, filename, time_offset, step_times, checkpoints, *entity_groups):
+    '''
+    Aggregate the attributes listed in KPI_ATTRS for the types of the entities in *entity_groups* into KPIs that are
+    written to *filename* at the end of the run. The aggregator saves its state with the checkpoint params
+    *checkpoints*.
+
+    :return: simulator ID of the aggregator (string)
+    '''
+    logger.info("Creating KPI aggregator (%s) ...", filename)
+    kpi = world.start('KPI', step_size=STEP_SIZE, step_times=step_times, time_offset=time_offset, **checkpoints)
+    n_batteries = sum(1 for entities in entity_groups for entity in entities if entity.type == 'Battery')
+    aggregator = kpi.Aggregator(filename=filename, battery_capacity=BATTERY_CAPACITY * n_batteries)
+    for entities in entity_groups:
+        by_type = {}
+        for entity in entities:
+            by_type.setdefault(entity.type, []).append(entity)
+        for etype, group in by_type.items():
+            if etype in KPI_ATTRS:
+                connect_many_to_one(world, group, aggregator, *KPI_ATTRS[etype])
+    return aggregator.sid
+
+
+def create_resource_monitor(world, filename, time_offset, step_times, clock_entities):
+    '''
+    Sample the resource usage of the containers in RESOURCE_CGROUPS into *filename*. The monitor is connected to
+    *clock_entities*, so that it steps with them.
+    '''
+    logger.info("Creating resource monitor (%s) ...", filename)
+    resources = world.start('Resources', step_size=STEP_SIZE, step_times=step_times, time_offset=time_offset,
+                            interval=RESOURCE_INTERVAL)
+    monitor = resources.Monitor(filename=filename, cgroups=RESOURCE_CGROUPS)
+    connect_many_to_one(world, clock_entities, monitor, 'P')
+
+
+def plan_steps(pvsim, until, time_offset, pv_units):
+    '''
+    Let the PV simulator plan adaptive step times (see step_plan.py) and log how many steps are saved and the bound of
+    the grid energy error driven by the PV input. Checkpoint times are always kept as step times.
+
+    :return: step times (list of ints)
+    '''
+    breaks = []
+    if CHECKPOINT_DIR:
+        breaks = [t for t in range(0, until, STEP_SIZE) if (time_offset + t) % CHECKPOINT_EVERY == 0]
+    plan = pvsim.step_plan(until, ADAPTIVE_TOLERANCE, ADAPTIVE_MAX_STEP, breaks, ADAPTIVE_SETTLE_STEPS,
+                           {'P': pv_error_rate(pv_units)}, ADAPTIVE_MAX_ERROR)
+    logger.info("Adaptive stepping: %d steps instead of %d (%.1f%%), PV-driven grid energy error at most %.0f Wh "
+                "(%.0f Wh per step, limit %s), largest PV deviation %s (tolerance %g W)",
+                plan['steps'], plan['base_steps'], 100 * plan['steps'] / max(plan['base_steps'], 1), plan['error'],
+                plan['step_error'], 'none' if ADAPTIVE_MAX_ERROR is None else '%g Wh' % ADAPTIVE_MAX_ERROR,
+                ', '.join('%s: %g' % item for item in plan['deviation'].items()), ADAPTIVE_TOLERANCE)
+    return plan['step_times']
+
+
+def connect_buildings_to_grid(world, houses, grid):
     house_data = world.get_data(houses, 'node_id')
     for house in houses:
         node_id = house_data[house]['node_id']
-        world.connect(house, buses[node_id], ('P_out', 'P'))
-
-
-def connect_compute_node_to_grid(world, compute_node, grid_node):
-    logger.info("***** inside connect_compute_node_to_grid")
-    world.connect(compute_node, grid_node, 'container_need')
-
-
-def connect_battery_to_compute_node(world, battery, compute_node):
-    logger.info("***** inside connect_battery_to_compute_node")
-    world.connect(battery, compute_node, ('current_load', 'battery_power'))
-
-
-def connect_battery_to_grid(world, battery, grid_node):
-    logger.info("***** inside connect_battery_to_grid")
-    world.connect(battery, grid_node, ('current_load', 'P'))
-    world.connect(grid_node, battery, 'battery_action', time_shifted=True, initial_data={'battery_action': 'charge:0'})
-
-
-def connect_pv_to_compute_node(world, pv, compute_node):
-    logger.info("***** inside connect_pv_to_compute_node")
-    world.connect(pv, compute_node, ('P', 'pv_power'))
-
-
-def connect_pv_to_grid(world, pv, grid_node):
-    logger.info("***** inside connect_pv_to_grid")
-    world.connect(pv, grid_node, 'P')
-
-
-def get_buses(grid):
-    buses = filter(lambda e: e.type == 'PQBus', grid)
-    buses = {b.eid.split('-')[1]: b for b in buses}
-    return buses
-
-
-def get_power_nodes(grid):
-    nodes = filter(lambda e: e.type == 'PowerNode', grid)
-    nodes = {b.eid.split('-')[1]: b for b in nodes}
-    return nodes
+        world.connect(house, grid.node('PQBus', node_id), ('P_out', 'P'))
+
+
+def battery_command(world, battery_nodes, power_nodes):
+    '''
+    Return the attribute the power nodes send their battery commands with and its initial value: the numeric
+    'battery_setpoint' if both simulators declare it, otherwise the 'battery_action' string.
+    '''
+    battery_sims = {world.sims[battery.sid] for battery in battery_nodes}
+    grid_sims = {world.sims[power_node.sid] for power_node in power_nodes}
+    if all(is_numeric(sim.meta, 'Battery', 'battery_setpoint') for sim in battery_sims) and \
+            all(is_numeric(sim.meta, 'PowerNode', 'battery_setpoint') for sim in grid_sims):
+        return 'battery_setpoint', 0.0
+    return 'battery_action', 'charge:0'
 
 
 if __name__ == '__main__':
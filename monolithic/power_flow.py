@@ -0,0 +1,187 @@
+'''
+Warm-started Newton-Raphson power flow for the PYPOWER cases of ``mosaik_pypower``.
+
+``mosaik_pypower`` calls ``runpf()`` in every step, which converts the case,
+builds the admittance matrix and runs Newton-Raphson from the voltages stored
+in the case again. The topology of the grid does not change during a run, so
+:class:`PowerFlow` keeps everything that only depends on it:
+
+* the bus and branch admittance matrices (``Ybus``, ``Yf``, ``Yt``), rebuilt
+  only if a tap or the status of a branch changes,
+* the sparse LU factorisation of the Jacobian. Iterations reuse it as long as
+  the mismatch drops fast enough (chord method) and only refactorise the
+  Jacobian at the current voltages otherwise,
+* the voltages of the last solution as starting point of the next step.
+
+The results are written into the case like ``runpf()`` does, so the outputs of
+``mosaik_pypower`` can be used unchanged.
+'''
+import logging
+
+import numpy as np
+from pypower.dSbus_dV import dSbus_dV
+from pypower.idx_brch import BR_STATUS, F_BUS, PF, PT, QF, QT, SHIFT, T_BUS, TAP
+from pypower.idx_bus import BUS_TYPE, GS, BS, PD, PQ as PQ_BUS, PV as PV_BUS, QD, REF as REF_BUS, VA, VM
+from pypower.idx_gen import GEN_BUS, GEN_STATUS, PG, QG, VG
+from pypower.makeYbus import makeYbus
+from scipy.sparse import bmat
+from scipy.sparse.linalg import splu
+
+
+logger = logging.getLogger('power_flow')
+
+TOLERANCE = 1e-8  # Largest power mismatch of a solution [p.u.] (PYPOWER's PF_TOL)
+MAX_ITERATIONS = 10  # Newton-Raphson iterations per solve (PYPOWER's PF_MAX_IT)
+MIN_CONTRACTION = 0.25  # Refactorise the Jacobian if an iteration reduces the mismatch by less than this factor
+BRANCH_RESULT_COLUMNS = QT + 1
+
+
+class PowerFlow:
+    '''
+    Power flow solver for one PYPOWER case with a fixed set of buses and branches.
+
+    :param case: PYPOWER case as created by ``mosaik_pypower.model.load_case()`` (dict)
+    '''
+
+    def __init__(self, case):
+        self.base_mva = case['baseMVA']
+        bus = case['bus']
+        self.ref = np.flatnonzero(bus[:, BUS_TYPE] == REF_BUS)
+        self.pv = np.flatnonzero(bus[:, BUS_TYPE] == PV_BUS)
+        self.pq = np.flatnonzero(bus[:, BUS_TYPE] == PQ_BUS)
+        self.pvpq = np.concatenate((self.pv, self.pq))
+        self.gens = np.flatnonzero(case['gen'][:, GEN_STATUS] > 0)
+        self.gen_bus = case['gen'][self.gens, GEN_BUS].astype(int)
+        self.f_bus = case['branch'][:, F_BUS].astype(int)
+        self.t_bus = case['branch'][:, T_BUS].astype(int)
+        self.V_flat = self._initial_voltage(case)  # Start of the first solve and after failures
+
+        self.topology = None  # Branch taps and status the admittance matrices were built for
+        self.Ybus = self.Yf = self.Yt = None
+        self.lu = None  # Factorised Jacobian
+        self.V = None  # Voltages of the last solution (warm start)
+        self.factorisations = 0
+        self.iterations = 0
+
+    def _update_admittance(self, case):
+        topology = case['branch'][:, [TAP, SHIFT, BR_STATUS]].tobytes() + case['bus'][:, [GS, BS]].tobytes()
+        if topology == self.topology:
+            return
+        self.Ybus, self.Yf, self.Yt = (m.tocsr() for m in makeYbus(self.base_mva, case['bus'], case['branch']))
+        self.topology = topology
+        self.lu = None
+        self.V = None
+        logger.debug('Built admittance matrix (%d buses, %d branches)', len(case['bus']), len(case['branch']))
+
+    def _initial_voltage(self, case):
+        bus = case['bus']
+        V0 = bus[:, VM] * np.exp(1j * np.deg2rad(bus[:, VA]))
+        gen = case['gen'][self.gens]
+        V0[self.gen_bus] = gen[:, VG] / np.abs(V0[self.gen_bus]) * V0[self.gen_bus]
+        return V0
+
+    def _power_injection(self, case):
+        '''
+        Return the complex power injected at every bus [p.u.] (array).
+        '''
+        bus = case['bus']
+        gen = case['gen'][self.gens]
+        Sbus = -(bus[:, PD] + 1j * bus[:, QD])
+        np.add.at(Sbus, self.gen_bus, gen[:, PG] + 1j * gen[:, QG])
+        return Sbus / self.base_mva
+
+    def _factorise(self, V):
+        dS_dVm, dS_dVa = dSbus_dV(self.Ybus, V)
+        pvpq, pq = self.pvpq, self.pq
+        J = bmat([
+            [dS_dVa[pvpq][:, pvpq].real, dS_dVm[pvpq][:, pq].real],
+            [dS_dVa[pq][:, pvpq].imag, dS_dVm[pq][:, pq].imag],
+        ], format='csc')
+        self.lu = splu(J)
+        self.factorisations += 1
+
+    def _mismatch(self, V, Sbus):
+        mis = V * np.conj(self.Ybus @ V) - Sbus
+        return np.concatenate((mis[self.pvpq].real, mis[self.pq].imag))
+
+    def _update_voltage(self, V, dx):
+        n = len(self.pvpq)
+        Va = np.angle(V)
+        Vm = np.abs(V)
+        Va[self.pvpq] -= dx[:n]
+        Vm[self.pq] -= dx[n:]
+        return Vm * np.exp(1j * Va)
+
+    def newton(self, Sbus, V):
+        '''
+        Solve the power flow for the injections *Sbus* starting at the voltages *V*, reusing the factorised Jacobian.
+
+        :return: tuple of (voltages (array), True if converged)
+        '''
+        F = self._mismatch(V, Sbus)
+        norm = np.max(np.abs(F), initial=0.0)
+        fresh = False  # True if the Jacobian was factorised at V
+        for _ in range(MAX_ITERATIONS):
+            if norm < TOLERANCE:
+                return V, True
+            if self.lu is None:
+                self._factorise(V)
+                fresh = True
+            V_new = self._update_voltage(V, self.lu.solve(F))
+            F_new = self._mismatch(V_new, Sbus)
+            norm_new = np.max(np.abs(F_new), initial=0.0)
+            self.iterations += 1
+            if not fresh and norm_new > MIN_CONTRACTION * norm:
+                # The cached Jacobian is too far off: repeat the iteration with the one at V (Newton-Raphson).
+                self.lu = None
+                continue
+            V, F, norm = V_new, F_new, norm_new
+            fresh = False
+        return V, norm < TOLERANCE
+
+    def solve(self, case):
+        '''
+        Solve the power flow of *case* and store the results in it like ``runpf()``.
+
+        :return: *case* with the results and 'success' (dict)
+        '''
+        self._update_admittance(case)
+        Sbus = self._power_injection(case)
+        V0 = self.V if self.V is not None else self.V_flat
+        V, success = self.newton(Sbus, V0)
+        if not success and self.V is not None:
+            self.lu = None
+            V, success = self.newton(Sbus, self.V_flat)
+
+        self.V = V if success else None
+        self._store_results(case, V, success)
+        return case
+
+    def _store_results(self, case, V, success):
+        bus = case['bus']
+        branch = case['branch']
+        if branch.shape[1] < BRANCH_RESULT_COLUMNS:
+            branch = case['branch'] = np.hstack(
+                (branch, np.zeros((branch.shape[0], BRANCH_RESULT_COLUMNS - branch.shape[1]))))
+        case['success'] = success
+        if not success:
+            return
+
+        bus[:, VM] = np.abs(V)
+        bus[:, VA] = np.rad2deg(np.angle(V))
+
+        # Generators at the reference buses take the balance.
+        gen = case['gen']
+        Sbus = V * np.conj(self.Ybus @ V) * self.base_mva
+        for i, b in zip(self.gens, self.gen_bus):
+            if b in self.ref:
+                gen[i, PG] = Sbus[b].real + bus[b, PD]
+                gen[i, QG] = Sbus[b].imag + bus[b, QD]
+
+        online = branch[:, BR_STATUS] > 0
+        Sf = V[self.f_bus] * np.conj(self.Yf @ V) * self.base_mva
+        St = V[self.t_bus] * np.conj(self.Yt @ V) * self.base_mva
+        branch[:, PF] = np.where(online, Sf.real, 0.0)
+        branch[:, QF] = np.where(online, Sf.imag, 0.0)
+        branch[:, PT] = np.where(online, St.real, 0.0)
+        branch[:, QT] = np.where(online, St.imag, 0.0)
@@ -0,0 +1,615 @@
+'''
+Columnar PV data source for mosaik.
+
+Drop-in replacement for ``mosaik_csv:CSV`` for the PV profiles in ``data/``.
+The CSV file is parsed only once and converted into a cache of binary column
+files (one ``.npy`` per attribute plus its cumulative sum) next to the data
+file. Later runs memory-map the cache, so a step costs O(1) independent of the
+resolution of the data file or the step size of the scenario.
+
+Horizons longer than the data file are served by profiles that compute the
+values of every step lazily, in constant memory (see :func:`open_profile`):
+
+* ``'data'``: the data file as it is, the simulation ends with the data,
+* ``'tile'``: the data file repeated indefinitely,
+* ``'season'``: the data file repeated indefinitely and every day scaled by
+  the ratio of the daily clear-sky irradiance of the simulated day and of the
+  day of the data it is taken from (at ``latitude``), e.g. one week of
+  January data becomes a year with summer yields,
+* ``'synthetic'``: a seeded stochastic profile of a south-facing PV plant at
+  ``latitude`` with ``peak_power``, generated one day at a time.
+'''
+import contextlib
+import functools
+import json
+import logging
+import math
+import os
+import pathlib
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import mosaik_api
+
+from checkpoint import open_checkpoints
+from step_plan import StepPlan, plan_steps
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger('pv_sim')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+CACHE_DIR_NAME = '.cache'
+CACHE_VERSION = 1
+AGGREGATIONS = ('mean', 'sample')
+PROFILES = ('data', 'tile', 'season', 'synthetic')
+UNBOUNDED = sys.maxsize  # Rows of the profiles that do not end
+LATITUDE = 53.1  # [deg], of the site of the data files
+# Synthetic profile
+PEAK_POWER = 10000  # [W]
+PERFORMANCE_RATIO = 0.8  # Losses of the modules and inverter
+TILT = 35  # Of the modules [deg]
+SOLAR_NOON = 12.5  # Local time [h] of the data files
+SYNTHETIC_EPOCH = datetime(2000, 1, 1)  # First day of the synthetic profiles
+SYNTHETIC_RESOLUTION = 60  # [s]
+CLEARNESS = (1.5, 1.5)  # Beta distribution of the daily clearness index
+CLOUD_SIGMA = 0.15  # Standard deviation of the hourly variation of the clearness index
+DAY_CACHE = 2  # Days of the synthetic profiles kept in memory
+
+
+class PVTable:
+    '''
+    Memory-mapped, column-oriented view of a cached PV data file.
+
+    Rows are sampled at a fixed interval of ``resolution`` seconds starting at
+    ``start``. For every attribute the raw values and their cumulative sum
+    (with a leading zero) are available, the latter allows computing the mean
+    over any window of rows in O(1).
+    '''
+
+    def __init__(self, meta, columns, cumsums):
+        self.model = meta['model']
+        self.attrs = meta['attrs']
+        self.start = datetime.strptime(meta['start'], DATE_FORMAT)
+        self.resolution = meta['resolution']
+        self.rows = meta['rows']
+        self.columns = columns
+        self.cumsums = cumsums
+
+    @property
+    def end(self):
+        return self.start + timedelta(seconds=self.rows * self.resolution)
+
+    def window(self, attr, first, last, aggregate='mean'):
+        '''
+        Return the value of *attr* for the rows ``[first, last)``.
+
+        :param attr: attribute name (string)
+        :param first: index of the first row (int)
+        :param last: index after the last row, must be larger than *first* (int)
+        :param aggregate: 'mean' for the average over the window, 'sample' for the value of the first row (string)
+        :return: aggregated value (float)
+        '''
+        if aggregate == 'sample':
+            return float(self.columns[attr][first])
+        cumsum = self.cumsums[attr]
+        return float((cumsum[last] - cumsum[first]) / (last - first))
+
+    def windows(self, attr, first, last, aggregate='mean'):
+        '''
+        Vectorised :meth:`window` for arrays of row indices *first* and *last*.
+
+        :return: aggregated values (array)
+        '''
+        if aggregate == 'sample':
+            return np.asarray(self.columns[attr])[first]
+        cumsum = self.cumsums[attr]
+        return (cumsum[last] - cumsum[first]) / (last - first)
+
+    def step_rows(self, offset, times, next_times):
+        '''
+        Return the rows of the steps at *times* that end at *next_times* (mosaik times [s] relative to *offset*).
+        Steps that start after the end of the data are dropped.
+
+        :return: tuple of (times, first rows, last rows) (arrays)
+        '''
+        times = np.asarray(times)
+        next_times = np.asarray(next_times)
+        first = (offset + times) // self.resolution
+        inside = first < self.rows
+        times, next_times, first = times[inside], next_times[inside], first[inside]
+        last = np.minimum(np.maximum((offset + next_times) // self.resolution, first + 1), self.rows)
+        return times, first, last
+
+
+def cache_paths(datafile):
+    '''
+    Return the paths of the cache belonging to *datafile*.
+
+    :param datafile: path to the CSV data file (string or pathlib.Path)
+    :return: tuple of (cache directory, meta file) (pathlib.Path)
+    '''
+    datafile = pathlib.Path(datafile)
+    cache_dir = pathlib.Path(datafile.parent, CACHE_DIR_NAME)
+    return cache_dir, pathlib.Path(cache_dir, datafile.name + '.json')
+
+
+def load_table(datafile):
+    '''
+    Return a :class:`PVTable` for *datafile*, (re-)building the binary cache
+    if it is missing or older than the data file.
+
+    :param datafile: path to the CSV data file (string or pathlib.Path)
+    :return: memory-mapped table (PVTable)
+    '''
+    datafile = pathlib.Path(datafile).resolve(strict=True)
+    cache_dir, meta_file = cache_paths(datafile)
+    source = _source_stamp(datafile)
+
+    meta = _load_meta(meta_file, source)
+    if meta is None:
+        # Processes started side by side (sweep and dispatch workers) convert the file once
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with _locked(pathlib.Path(cache_dir, datafile.name + '.lock')):
+            meta = _load_meta(meta_file, source)
+            if meta is None:
+                logger.info('Converting "%s" into binary cache ...', datafile)
+                meta = convert_csv(datafile, cache_dir, meta_file, source)
+
+    columns = {}
+    cumsums = {}
+    for attr, (col_file, cumsum_file) in meta['files'].items():
+        columns[attr] = np.load(pathlib.Path(cache_dir, col_file), mmap_mode='r')
+        cumsums[attr] = np.load(pathlib.Path(cache_dir, cumsum_file), mmap_mode='r')
+
+    return PVTable(meta, columns, cumsums)
+
+
+def convert_csv(datafile, cache_dir, meta_file, source=None):
+    '''
+    Parse a mosaik-csv style data file and write it as binary column files.
+
+    The first line holds the model name, the second line the attribute names
+    (with optional ``# comments``), all following lines a date and one value
+    per attribute. The rows have to be sampled at a fixed interval.
+
+    :param datafile: path to the CSV data file (pathlib.Path)
+    :param cache_dir: directory the column files are written to (pathlib.Path)
+    :param meta_file: path of the JSON file describing the cache (pathlib.Path)
+    :param source: stamp of the data file used to detect changes (string)
+    :return: content of the meta file (dict)
+    '''
+    with open(datafile) as f:
+        model = next(f).strip()
+        attrs = [_strip_comment(a) for a in next(f).strip().split(',')[1:]]
+        dates = []
+        values = []
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = line.split(',')
+            dates.append(row[0].strip())
+            values.append([float(v) for v in row[1:]])
+
+    if len(dates) < 2:
+        raise ValueError('PV data file "{}" needs at least two rows'.format(datafile))
+
+    start = datetime.strptime(dates[0], DATE_FORMAT)
+    resolution = int((datetime.strptime(dates[1], DATE_FORMAT) - start).total_seconds())
+    last = datetime.strptime(dates[-1], DATE_FORMAT)
+    if resolution <= 0 or (last - start).total_seconds() != resolution * (len(dates) - 1):
+        raise ValueError('PV data file "{}" is not sampled at a fixed interval'.format(datafile))
+
+    data = np.asarray(values, dtype=np.float64).reshape(len(dates), len(attrs))
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    files = {}
+    for i, attr in enumerate(attrs):
+        column = np.ascontiguousarray(data[:, i])
+        cumsum = np.concatenate(([0.0], np.cumsum(column)))
+        col_file = '{}.{}.npy'.format(datafile.name, attr)
+        cumsum_file = '{}.{}.cumsum.npy'.format(datafile.name, attr)
+        _save_atomic(pathlib.Path(cache_dir, col_file), column)
+        _save_atomic(pathlib.Path(cache_dir, cumsum_file), cumsum)
+        files[attr] = (col_file, cumsum_file)
+
+    meta = dict(
+        version=CACHE_VERSION,
+        source=source if source is not None else _source_stamp(datafile),
+        model=model,
+        attrs=attrs,
+        start=start.strftime(DATE_FORMAT),
+        resolution=resolution,
+        rows=len(dates),
+        files=files,
+    )
+    _write_atomic(meta_file, lambda f: f.write(json.dumps(meta, indent=2).encode()))
+
+    return meta
+
+
+def day_of_year(start, seconds):
+    '''
+    Return the days of the year (1 to 366) of the dates *seconds* after *start* (array).
+    '''
+    dates = np.datetime64(start, 's') + np.asarray(seconds, dtype='timedelta64[s]')
+    return (dates.astype('datetime64[D]') - dates.astype('datetime64[Y]')).astype(np.int64) + 1
+
+
+def declination(doy):
+    '''
+    Return the solar declination [rad] on the days of the year *doy*.
+    '''
+    return np.radians(23.45) * np.sin(2 * np.pi * (284 + np.asarray(doy)) / 365)
+
+
+def clear_sky(doy, hours, latitude):
+    '''
+    Return the clear-sky irradiance on modules tilted by TILT towards the south at *latitude* [deg] on the day of
+    the year *doy* at the local times *hours* [h], relative to the irradiance on modules facing the sun (array).
+    '''
+    phi = math.radians(latitude)
+    delta = declination(doy)
+    hour_angle = np.radians(15 * (np.asarray(hours) - SOLAR_NOON))
+    sin_elevation = math.sin(phi) * math.sin(delta) + math.cos(phi) * math.cos(delta) * np.cos(hour_angle)
+    tilted = phi - math.radians(TILT)
+    cos_incidence = math.sin(delta) * math.sin(tilted) + math.cos(delta) * math.cos(tilted) * np.cos(hour_angle)
+    return np.where(sin_elevation > 0, np.maximum(cos_incidence, 0), 0)
+
+
+def daily_clear_sky(doy, latitude):
+    '''
+    Return the daily mean of :func:`clear_sky` on the days of the year *doy* (array).
+    '''
+    days, index = np.unique(np.asarray(doy), return_inverse=True)
+    hours = (np.arange(96) + 0.5) / 4
+    means = np.array([clear_sky(day, hours, latitude).mean() for day in days.tolist()])
+    return means[index].reshape(np.shape(doy))
+
+
+class TiledProfile(PVTable):
+    '''
+    A :class:`PVTable` repeated indefinitely, optionally scaled to the season.
+
+    Rows beyond the table are taken from the table modulo its length. The sum
+    of the rows up to any row is the number of whole repetitions times the sum
+    of the table plus the cumulative sum within the table, so windows still
+    cost O(1). With *season*, the value of a window is scaled by the ratio of
+    the :func:`daily_clear_sky` of the day of its first row and of the day it
+    is taken from.
+    '''
+
+    def __init__(self, table, season=False, latitude=LATITUDE):
+        self.table = table
+        self.model = table.model
+        self.attrs = table.attrs
+        self.start = table.start
+        self.resolution = table.resolution
+        self.rows = UNBOUNDED
+        self.season = season
+        self.latitude = latitude
+        self.totals = {attr: float(table.cumsums[attr][-1]) for attr in table.attrs}
+
+    @property
+    def end(self):
+        return datetime.max
+
+    def _cumsum(self, attr, rows):
+        cycles, rows = np.divmod(rows, self.table.rows)
+        return cycles * self.totals[attr] + self.table.cumsums[attr][rows]
+
+    def _factor(self, rows):
+        if not self.season:
+            return 1.0
+        rows = np.asarray(rows)
+        target = day_of_year(self.start, rows * self.resolution)
+        source = day_of_year(self.start, rows % self.table.rows * self.resolution)
+        return daily_clear_sky(target, self.latitude) / daily_clear_sky(source, self.latitude)
+
+    def window(self, attr, first, last, aggregate='mean'):
+        if aggregate == 'sample':
+            value = self.table.columns[attr][first % self.table.rows]
+        else:
+            value = (self._cumsum(attr, last) - self._cumsum(attr, first)) / (last - first)
+        return float(value * self._factor(first))
+
+    def windows(self, attr, first, last, aggregate='mean'):
+        first = np.asarray(first)
+        last = np.asarray(last)
+        if aggregate == 'sample':
+            values = np.asarray(self.table.columns[attr])[first % self.table.rows]
+        else:
+            values = (self._cumsum(attr, last) - self._cumsum(attr, first)) / (last - first)
+        return values * self._factor(first)
+
+
+class SyntheticProfile(PVTable):
+    '''
+    Seeded stochastic PV profile starting at SYNTHETIC_EPOCH, without end.
+
+    The power of every row is the clear-sky irradiance on modules tilted by
+    TILT towards the south (:func:`clear_sky`) times PERFORMANCE_RATIO and a
+    clearness index: a daily value drawn from a beta distribution plus an
+    hourly variation interpolated over the day. Days
+    are generated on demand from a random generator seeded with *seed* and the
+    number of the day, so every day is the same whichever order the days are
+    requested in (e.g. when restoring a checkpoint), and only the last
+    DAY_CACHE days are kept.
+    '''
+
+    def __init__(self, seed=0, latitude=LATITUDE, peak_power=PEAK_POWER, resolution=SYNTHETIC_RESOLUTION):
+        if 86400 % resolution:
+            raise ValueError('Resolution must divide a day, got {}'.format(resolution))
+        self.model = 'PV'
+        self.attrs = ['P']
+        self.start = SYNTHETIC_EPOCH
+        self.resolution = resolution
+        self.rows = UNBOUNDED
+        self.seed = int(seed)
+        self.latitude = latitude
+        self.peak_power = peak_power
+        self.rows_per_day = 86400 // resolution
+        self.day = functools.lru_cache(maxsize=DAY_CACHE)(self._make_day)
+
+    @property
+    def end(self):
+        return datetime.max
+
+    def _make_day(self, day):
+        '''
+        Return the values (negative for feed-in, like the data files) of the *day* and their cumulative sum.
+        '''
+        rng = np.random.default_rng([self.seed, day])
+        doy = (self.start + timedelta(days=day)).timetuple().tm_yday
+        hours = (np.arange(self.rows_per_day) + 0.5) * self.resolution / 3600
+
+        clearness = rng.beta(*CLEARNESS) + CLOUD_SIGMA * rng.standard_normal(25)
+        clearness = np.clip(np.interp(hours, np.arange(25), clearness), 0.05, 1)
+
+        values = -self.peak_power * PERFORMANCE_RATIO * clear_sky(doy, hours, self.latitude) * clearness
+        return values, np.concatenate(([0.0], np.cumsum(values)))
+
+    def window(self, attr, first, last, aggregate='mean'):
+        if attr not in self.attrs:
+            raise KeyError(attr)
+        if aggregate == 'sample':
+            day, row = divmod(int(first), self.rows_per_day)
+            return float(self.day(day)[0][row])
+        first, last = int(first), int(last)
+        total = 0.0
+        row = first
+        while row < last:
+            # Sum the rows of one day at a time
+            day, start = divmod(row, self.rows_per_day)
+            end = min(last - day * self.rows_per_day, self.rows_per_day)
+            cumsum = self.day(day)[1]
+            total += cumsum[end] - cumsum[start]
+            row = day * self.rows_per_day + end
+        return float(total / (last - first))
+
+    def windows(self, attr, first, last, aggregate='mean'):
+        first = np.asarray(first).tolist()
+        last = np.asarray(last).tolist()
+        return np.fromiter((self.window(attr, f, l, aggregate) for f, l in zip(first, last)), dtype=np.float64,
+                           count=len(first))
+
+
+def open_profile(datafile=None, profile='data', seed=0, latitude=LATITUDE, peak_power=PEAK_POWER):
+    '''
+    Return the PV profile *profile* (one of PROFILES, see the module docstring).
+
+    :param datafile: path to the CSV data file, not used by 'synthetic' (string or pathlib.Path)
+    :return: table with the interface of :class:`PVTable` (PVTable)
+    '''
+    if profile == 'synthetic':
+        return SyntheticProfile(seed, latitude, peak_power)
+    if profile not in PROFILES:
+        raise ValueError('Unknown PV profile "{}", expected one of {}'.format(profile, PROFILES))
+    table = load_table(datafile)
+    if profile == 'data':
+        return table
+    return TiledProfile(table, season=profile == 'season', latitude=latitude)
+
+
+class PVSim(mosaik_api.Simulator):
+    '''
+    Serves the attributes of a PV data file or profile (see :func:`open_profile`) at a fixed step size.
+
+    With ``aggregate='mean'`` (default) every step returns the average over
+    the step interval, with ``aggregate='sample'`` it returns the value at the
+    beginning of the interval (which is what ``mosaik_csv:CSV`` delivers to a
+    simulator stepping at a coarser step size).
+    '''
+
+    def __init__(self):
+        super().__init__({'type': 'time-based', 'models': {}, 'extra_methods': ['step_plan']})
+        self.table = None
+        self.start_date = None
+        self.offset = None
+        self.step_size = None
+        self.plan = None
+        self.aggregate = None
+        self.eids = set()
+        self.cache = None
+        self.checkpoints = None
+
+    def init(self, sid, time_resolution=1., sim_start=None, datafile=None, step_size=None, aggregate='mean',
+             profile='data', seed=0, latitude=LATITUDE, peak_power=PEAK_POWER, checkpoint_dir=None,
+             checkpoint_every=0, restore=None):
+        if aggregate not in AGGREGATIONS:
+            raise ValueError('Unknown aggregation "{}", expected one of {}'.format(aggregate, AGGREGATIONS))
+
+        self.table = open_profile(datafile, profile, seed, latitude, peak_power)
+        self.start_date = datetime.strptime(sim_start, DATE_FORMAT)
+        if not self.table.start <= self.start_date < self.table.end:
+            raise ValueError('Start date "{}" not in PV data file.'.format(sim_start))
+
+        self.offset = int((self.start_date - self.table.start).total_seconds())
+        self.checkpoints, restored = open_checkpoints(sid, checkpoint_dir, checkpoint_every, restore)
+        if restored is not None:
+            # Continue at the saved position in the data file.
+            self.offset = restored['cursor']
+            self.start_date = self.table.start + timedelta(seconds=self.offset)
+        self.step_size = int(step_size) if step_size else self.table.resolution
+        self.plan = StepPlan(self.step_size)
+        self.aggregate = aggregate
+
+        self.meta['models'][self.table.model] = {
+            'public': True,
+            'any_inputs': True,  # Ignored, inputs only pace the simulator (e.g. a time-shifted clock)
+            'params': [],
+            'attrs': ['Date'] + self.table.attrs,
+        }
+        return self.meta
+
+    def create(self, num, model):
+        if model != self.table.model:
+            raise ValueError('Invalid model "{}"'.format(model))
+
+        start_idx = len(self.eids)
+        entities = []
+        for i in range(num):
+            eid = '%s_%s' % (model, i + start_idx)
+            entities.append({
+                'eid': eid,
+                'type': model,
+                'rel': [],
+            })
+            self.eids.add(eid)
+        return entities
+
+    def step_plan(self, until, tolerance, max_step, breaks=(), settle_steps=2, error_rates=None, max_error=None):
+        '''
+        Plan adaptive step times until *until*: steps are merged as long as
+        the values of all attributes at the merged steps differ by at most
+        *tolerance* and the merged step is not longer than *max_step* [s],
+        and the summed output error bound of the merged steps stays within
+        *max_error* (see step_plan.plan_steps()).
+        This simulator steps at the planned times from now on.
+
+        :param breaks: times that must be step times, e.g. checkpoint times (list of ints)
+        :param settle_steps: number of steps at the start of a quiescent interval that are not merged (int)
+        :param error_rates: output error per unit of deviation of an attribute {attr: W} (dict, optional)
+        :param max_error: bound on the summed output error [Wh] (float, optional)
+        :return: {'step_times': [...], 'steps': n, 'base_steps': n, 'deviation': {attr: largest difference},
+                 'error': summed output error bound [Wh], 'step_error': largest output error bound of a step [Wh]}
+        '''
+        table = self.table
+        times = np.arange(0, until, self.step_size)
+        times, first, last = table.step_rows(self.offset, times, times + self.step_size)
+        values = [table.windows(attr, first, last, self.aggregate) for attr in table.attrs]
+        error_rates = error_rates or {}
+
+        step_times, deviation, errors = plan_steps(
+            np.column_stack(values), self.step_size, tolerance, max(int(max_step) // self.step_size, 1), breaks,
+            settle_steps, [error_rates.get(attr, 0.0) for attr in table.attrs], max_error)
+        self.plan = StepPlan(self.step_size, step_times)
+        return {
+            'step_times': step_times,
+            'steps': len(step_times),
+            'base_steps': len(times),
+            'deviation': dict(zip(table.attrs, deviation.tolist())),
+            'error': sum(errors),
+            'step_error': max(errors, default=0.0),
+        }
+
+    def step(self, time, inputs, max_advance):
+        if self.checkpoints is not None and self.checkpoints.due(time):
+            self.checkpoints.save(time, {'cursor': self.offset + time})
+
+        table = self.table
+        first = (self.offset + time) // table.resolution
+        if first >= table.rows:
+            raise IndexError('End of PV data reached.')
+        next_time = self.plan.next(time)
+        last = min(max((self.offset + next_time) // table.resolution, first + 1), table.rows)
+
+        self.cache = {
+            attr: table.window(attr, first, last, self.aggregate) for attr in table.attrs
+        }
+        self.cache['Date'] = (self.start_date + timedelta(seconds=time)).strftime(DATE_FORMAT)
+
+        return next_time
+
+    def get_data(self, outputs):
+        data = {}
+        for eid, attrs in outputs.items():
+            if eid not in self.eids:
+                raise ValueError('Unknown entity ID "{}"'.format(eid))
+            data[eid] = {attr: self.cache[attr] for attr in attrs}
+        return data
+
+    def finalize(self):
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+
+
+def _strip_comment(attr):
+    try:
+        attr = attr[:attr.index('#')]
+    except ValueError:
+        pass
+    return attr.strip()
+
+
+def _source_stamp(datafile):
+    stat = datafile.stat()
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def _load_meta(meta_file, source):
+    '''
+    Return the content of the meta file if the cache is complete and up to date, otherwise None.
+    '''
+    if not meta_file.is_file():
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta.get('version') != CACHE_VERSION or meta.get('source') != source:
+        return None
+    return meta
+
+
+@contextlib.contextmanager
+def _locked(path):
+    '''
+    Hold an exclusive lock on the file *path* (without locking where fcntl is not available).
+    '''
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _write_atomic(path, write):
+    '''
+    Write *path* with *write(file)* through a temporary file of a unique name, so that concurrent writers of the same
+    path do not interfere and readers never see a partial file.
+    '''
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + '.', suffix='.tmp', delete=False) as f:
+        try:
+            write(f)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+def _save_atomic(path, array):
+    _write_atomic(path, lambda f: np.save(f, array))
+
+
+def main():
+    return mosaik_api.start_simulation(PVSim(), 'Columnar PV data simulator')
+
+
+if __name__ == '__main__':
+    main()
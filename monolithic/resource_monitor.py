@@ -0,0 +1,223 @@
+'''
+Resource usage of the simulation containers, tagged with simulated time.
+
+A sampler thread reads the cgroup counters of every monitored container
+every ``interval`` wall-clock seconds:
+
+* ``cpu_usage``: CPU time used [s] and ``cpu_cores``: CPU cores used since
+  the last sample,
+* ``nr_throttled`` / ``throttled``: periods and time [s] the container was
+  throttled by its CPU quota (``--cpus``),
+* ``memory``: memory used [bytes] and ``memory_limit`` (``--memory``).
+
+Every sample is tagged with the simulated time the scenario has reached (the
+time of the last step of the monitor), and the samples are appended to a CSV
+file in batches of ``batch_size``. Connect at least one entity to the
+monitor, so that it steps with the scenario instead of running ahead.
+
+Containers are given as ``{name: cgroup directory}``. Inside a container, its
+own cgroup is ``/sys/fs/cgroup``. Both cgroup v2 and v1 (with the files of
+the ``cpu``, ``cpuacct`` and ``memory`` controllers in one directory or in one
+subdirectory per controller) are read. Any directory with these files can
+stand in for a cgroup, e.g. for tests.
+'''
+import csv
+import logging
+import os
+import threading
+import time
+
+import mosaik_api
+
+from step_plan import StepPlan
+
+
+logger = logging.getLogger('resource_monitor')
+
+COLUMNS = ('wall_time', 'sim_time', 'container', 'cpu_usage', 'cpu_cores', 'nr_throttled', 'throttled', 'memory',
+           'memory_limit')
+OWN_CGROUP = '/sys/fs/cgroup'
+
+META = {
+    'type': 'time-based',
+    'models': {
+        'Monitor': {
+            'public': True,
+            'any_inputs': True,
+            'params': [
+                'filename',  # CSV file the samples are appended to
+                'cgroups',  # {container name: cgroup directory} (default: own cgroup)
+            ],
+            'attrs': [],
+        },
+    },
+}
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _read_int(path):
+    value = _read(path)
+    if value is None or value == 'max':
+        return None
+    return int(value)
+
+
+def _read_stat(path):
+    text = _read(path)
+    if text is None:
+        return {}
+    return {key: int(value) for key, value in (line.split() for line in text.splitlines() if line.strip())}
+
+
+def read_cgroup(path):
+    '''
+    Read the counters of the cgroup directory *path* (cgroup v2 or v1).
+
+    :return: {'cpu_usage': [s], 'nr_throttled': int, 'throttled': [s], 'memory': [bytes], 'memory_limit': [bytes]},
+        None for counters that are not available (dict)
+    '''
+    cpu_stat = _read_stat(os.path.join(path, 'cpu.stat'))
+    if 'usage_usec' in cpu_stat:
+        # cgroup v2
+        throttled = cpu_stat.get('throttled_usec')
+        return {
+            'cpu_usage': cpu_stat['usage_usec'] / 1e6,
+            'nr_throttled': cpu_stat.get('nr_throttled'),
+            'throttled': None if throttled is None else throttled / 1e6,
+            'memory': _read_int(os.path.join(path, 'memory.current')),
+            'memory_limit': _read_int(os.path.join(path, 'memory.max')),
+        }
+
+    # cgroup v1: the files are in one directory or in one directory per controller (like /sys/fs/cgroup).
+    def v1(controller, name):
+        directory = os.path.join(path, controller)
+        return os.path.join(directory if os.path.isdir(directory) else path, name)
+
+    cpu_stat = _read_stat(v1('cpu', 'cpu.stat'))
+    usage = _read_int(v1('cpuacct', 'cpuacct.usage'))
+    throttled = cpu_stat.get('throttled_time')
+    return {
+        'cpu_usage': None if usage is None else usage / 1e9,
+        'nr_throttled': cpu_stat.get('nr_throttled'),
+        'throttled': None if throttled is None else throttled / 1e9,
+        'memory': _read_int(v1('memory', 'memory.usage_in_bytes')),
+        'memory_limit': _read_int(v1('memory', 'memory.limit_in_bytes')),
+    }
+
+
+class Sampler:
+    '''
+    Samples the cgroups of the containers in a thread and writes the samples in batches.
+
+    :param filename: CSV file (string)
+    :param cgroups: {container name: cgroup directory} (dict)
+    :param interval: time between samples [s] (float)
+    :param batch_size: samples per write (int)
+    '''
+
+    def __init__(self, filename, cgroups, interval, batch_size):
+        self.cgroups = dict(cgroups)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.sim_time = None  # Set by the simulator
+        self.batch = []
+        self.last = {}  # container -> (wall time, cpu usage) of the last sample
+        new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        self.file = open(filename, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new:
+            self.writer.writerow(COLUMNS)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='resource-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def sample(self):
+        now = time.time()
+        for name, path in self.cgroups.items():
+            counters = read_cgroup(path)
+            cores = None
+            last = self.last.get(name)
+            if last is not None and counters['cpu_usage'] is not None and now > last[0]:
+                cores = (counters['cpu_usage'] - last[1]) / (now - last[0])
+            if counters['cpu_usage'] is not None:
+                self.last[name] = (now, counters['cpu_usage'])
+            counters.update(wall_time=now, sim_time=self.sim_time, container=name, cpu_cores=cores)
+            self.batch.append([counters[column] for column in COLUMNS])
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.writerows(self.batch)
+            self.file.flush()
+            self.batch = []
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                # Monitoring must never stop the simulation.
+                logger.exception('Sampling failed')
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        self.flush()
+        self.file.close()
+
+
+class ResourceMonitor(mosaik_api.Simulator):
+    def __init__(self):
+        super().__init__(META)
+        self.eid = 'resources'
+        self.plan = None
+        self.time_offset = None
+        self.interval = None
+        self.batch_size = None
+        self.sampler = None
+
+    def init(self, sid, time_resolution=1., step_size=900, step_times=None, time_offset=0, interval=1.0,
+             batch_size=100):
+        self.plan = StepPlan(step_size, step_times)
+        self.time_offset = time_offset
+        self.interval = interval
+        self.batch_size = batch_size
+        return self.meta
+
+    def create(self, num, model, filename, cgroups=None):
+        if num != 1 or self.sampler is not None:
+            raise ValueError('Can only create one monitor.')
+        self.sampler = Sampler(filename, cgroups or {'self': OWN_CGROUP}, self.interval, self.batch_size)
+        return [{'eid': self.eid, 'type': model, 'rel': []}]
+
+    def setup_done(self):
+        self.sampler.sim_time = self.time_offset
+        self.sampler.sample()
+        self.sampler.start()
+
+    def step(self, time, inputs, max_advance):
+        self.sampler.sim_time = time + self.time_offset
+        return self.plan.next(time)
+
+    def finalize(self):
+        if self.sampler is not None:
+            self.sampler.close()
+
+
+def main():
+    return mosaik_api.start_simulation(ResourceMonitor(), 'Container resource monitor')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+'''
+Buffered result sink for mosaik.
+
+Replacement for ``mosaik_hdf5:MosaikHdf5``. Instead of one dataset per entity
+and attribute, the values of all entities of a type are collected in
+preallocated NumPy arrays (steps x entities) and written every ``buf_steps``
+recorded steps as one chunk of a compressed, chunked dataset. Writing happens
+on a background thread while the simulation goes on.
+
+Output layout:
+
+* ``hdf5``: one file, group ``/<type>`` with the datasets ``eid``, ``time`` and
+  one 2D dataset (time x entity) per attribute.
+* ``parquet``: one file ``<name>.<type>.parquet`` per entity type in long
+  format with the columns ``time``, ``eid`` and one column per attribute.
+
+Which attributes are recorded and how often can be set for each entity type
+with the *record* parameter, e.g. ``{'PQBus': {'attrs': ['Vm'], 'every': 4}}``
+records only the voltage of the PQ buses at every fourth step. The layout of
+types with ``attrs`` is known at setup: all entities of the type connected to
+the sink, times the listed attributes. Types without ``attrs`` are recorded
+completely at every step, with the attributes they deliver in the first
+step. Values that are missing at a step (an entity that has not delivered
+yet, ``None``) are recorded as NaN; attributes with non-numeric values are not
+recorded.
+'''
+import logging
+import numbers
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import mosaik_api
+
+from step_plan import StepPlan
+
+
+logger = logging.getLogger('result_sink')
+
+FORMATS = ('hdf5', 'parquet')
+DEFAULT_COMPRESSION = {
+    'hdf5': 'gzip',
+    'parquet': 'zstd',
+}
+MAX_CHUNK_CELLS = 2 ** 20  # Upper limit for the number of values in one HDF5 chunk
+
+META = {
+    'type': 'time-based',
+    'models': {
+        'Database': {
+            'public': True,
+            'any_inputs': True,
+            'params': [
+                'filename',  # Output file (for parquet: base name of the files)
+                'format',  # 'hdf5' or 'parquet'
+                'record',  # {entity type: {'attrs': [...], 'every': n}}, optional
+                'buf_steps',  # Number of recorded steps kept in memory per entity type
+                'compression',  # Compression filter/codec, default depends on format
+            ],
+            'attrs': [],
+        },
+    },
+}
+
+
+class Hdf5Writer:
+    '''
+    Writes the buffers of each entity type into one HDF5 group.
+    '''
+
+    def __init__(self, filename, layout, compression, chunk_steps):
+        import h5py
+
+        self.file = h5py.File(filename, 'w')
+        for etype, (eids, attrs) in layout.items():
+            group = self.file.create_group(etype)
+            group.create_dataset('eid', data=np.array(eids, dtype=object), dtype=h5py.string_dtype())
+            group.create_dataset('time', shape=(0,), maxshape=(None,), dtype='i8', chunks=(chunk_steps,))
+            rows = max(1, min(chunk_steps, MAX_CHUNK_CELLS // len(eids)))
+            for attr in attrs:
+                group.create_dataset(attr, shape=(0, len(eids)), maxshape=(None, len(eids)), dtype='f8',
+                                     chunks=(rows, len(eids)), compression=compression,
+                                     shuffle=compression is not None)
+
+    def write(self, etype, times, columns):
+        group = self.file[etype]
+        start = group['time'].shape[0]
+        end = start + len(times)
+        group['time'].resize((end,))
+        group['time'][start:end] = times
+        for attr, values in columns.items():
+            dataset = group[attr]
+            dataset.resize(end, axis=0)
+            dataset[start:end] = values
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    '''
+    Writes the buffers of each entity type into its own Parquet file, one row
+    group per flush.
+    '''
+
+    def __init__(self, filename, layout, compression, chunk_steps):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.writers = {}
+        self.schemas = {}
+        self.eids = {}
+        base = pathlib.Path(filename)
+        for etype, (eids, attrs) in layout.items():
+            schema = pa.schema(
+                [('time', pa.int64()), ('eid', pa.dictionary(pa.int32(), pa.string()))] +
+                [(attr, pa.float64()) for attr in attrs]
+            )
+            path = base.with_name('{}.{}.parquet'.format(base.stem, etype))
+            self.writers[etype] = pq.ParquetWriter(str(path), schema, compression=compression or 'none')
+            self.schemas[etype] = schema
+            self.eids[etype] = pa.array(eids, type=pa.string())
+
+    def write(self, etype, times, columns):
+        pa = self.pa
+        eids = self.eids[etype]
+        count = len(eids)
+        indices = np.tile(np.arange(count, dtype=np.int32), len(times))
+        arrays = [
+            pa.array(np.repeat(times, count)),
+            pa.DictionaryArray.from_arrays(pa.array(indices), eids),
+        ]
+        # Columns are (time x entity) in C order, so ravel() matches the repeat/tile above.
+        arrays.extend(pa.array(columns[name].ravel()) for name in self.schemas[etype].names[2:])
+        self.writers[etype].write_table(pa.Table.from_arrays(arrays, schema=self.schemas[etype]))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+WRITERS = {
+    'hdf5': Hdf5Writer,
+    'parquet': ParquetWriter,
+}
+
+
+class TypeBuffer:
+    '''
+    Double-buffered (steps x entities) arrays for the attributes of one
+    entity type. One buffer is filled while the other one is being written.
+    '''
+
+    def __init__(self, etype, eids, attrs, every, steps):
+        self.etype = etype
+        self.eids = eids
+        self.attrs = attrs
+        self.every = every
+        self.columns = {eid: i for i, eid in enumerate(eids)}
+        self._slots = [self._allocate(steps), self._allocate(steps)]
+        self._futures = [None, None]
+        self._current = 0
+        self.times, self.data = self._slots[0]
+        self.rows = 0
+
+    def _allocate(self, steps):
+        times = np.empty(steps, dtype=np.int64)
+        data = {attr: np.full((steps, len(self.eids)), np.nan) for attr in self.attrs}
+        return times, data
+
+    @property
+    def full(self):
+        return self.rows == len(self.times)
+
+    def flush(self, executor, writer):
+        '''
+        Hand the filled rows over to *writer* on *executor* and switch to the
+        other buffer (waiting until its previous write has finished).
+        '''
+        if self.rows:
+            rows = self.rows
+            times, data = self.times, self.data
+            self._futures[self._current] = executor.submit(
+                writer.write, self.etype, times[:rows], {attr: values[:rows] for attr, values in data.items()})
+
+        self._current = 1 - self._current
+        future = self._futures[self._current]
+        if future is not None:
+            future.result()
+            self._futures[self._current] = None
+        self.times, self.data = self._slots[self._current]
+        for values in self.data.values():
+            values.fill(np.nan)
+        self.rows = 0
+
+    def wait(self):
+        for i, future in enumerate(self._futures):
+            if future is not None:
+                future.result()
+                self._futures[i] = None
+
+
+class ResultSink(mosaik_api.Simulator):
+    def __init__(self):
+        super().__init__(META)
+        self.eid = 'resultdb'
+        self.sid = None
+        self.step_size = None
+        self.plan = None
+        self.time_offset = None
+        self.filename = None
+        self.format = None
+        self.record = None
+        self.buf_steps = None
+        self.compression = None
+
+        self.types = {}  # full entity ID -> entity type of the connected entities, set in setup_done()
+        self.buffers = None  # entity type -> TypeBuffer, set in the first step
+        self.targets = None  # (full entity ID, attr) -> (TypeBuffer, column)
+        self.writer = None
+        self.executor = None
+        self.step_count = 0
+
+    def init(self, sid, time_resolution=1., step_size=900, duration=None, time_offset=0, step_times=None):
+        self.sid = sid
+        self.step_size = step_size
+        self.plan = StepPlan(step_size, step_times)
+        self.time_offset = time_offset  # Added to the recorded times, e.g. for runs restored from a checkpoint
+        return self.meta
+
+    def create(self, num, model, filename, format='hdf5', record=None, buf_steps=96, compression=None):
+        if num != 1 or self.filename is not None:
+            raise ValueError('Can only create one database.')
+        if format not in FORMATS:
+            raise ValueError('Unknown format "{}", expected one of {}'.format(format, FORMATS))
+
+        self.filename = filename
+        self.format = format
+        self.record = record or {}
+        self.buf_steps = buf_steps
+        self.compression = compression if compression is not None else DEFAULT_COMPRESSION[format]
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='result-sink')
+
+        return [{'eid': self.eid, 'type': model, 'rel': []}]
+
+    def setup_done(self):
+        related = yield self.mosaik.get_related_entities('%s.%s' % (self.sid, self.eid))
+        self.types = {full_id: node['type'] for full_id, node in related.items()}
+
+    def step(self, time, inputs, max_advance):
+        inputs = inputs.get(self.eid, {})
+        if self.buffers is None:
+            self._create_buffers(inputs)
+
+        active = [buf for buf in self.buffers.values() if self.step_count % buf.every == 0]
+        for buf in active:
+            buf.times[buf.rows] = self.time_offset + time
+
+        targets = self.targets
+        for attr, values in inputs.items():
+            for src_id, value in values.items():
+                target = targets.get((src_id, attr))
+                if target is None:
+                    continue
+                buf, column = target
+                if self.step_count % buf.every == 0:
+                    try:
+                        buf.data[attr][buf.rows, column] = np.nan if value is None else value
+                    except (TypeError, ValueError):
+                        logger.warning('Not recording non-numeric value %r of %s of %s', value, attr, src_id)
+                        del targets[(src_id, attr)]
+
+        for buf in active:
+            buf.rows += 1
+            if buf.full:
+                buf.flush(self.executor, self.writer)
+
+        self.step_count += 1
+        return self.plan.next(time)
+
+    def finalize(self):
+        if self.buffers is not None:
+            for buf in self.buffers.values():
+                buf.flush(self.executor, self.writer)
+            for buf in self.buffers.values():
+                buf.wait()
+            self.executor.submit(self.writer.close).result()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def _create_buffers(self, inputs):
+        # Types with recorded attrs: every connected entity of the type with all of them
+        entity_attrs = {}
+        for src_id, etype in self.types.items():
+            attrs = self.record.get(etype, {}).get('attrs')
+            if attrs is not None:
+                entity_attrs.setdefault(etype, {})[src_id] = set(attrs)
+
+        # Other types: the attributes delivered in the first step
+        for attr, values in inputs.items():
+            for src_id, value in values.items():
+                etype = self.types.get(src_id, src_id.split('.', 1)[0])
+                if self.record.get(etype, {}).get('attrs') is not None:
+                    continue
+                if value is not None and (not isinstance(value, numbers.Real) or isinstance(value, bool)):
+                    logger.warning('Not recording non-numeric attribute %s of %s', attr, src_id)
+                    continue
+                entity_attrs.setdefault(etype, {}).setdefault(src_id, set()).add(attr)
+
+        self.buffers = {}
+        self.targets = {}
+        for etype, entities in sorted(entity_attrs.items()):
+            eids = sorted(entities)
+            attrs = sorted(set().union(*entities.values()))
+            every = int(self.record.get(etype, {}).get('every', 1))
+            buf = TypeBuffer(etype, eids, attrs, every, self.buf_steps)
+            self.buffers[etype] = buf
+            for src_id, src_attrs in entities.items():
+                for attr in src_attrs:
+                    self.targets[(src_id, attr)] = (buf, buf.columns[src_id])
+
+        layout = {etype: (buf.eids, buf.attrs) for etype, buf in self.buffers.items()}
+        writer_cls = WRITERS[self.format]
+        self.writer = self.executor.submit(writer_cls, self.filename, layout, self.compression, self.buf_steps).result()
+
+
+def main():
+    return mosaik_api.start_simulation(ResultSink(), 'Buffered result sink')
+
+
+if __name__ == '__main__':
+    main()
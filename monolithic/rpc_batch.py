@@ -0,0 +1,132 @@
+'''
+One round-trip per step for remote simulators.
+
+mosaik keeps one connection per remote simulator, but for every step it sends
+a ``step()`` request, waits for the response, then sends a ``get_data()``
+request for the outputs and waits again. ``set_data()`` calls of the
+simulator during its step are requests of their own. If the simulators run in
+other containers or on other hosts, these round-trips and not the computation
+limit the step rate.
+
+Simulators of this package offer the extra method ``step_batch()``
+(:class:`BatchedStep`). It steps the simulator, collects its outputs and the
+``set_data()`` calls it made during the step, and returns everything in one
+response. After the simulators have been started, :func:`enable_batching`
+replaces the proxies of all remote simulators that offer it by a
+:class:`BatchingProxy`, which sends one ``step_batch()`` request instead of
+``step()`` and answers the following ``get_data()`` of the scheduler from its
+response. Other requests, e.g. ``get_data()`` calls of other simulators, are
+passed through unchanged on the same connection.
+
+Like wire.py, this relies on the internals of the pinned mosaik version (see
+requirements.txt).
+'''
+import inspect
+import logging
+
+import mosaik_api
+
+
+logger = logging.getLogger('rpc_batch')
+
+BATCH_METHOD = 'step_batch'
+
+
+class _BufferedMosaik:
+    '''
+    Stand-in for the mosaik proxy of a simulator during :meth:`BatchedStep.step_batch` that buffers ``set_data()``.
+    '''
+
+    def __init__(self, proxy, env):
+        self._proxy = proxy
+        self._env = env
+        self.buffered = []
+
+    def __getattr__(self, name):
+        return getattr(self._proxy, name)
+
+    def set_data(self, data):
+        self.buffered.append(data)
+        return self._env.event().succeed()
+
+
+class BatchedStep:
+    '''
+    Mixin for mosaik_api.Simulator classes that adds ``step_batch()``. Add BATCH_METHOD to the ``'extra_methods'`` of
+    the meta data.
+    '''
+
+    def step_batch(self, time, inputs, max_advance, outputs):
+        '''
+        Step like ``step()`` and return ``[next step, get_data(outputs), buffered set_data() calls]``.
+        '''
+        proxy = getattr(self, 'mosaik', None)
+        buffered = None
+        if isinstance(proxy, mosaik_api.MosaikProxy):
+            buffered = self.mosaik = _BufferedMosaik(proxy, proxy._channel.env)
+        try:
+            next_step = self.step(time, inputs, max_advance)
+            if inspect.isgenerator(next_step):
+                next_step = yield from next_step
+        finally:
+            if buffered is not None:
+                self.mosaik = proxy
+        data = self.get_data(outputs) if outputs else {}
+        return [next_step, data, buffered.buffered if buffered is not None else []]
+
+
+class BatchingProxy:
+    '''
+    Stand-in for the proxy of a remote simulator that steps it with ``step_batch()``.
+
+    :param sim: the simulator (mosaik.simmanager.RemoteProcess)
+    :param world: the world of *sim* (mosaik.World)
+    '''
+
+    def __init__(self, sim, world):
+        self._proxy = sim.proxy
+        self._sim = sim
+        self._world = world
+        self._outputs = None  # Outputs requested with the last step and their values
+        self._data = None
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        return getattr(self._proxy, name)
+
+    def step(self, time, inputs, max_advance=None):
+        self._outputs = self._data = None
+        return self._world.env.process(self._step(time, inputs, max_advance))
+
+    def _step(self, time, inputs, max_advance):
+        outputs = self._world._df_outattr[self._sim.sid]
+        self.round_trips += 1
+        next_step, data, set_data = yield getattr(self._proxy, BATCH_METHOD)(time, inputs, max_advance, outputs)
+        for request in set_data:
+            self._sim._mosaik_remote.set_data(request)
+        self._outputs, self._data = outputs, data
+        return next_step
+
+    def get_data(self, outputs):
+        if self._data is not None and outputs == self._outputs:
+            data, self._outputs, self._data = self._data, None, None
+            return self._world.env.event().succeed(data)
+        self.round_trips += 1
+        return self._proxy.get_data(outputs)
+
+
+def enable_batching(world):
+    '''
+    Step all remote simulators of *world* that offer ``step_batch()`` with one request per step.
+
+    :return: IDs of the simulators stepped in batches (list of strings)
+    '''
+    batched = []
+    for sid, sim in world.sims.items():
+        if getattr(sim, '_rpc_con', None) is None or BATCH_METHOD not in sim.meta.get('extra_methods', []):
+            continue
+        if not isinstance(sim.proxy, BatchingProxy):
+            sim.proxy = BatchingProxy(sim, world)
+        batched.append(sid)
+        logger.debug('Batching steps of %s', sid)
+    return batched
@@ -0,0 +1,412 @@
+'''
+Declarative scenarios.
+
+A scenario file (JSON, or YAML if PyYAML is installed) describes the
+simulators, entities, connections and recorded attributes of a scenario, see
+``scenarios/demo.json`` for the scenario of ``main.py``::
+
+    {
+        "simulators": {
+            <name>: {"sim": <name in sim_config>, "checkpoint": <bool>, "params": {<init params>}}
+        },
+        "entities": {
+            <group>: {"sim": <simulator>, "model": <model>, "count": <n>, "params": {<create params>},
+                      "children": {<group>: [<entity types>]}}
+        },
+        "connections": [
+            {"name": <name>, "from": <group>, "to": <group>, "rule": <rule>, "attrs": [<attr or [src, dest]>],
+             "time_shifted": <bool>, "initial_data": {...}, "weak": <bool>, "async_requests": <bool>}
+        ],
+        "groups": {<group>: {"targets": <connection name>}},
+        "results": {"groups": [<groups>], "record": {<entity type>: {"attrs": [...], "every": <n>}}}
+    }
+
+A string ``"${NAME}"`` anywhere in the file (also as key) is replaced by the
+variable *NAME*, which can be any value, e.g. a constant of ``main.py``.
+``children`` are groups of the children of the created entities by type (e.g.
+the buses of a grid). Rules of the connections:
+
+* ``round_robin``: source *i* to destination *i* mod the size of ``to``,
+* ``one_to_one``: source *i* to destination *i* (groups of the same size),
+* ``many_to_one``: every source to the only destination,
+* ``first``: the first source to the first destination,
+* ``via``: through the named connections in ``via``, e.g. a PV unit to the
+  power node of the compute node it is assigned to,
+* ``reverse``: the pairs of the named connection ``of``, reversed.
+
+``groups`` are derived groups: the destinations of a connection (e.g. the
+power nodes with at least one compute node). ``results`` lists the groups
+whose types are recorded as given by ``record``.
+
+The connections are compiled into a plan with the indices of the source and
+destination entities of every pair. The plan is cached in ``.cache`` next to
+the scenario file by a content hash of the resolved connections and the sizes
+of the groups, so later runs with the same scenario and fleet replay it
+without evaluating the rules. Every connection is replayed with one
+:func:`scenario_util.connect_pairs` call, mosaik checks the attributes of the
+first pair of every group of connections between the same models.
+'''
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+
+from mosaik.exceptions import ScenarioError
+
+from grid_index import GridIndex
+from scenario_util import connect_many_to_one, connect_pairs
+
+
+logger = logging.getLogger('scenario_spec')
+
+CACHE_DIR_NAME = '.cache'
+PLAN_VERSION = 1
+RULES = ('round_robin', 'one_to_one', 'many_to_one', 'first', 'via', 'reverse')
+CONNECT_OPTIONS = ('time_shifted', 'initial_data', 'weak', 'async_requests')
+VARIABLE = re.compile(r'^\$\{(\w+)\}$')
+
+
+def load_spec(path):
+    '''
+    Read and check the scenario file *path* (.json, .yaml or .yml).
+
+    :return: scenario with unresolved variables (dict)
+    '''
+    path = pathlib.Path(path)
+    with open(path) as f:
+        if path.suffix in ('.yaml', '.yml'):
+            import yaml
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    check_spec(spec, path)
+    return spec
+
+
+def check_spec(spec, path='<scenario>'):
+    '''
+    Check the structure and the references of the scenario *spec*.
+
+    :raise ScenarioError: listing all problems
+    '''
+    errors = []
+    if not isinstance(spec, dict):
+        raise ScenarioError('{}: expected an object'.format(path))
+    unknown = set(spec) - {'simulators', 'entities', 'connections', 'groups', 'results'}
+    if unknown:
+        errors.append('unknown sections: {}'.format(', '.join(sorted(unknown))))
+
+    simulators = spec.get('simulators', {})
+    for name, sim in simulators.items():
+        if 'sim' not in sim:
+            errors.append('simulator "{}": no "sim"'.format(name))
+
+    groups = set()
+    for name, entity in spec.get('entities', {}).items():
+        if entity.get('sim') not in simulators:
+            errors.append('entities "{}": unknown simulator "{}"'.format(name, entity.get('sim')))
+        if 'model' not in entity:
+            errors.append('entities "{}": no "model"'.format(name))
+        groups.add(name)
+        for child in entity.get('children', {}):
+            if child in groups:
+                errors.append('entities "{}": group "{}" defined twice'.format(name, child))
+            groups.add(child)
+
+    connections = {}
+    for i, conn in enumerate(spec.get('connections', [])):
+        label = 'connection {} ({})'.format(
+            i, conn.get('name', '{} -> {}'.format(conn.get('from'), conn.get('to'))))
+        for key in ('from', 'to'):
+            if conn.get(key) not in groups:
+                errors.append('{}: unknown group "{}"'.format(label, conn.get(key)))
+        rule = conn.get('rule')
+        if rule not in RULES:
+            errors.append('{}: unknown rule "{}", expected one of {}'.format(label, rule, ', '.join(RULES)))
+        if not conn.get('attrs'):
+            errors.append('{}: no "attrs"'.format(label))
+        refs = conn.get('via', []) if rule == 'via' else [conn.get('of')] if rule == 'reverse' else []
+        for ref in refs:
+            if ref not in connections:
+                errors.append('{}: "{}" is not the name of an earlier connection'.format(label, ref))
+        if rule == 'via' and refs and all(ref in connections for ref in refs):
+            chain = [connections[ref] for ref in refs]
+            if chain[0].get('from') != conn.get('from') or chain[-1].get('to') != conn.get('to') or any(
+                    a.get('to') != b.get('from') for a, b in zip(chain, chain[1:])):
+                errors.append('{}: "via" does not lead from "{}" to "{}"'.format(label, conn.get('from'),
+                                                                                conn.get('to')))
+        if rule == 'reverse' and conn.get('of') in connections:
+            of = connections[conn['of']]
+            if (of.get('from'), of.get('to')) != (conn.get('to'), conn.get('from')):
+                errors.append('{}: "{}" does not connect "{}" to "{}"'.format(label, conn['of'], conn.get('to'),
+                                                                             conn.get('from')))
+        unknown = set(conn) - {'name', 'from', 'to', 'rule', 'attrs', 'via', 'of'} - set(CONNECT_OPTIONS)
+        if unknown:
+            errors.append('{}: unknown keys {}'.format(label, ', '.join(sorted(unknown))))
+        if 'name' in conn:
+            if conn['name'] in connections:
+                errors.append('{}: name used twice'.format(label))
+            connections[conn['name']] = conn
+
+    derived = spec.get('groups', {})
+    for name, group in derived.items():
+        if name in groups:
+            errors.append('groups "{}": already an entity group'.format(name))
+        if group.get('targets') not in connections:
+            errors.append('groups "{}": unknown connection "{}"'.format(name, group.get('targets')))
+
+    for name in spec.get('results', {}).get('groups', []):
+        if name not in groups and name not in derived:
+            errors.append('results: unknown group "{}"'.format(name))
+
+    if errors:
+        raise ScenarioError('Invalid scenario {}:\n  {}'.format(path, '\n  '.join(errors)))
+
+
+def simulator_names(spec):
+    '''
+    Return the names in the sim config of the simulators of the scenario *spec* (list of strings).
+    '''
+    return [entry['sim'] for entry in spec.get('simulators', {}).values()]
+
+
+def resolve(value, variables):
+    '''
+    Return *value* with every string ``"${NAME}"`` in it replaced by ``variables[NAME]``.
+    '''
+    if isinstance(value, str):
+        match = VARIABLE.match(value)
+        if match is None:
+            return value
+        try:
+            return variables[match.group(1)]
+        except KeyError:
+            raise ScenarioError('Unknown variable "{}"'.format(match.group(1))) from None
+    if isinstance(value, dict):
+        return {resolve(k, variables): resolve(v, variables) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve(v, variables) for v in value]
+    return value
+
+
+def compile_plan(connections, derived, sizes):
+    '''
+    Evaluate the rules of the resolved *connections* for groups of the given *sizes*.
+
+    :param connections: resolved "connections" of a scenario (list of dicts)
+    :param derived: "groups" of a scenario (dict)
+    :param sizes: {group: number of entities} (dict)
+    :return: {'connections': [{'from', 'to', 'src': [...], 'dest': [...], 'attrs', 'options'}],
+        'groups': {name: {'of': group, 'indices': [...]}}} (dict)
+    '''
+    plan = []
+    named = {}
+    for conn in connections:
+        n, m = sizes[conn['from']], sizes[conn['to']]
+        rule = conn['rule']
+        if rule == 'round_robin':
+            if n and not m:
+                raise ScenarioError('Cannot distribute "{}" over the empty group "{}"'.format(conn['from'],
+                                                                                           conn['to']))
+            pairs = [(i, i % m) for i in range(n)]
+        elif rule == 'one_to_one':
+            if n != m:
+                raise ScenarioError('"{}" ({}) and "{}" ({}) differ in size'.format(conn['from'], n, conn['to'], m))
+            pairs = [(i, i) for i in range(n)]
+        elif rule == 'many_to_one':
+            if m != 1:
+                raise ScenarioError('"{}" must have exactly one entity, not {}'.format(conn['to'], m))
+            pairs = [(i, 0) for i in range(n)]
+        elif rule == 'first':
+            pairs = [(0, 0)] if n and m else []
+        elif rule == 'via':
+            pairs = [(i, i) for i in range(n)]
+            for ref in conn['via']:
+                mapping = dict(named[ref])
+                if len(mapping) != len(named[ref]):
+                    raise ScenarioError('Connection "{}" connects an entity more than once'.format(ref))
+                pairs = [(i, mapping[j]) for i, j in pairs if j in mapping]
+        else:  # 'reverse'
+            pairs = [(j, i) for i, j in named[conn['of']]]
+
+        if 'name' in conn:
+            named[conn['name']] = pairs
+        plan.append({
+            'from': conn['from'],
+            'to': conn['to'],
+            'src': [i for i, _ in pairs],
+            'dest': [j for _, j in pairs],
+            'attrs': conn['attrs'],
+            'options': {key: conn[key] for key in CONNECT_OPTIONS if key in conn},
+        })
+
+    groups = {}
+    for name, group in derived.items():
+        conn = next(c for c in connections if c.get('name') == group['targets'])
+        groups[name] = {'of': conn['to'], 'indices': sorted({j for _, j in named[group['targets']]})}
+    return {'connections': plan, 'groups': groups}
+
+
+def plan_key(connections, derived, sizes):
+    content = {'version': PLAN_VERSION, 'connections': connections, 'groups': derived, 'sizes': sizes}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def load_plan(connections, derived, sizes, cache_dir=None):
+    '''
+    Return the plan of :func:`compile_plan` from *cache_dir* or compile and cache it.
+
+    :return: tuple of (plan, True if it was cached)
+    '''
+    if cache_dir is None:
+        return compile_plan(connections, derived, sizes), False
+    path = pathlib.Path(cache_dir, 'plan-{}.json'.format(plan_key(connections, derived, sizes)))
+    try:
+        with open(path) as f:
+            return json.load(f), True
+    except (OSError, ValueError):
+        pass
+    plan = compile_plan(connections, derived, sizes)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Unique temporary name: sweep workers may cache the same plan at the same time
+        with tempfile.NamedTemporaryFile('w', dir=path.parent, prefix=path.name + '.', suffix='.tmp',
+                                         delete=False) as f:
+            json.dump(plan, f)
+        os.replace(f.name, path)
+    except OSError as e:
+        logger.warning('Could not cache the connection plan: %s', e)
+    return plan, False
+
+
+class Scenario:
+    '''
+    Builds the scenario *spec* in *world*, step by step, so that the caller can work in between (e.g. plan the step
+    times after starting the PV simulator and set them as variable before starting the others):
+
+    1. :meth:`start` / :meth:`start_all` the simulators,
+    2. :meth:`create_entities`,
+    3. :meth:`connect` them,
+    4. :meth:`connect_results` to a database.
+
+    :param variables: values of the variables of the scenario, may be extended until they are used (dict)
+    :param checkpoints: init params of the simulators with ``"checkpoint": true`` (dict)
+    :param cache_dir: directory of the cached plans, None to compile every time (string or pathlib.Path)
+    '''
+
+    def __init__(self, world, spec, variables, checkpoints=None, cache_dir=None):
+        self.world = world
+        self.spec = spec
+        self.variables = variables
+        self.checkpoints = checkpoints or {}
+        self.cache_dir = cache_dir
+        self.sims = {}  # name -> model factory
+        self.sids = {}  # name -> simulator ID
+        self.groups = {}
+
+    def start(self, name, **params):
+        '''
+        Start the simulator *name* of the scenario with its params and *params*.
+
+        :return: model factory of the simulator
+        '''
+        entry = self.spec['simulators'][name]
+        params = dict(resolve(entry.get('params', {}), self.variables), **params)
+        if entry.get('checkpoint'):
+            params.update(self.checkpoints)
+        started = set(self.world.sims)
+        self.sims[name] = self.world.start(entry['sim'], **params)
+        self.sids[name] = (set(self.world.sims) - started).pop()
+        return self.sims[name]
+
+    def start_all(self):
+        '''
+        Start the simulators that are not started yet, in the order of the scenario.
+        '''
+        for name in self.spec.get('simulators', {}):
+            if name not in self.sims:
+                self.start(name)
+        return self.sims
+
+    def stateful(self):
+        '''
+        Return the IDs of the started simulators that save checkpoints (list).
+        '''
+        return [self.sids[name] for name, entry in self.spec['simulators'].items()
+                if entry.get('checkpoint') and name in self.sids]
+
+    def count(self, name):
+        '''
+        Return the number of entities of the group *name* before they are created, 0 if there is no such group.
+        '''
+        entry = self.spec.get('entities', {}).get(name)
+        return int(resolve(entry.get('count', 1), self.variables)) if entry else 0
+
+    def create_entities(self):
+        '''
+        Create the entities of all groups.
+
+        :return: {group: entities} (dict)
+        '''
+        for name, entry in self.spec.get('entities', {}).items():
+            entry = resolve(entry, self.variables)
+            count = int(entry.get('count', 1))
+            logger.info('Creating %d %s (%s) ...', count, name, entry['model'])
+            entities = getattr(self.sims[entry['sim']], entry['model']).create(count, **entry.get('params', {}))
+            self.groups[name] = entities
+            if entry.get('children'):
+                index = GridIndex(child for entity in entities for child in entity.children)
+                for child, types in entry['children'].items():
+                    self.groups[child] = index.of_type(*types)
+        return self.groups
+
+    def connect(self):
+        '''
+        Connect the entities as planned and add the derived groups.
+
+        :return: {group: entities} (dict)
+        '''
+        connections = resolve(self.spec.get('connections', []), self.variables)
+        derived = self.spec.get('groups', {})
+        sizes = {name: len(entities) for name, entities in self.groups.items()}
+        plan, cached = load_plan(connections, derived, sizes, self.cache_dir)
+        logger.info('%s connection plan (%d connections)', 'Cached' if cached else 'Compiled',
+                    sum(len(conn['src']) for conn in plan['connections']))
+
+        for conn in plan['connections']:
+            src, dest = self.groups[conn['from']], self.groups[conn['to']]
+            attrs = [a if isinstance(a, str) else tuple(a) for a in conn['attrs']]
+            connect_pairs(self.world, [(src[i], dest[j]) for i, j in zip(conn['src'], conn['dest'])], *attrs,
+                          **conn['options'])
+        for name, group in plan['groups'].items():
+            entities = self.groups[group['of']]
+            self.groups[name] = [entities[i] for i in group['indices']]
+        return self.groups
+
+    def connect_results(self, db, record=None):
+        '''
+        Connect the recorded attributes of the entities of the result groups to the database entity *db*.
+
+        :param record: {entity type: {'attrs': [...]}}, default: "record" of "results" (dict)
+        '''
+        results = resolve(self.spec.get('results', {}), self.variables)
+        record = results.get('record', {}) if record is None else record
+        by_type = {}
+        for name in results.get('groups', []):
+            for entity in self.groups.get(name, []):
+                by_type.setdefault(entity.type, {})[entity.full_id] = entity  # Once if in several groups
+        for etype, entities in by_type.items():
+            if etype in record:
+                connect_many_to_one(self.world, list(entities.values()), db, *record[etype]['attrs'])
+
+
+def load_scenario(world, path, variables, checkpoints=None, cache=True):
+    '''
+    Return a :class:`Scenario` for the scenario file *path*, caching its plans next to it if *cache*.
+    '''
+    path = pathlib.Path(path)
+    cache_dir = pathlib.Path(path.parent, CACHE_DIR_NAME) if cache else None
+    return Scenario(world, load_spec(path), variables, checkpoints, cache_dir)
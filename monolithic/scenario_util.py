@@ -0,0 +1,106 @@
+'''
+Helpers for building large scenarios.
+
+``world.connect()`` validates and classifies every single connection, which
+makes wiring thousands of entities slow. The functions in this module create
+the same data flows as repeated ``world.connect()`` calls, but do the checks
+only once per group of connections between the same simulators and models.
+
+They rely on the internals of the pinned mosaik version (see requirements.txt).
+'''
+import logging
+from collections import defaultdict
+
+from mosaik.simmanager import FULL_ID
+from mosaik.exceptions import ScenarioError
+
+
+logger = logging.getLogger('scenario_util')
+
+
+def connect_pairs(world, pairs, *attr_pairs, async_requests=False, time_shifted=False, initial_data={}, weak=False):
+    '''
+    Connect every ``(src, dest)`` entity pair in *pairs* with the same
+    *attr_pairs*. The result is the same as calling ``world.connect()`` for
+    each pair with the given arguments.
+
+    :param world: mosaik world (mosaik.World)
+    :param pairs: (src, dest) tuples of entities (iterable)
+    :param attr_pairs: attribute names or (src_attr, dest_attr) tuples
+    :return: number of connections created (int)
+    '''
+    groups = defaultdict(list)
+    for src, dest in pairs:
+        groups[(src.sid, src.type, dest.sid, dest.type)].append((src, dest))
+
+    attr_pairs = tuple((a, a) if type(a) is str else a for a in attr_pairs)
+    outattr = [a[0] for a in attr_pairs]
+    count = 0
+
+    for (src_sid, src_type, dest_sid, dest_type), group in groups.items():
+        # The first connection of a group goes through mosaik and does all the
+        # checks, the others only repeat its bookkeeping.
+        first_src, first_dest = group[0]
+        world.connect(first_src, first_dest, *attr_pairs, async_requests=async_requests, time_shifted=time_shifted,
+                      initial_data=initial_data, weak=weak)
+        rest = group[1:]
+        count += len(group)
+        logger.info('Connected %d %s entities to %s (%s)', len(group), src_type, dest_type,
+                    ', '.join('%s->%s' % a for a in attr_pairs))
+        if not rest:
+            continue
+
+        if world._df_cache is not None:
+            _, cached, time_buffered, memorized, persistent = \
+                world._classify_connections_with_cache(first_src, first_dest, attr_pairs)
+        else:
+            _, time_buffered, memorized, persistent = \
+                world._classify_connections_without_cache(first_src, first_dest, attr_pairs)
+            cached = ()
+
+        edge = world.df_graph[src_sid][dest_sid]
+        dataflows = edge['dataflows']
+        cached_connections = edge['cached_connections']
+        df_outattr = world._df_outattr[src_sid]
+        src_sim = first_src.sim
+        dest_sim = first_dest.sim
+
+        for src, dest in rest:
+            src_full_id = FULL_ID % (src.sid, src.eid)
+            dataflows.append((src.eid, dest.eid, attr_pairs))
+            if cached:
+                cached_connections.append((src.eid, dest.eid, cached))
+            if outattr:
+                df_outattr[src.eid].extend(outattr)
+
+            if time_shifted and world._df_cache is not None:
+                init_cache = world._df_cache[-1].setdefault(src.sid, {}).setdefault(src.eid, {})
+                init_cache.update(initial_data)
+
+            for src_attr, dest_attr in time_buffered:
+                src_sim.buffered_output.setdefault((src.eid, src_attr), []).append(
+                    (dest.sid, dest.eid, dest_attr))
+
+            if weak:
+                for src_attr, dest_attr in persistent:
+                    if src_attr not in initial_data:
+                        raise ScenarioError('Weak connections of persistent attributes have to be set with default '
+                                            'inputs for the first step. {} is missing.'.format(src_attr))
+                    dest_sim.input_buffer.setdefault(dest.eid, {}).setdefault(
+                        dest_attr, {})[src_full_id] = initial_data[src_attr]
+
+            for src_attr, dest_attr in memorized:
+                init_val = initial_data[src_attr] if weak else None
+                dest_sim.input_memory.setdefault(dest.eid, {}).setdefault(
+                    dest_attr, {})[src_full_id] = init_val
+
+        world.entity_graph.add_edges_from((src.full_id, dest.full_id) for src, dest in rest)
+
+    return count
+
+
+def connect_many_to_one(world, src_set, dest, *attrs, **kwargs):
+    '''
+    Batched version of ``mosaik.util.connect_many_to_one()``.
+    '''
+    return connect_pairs(world, ((src, dest) for src in src_set), *attrs, **kwargs)
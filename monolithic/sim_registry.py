@@ -0,0 +1,345 @@
+'''
+SQLite registry of the simulations of a simulation setup.
+
+Source of truth for the simulations instead of the ``sim_ids_up``/
+``sim_ids_down`` lists in ``mosaik-docker.json``: every simulation is one row
+with its status, timestamps and the resources (CPU set, host ports) assigned
+to it. IDs are indexed, and reservations run in ``BEGIN IMMEDIATE``
+transactions, so concurrent launchers neither lose each other's entries nor
+get the same CPUs or ports.
+
+The registry file lives next to ``mosaik-docker.json``. For mosaik-docker's
+own tools (``get_sim_ids``, ``get_sim_status``, ``cancel_sim``, ``clear_sim``,
+``get_sim_results``) and the JupyterLab extension, :meth:`SimRegistry.sync`
+writes the simulations that are up or down to the lists of the config file
+and takes over the changes these tools made to them (simulations started,
+cancelled or cleared). It runs once at the end of every batch of launches
+(see start_sim.py) and with ``--sync``, not on every status change: the
+config file is a single JSON document that these tools rewrite without
+locking.
+'''
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+
+from mosaik_docker.util.config_data import ConfigData
+from mosaik_docker.util.execute import execute_and_capture_output
+
+from sim_resources import parse_cpuset
+
+
+# Docker CLI to use, can be replaced by a stand-in with the same interface (e.g. for testing).
+DOCKER = os.environ.get('DOCKER', 'docker')
+REGISTRY_FILE_NAME = 'mosaik-sims.sqlite'
+BUSY_TIMEOUT = 60  # Seconds to wait for other writers
+STARTING_TIMEOUT = 900  # Seconds after which a simulation that is still starting without a container has failed
+
+STARTING = 'starting'
+UP = 'up'
+DOWN = 'down'
+FAILED = 'failed'
+STATUSES = (STARTING, UP, DOWN, FAILED)
+ACTIVE = (STARTING, UP)  # Simulations that hold their resources
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sims (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    cpuset TEXT,
+    cpus INTEGER,
+    ports TEXT,
+    listed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sims_status ON sims (status);
+'''
+
+
+class SimRegistry:
+    '''
+    Registry of the simulations of one simulation setup.
+
+    :param path: registry file (string or pathlib.Path)
+    :param setup_dir: simulation setup whose config lists are kept in sync, None for none (string)
+    '''
+
+    def __init__(self, path, setup_dir=None):
+        self.path = pathlib.Path(path)
+        self.setup_dir = setup_dir
+        self.db = sqlite3.connect(str(self.path), timeout=BUSY_TIMEOUT, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        columns = {row['name'] for row in self.db.execute('PRAGMA table_info(sims)')}
+        if 'listed' not in columns:  # Registry created before the config lists were kept in sync
+            self.db.execute('ALTER TABLE sims ADD COLUMN listed INTEGER NOT NULL DEFAULT 0')
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Exclusive write transaction, committed on success and rolled back on errors.
+        '''
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def reserve(self, ids, allocate):
+        '''
+        Atomically register the simulations *ids* with status 'starting' and the resources returned by *allocate*.
+
+        :param ids: simulation IDs (list of strings)
+        :param allocate: called with the CPUs and ports of all active simulations (two sets), returns
+            {id: {'cpuset': string, 'cpus': int, 'ports': {container port: host port}}} (callable)
+        :return: the assignments returned by *allocate* (dict)
+        :raise RuntimeError: if one of the IDs has already been used
+        '''
+        with self.transaction() as db:
+            for id in ids:
+                if db.execute('SELECT 1 FROM sims WHERE id = ?', (id,)).fetchone() is not None:
+                    raise RuntimeError('Simulation ID \'{}\' has already been used'.format(id))
+
+            used_cpus = set()
+            used_ports = set()
+            query = 'SELECT cpuset, ports FROM sims WHERE status IN ({})'.format(','.join('?' * len(ACTIVE)))
+            for row in db.execute(query, ACTIVE):
+                used_cpus.update(parse_cpuset(row['cpuset'] or ''))
+                used_ports.update(json.loads(row['ports'] or '{}').values())
+
+            assignments = allocate(used_cpus, used_ports)
+            now = time.time()
+            db.executemany(
+                'INSERT INTO sims (id, status, created, updated, cpuset, cpus, ports) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(id, STARTING, now, now, assignments[id]['cpuset'], assignments[id]['cpus'],
+                  json.dumps(assignments[id]['ports'])) for id in ids]
+            )
+        return assignments
+
+    def add(self, ids, status, resources=None):
+        '''
+        Register the simulations *ids* with *status*. Already registered IDs are ignored.
+
+        :param resources: {id: {'cpuset', 'cpus', 'ports'}} for simulations that have resources assigned (dict)
+        '''
+        with self.transaction() as db:
+            self._insert(db, ids, status, resources)
+
+    def _insert(self, db, ids, status, resources=None):
+        resources = resources or {}
+        now = time.time()
+        rows = []
+        for id in ids:
+            entry = resources.get(id, {})
+            rows.append((id, status, now, now, entry.get('cpuset'), entry.get('cpus'),
+                         json.dumps(entry['ports']) if 'ports' in entry else None))
+        db.executemany(
+            'INSERT OR IGNORE INTO sims (id, status, created, updated, cpuset, cpus, ports) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def set_status(self, ids, status):
+        '''
+        Set the status of the simulations *ids*.
+        '''
+        if status not in STATUSES:
+            raise ValueError('Unknown status "{}", expected one of {}'.format(status, STATUSES))
+        now = time.time()
+        with self.transaction() as db:
+            db.executemany('UPDATE sims SET status = ?, updated = ? WHERE id = ?', [(status, now, id) for id in ids])
+
+    def sync(self):
+        '''
+        Take over the changes mosaik-docker's tools made to the 'sim_ids_up' and 'sim_ids_down' lists of the setup
+        config, then write the simulations that are up and down to the lists (only if they changed). Runs in one
+        transaction, so that launchers do not overwrite each other's lists.
+        '''
+        if self.setup_dir is None:
+            return
+        with self.transaction() as db:
+            config_data = ConfigData(self.setup_dir)
+            up = list(config_data['sim_ids_up']) if 'sim_ids_up' in config_data else []
+            down = list(config_data['sim_ids_down']) if 'sim_ids_down' in config_data else []
+            up_set, down_set = set(up), set(down)
+            now = time.time()
+            rows = {row['id']: row for row in db.execute('SELECT id, status, listed FROM sims')}
+            for id, row in rows.items():
+                if id in down_set and row['status'] in ACTIVE:
+                    # Stopped with cancel_sim, or found stopped by get_sim_status
+                    db.execute('UPDATE sims SET status = ?, updated = ? WHERE id = ?', (DOWN, now, id))
+                elif row['listed'] and id not in up_set and id not in down_set:
+                    # Removed with clear_sim
+                    db.execute('DELETE FROM sims WHERE id = ?', (id,))
+            # Started with mosaik-docker's start_sim, or listed before the registry was created (with the resources the
+            # config recorded then)
+            resources = config_data['sim_resources'] if 'sim_resources' in config_data else {}
+            self._insert(db, [id for id in up if id not in rows], UP, resources)
+            self._insert(db, [id for id in down if id not in rows], DOWN, resources)
+
+            db.execute('UPDATE sims SET listed = status IN (?, ?)', (UP, DOWN))
+            query = 'SELECT id FROM sims WHERE status = ? ORDER BY created, id'
+            ids_up = [row[0] for row in db.execute(query, (UP,))]
+            ids_down = [row[0] for row in db.execute(query, (DOWN,))]
+            if ids_up != up or ids_down != down:
+                config_data['sim_ids_up'] = ids_up
+                config_data['sim_ids_down'] = ids_down
+                config_data.write()
+
+    def ids(self, *statuses):
+        '''
+        Return the IDs of all simulations with one of *statuses* (default: all), oldest first.
+        '''
+        if not statuses:
+            return [row[0] for row in self.db.execute('SELECT id FROM sims ORDER BY created, id')]
+        query = 'SELECT id FROM sims WHERE status IN ({}) ORDER BY created, id'.format(','.join('?' * len(statuses)))
+        return [row[0] for row in self.db.execute(query, statuses)]
+
+    def get(self, id):
+        '''
+        Return the entry of simulation *id* or None.
+
+        :return: {'id', 'status', 'created', 'updated', 'cpuset', 'cpus', 'ports', 'listed'} (dict)
+        '''
+        row = self.db.execute('SELECT * FROM sims WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['ports'] = json.loads(entry['ports'] or '{}')
+        return entry
+
+    def __contains__(self, id):
+        return self.db.execute('SELECT 1 FROM sims WHERE id = ?', (id,)).fetchone() is not None
+
+    def counts(self):
+        '''
+        Return the number of simulations per status (dict).
+        '''
+        return dict(self.db.execute('SELECT status, COUNT(*) FROM sims GROUP BY status').fetchall())
+
+    def refresh(self, docker=DOCKER, starting_timeout=STARTING_TIMEOUT):
+        '''
+        Mark simulations that are up but whose containers are not running anymore as 'down', and simulations that have
+        been starting for more than *starting_timeout* seconds without a running container as 'failed' (their launcher
+        exited before it recorded the result), so that their resources are released.
+
+        :return: IDs of the simulations that went down or failed (list)
+        '''
+        out = execute_and_capture_output([
+            docker, 'ps',  # List containers.
+            '--no-trunc',  # Do not truncate output.
+            '--filter', 'status=running',  # Only running containers.
+            '--format', '{{.Names}}'  # Only output container names.
+        ])
+        running = set(out.split('\n'))
+        cutoff = time.time() - starting_timeout
+        with self.transaction() as db:
+            stopped = [row[0] for row in db.execute('SELECT id FROM sims WHERE status = ?', (UP,))
+                       if row[0] not in running]
+            abandoned = [row[0] for row in db.execute('SELECT id FROM sims WHERE status = ? AND updated < ?',
+                                                      (STARTING, cutoff))
+                         if row[0] not in running]
+            now = time.time()
+            db.executemany('UPDATE sims SET status = ?, updated = ? WHERE id = ?',
+                           [(DOWN, now, id) for id in stopped] + [(FAILED, now, id) for id in abandoned])
+        return stopped + abandoned
+
+
+def open_registry(setup_dir):
+    '''
+    Open the registry of the simulation setup in *setup_dir*. Call
+    :meth:`SimRegistry.sync` to reconcile it with the lists of the setup
+    config.
+
+    :param setup_dir: path to simulation setup (string)
+    :return: registry (SimRegistry)
+    '''
+    config_data = ConfigData(setup_dir)
+    return SimRegistry(pathlib.Path(config_data.path.parent, REGISTRY_FILE_NAME), setup_dir)
+
+
+def main():
+    import argparse
+
+    # Command line parser.
+    parser = argparse.ArgumentParser(
+        description='List the simulations of a simulation setup.'
+    )
+
+    parser.add_argument(
+        'setup_dir',
+        nargs='?',
+        default='.',
+        metavar='SETUP_DIR',
+        help='path to simulation setup directory (default: current working directory)'
+    )
+
+    parser.add_argument(
+        '--status',
+        choices=STATUSES,
+        action='append',
+        help='only list simulations with this status (can be repeated)'
+    )
+
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='mark simulations whose containers have stopped as down and abandoned starts as failed first'
+    )
+
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        help='reconcile the registry with the simulation lists of mosaik-docker.json first (after --refresh)'
+    )
+
+    parser.add_argument(
+        '--docker',
+        default=DOCKER,
+        metavar='DOCKER',
+        help='Docker CLI executable (default: $DOCKER or "docker")'
+    )
+
+    args = parser.parse_args()
+
+    try:
+        with open_registry(args.setup_dir) as registry:
+            if args.refresh:
+                registry.refresh(args.docker)
+            if args.sync:
+                registry.sync()
+            for id in registry.ids(*(args.status or ())):
+                entry = registry.get(id)
+                print('{id}\t{status}\t{created}\t{cpuset}\t{ports}'.format(
+                    id=id,
+                    status=entry['status'],
+                    created=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['created'])),
+                    cpuset=entry['cpuset'] or '-',
+                    ports=' '.join('{}:{}'.format(h, c) for c, h in entry['ports'].items()) or '-',
+                ))
+        sys.exit(0)
+
+    except Exception as err:
+
+        print(str(err))
+        sys.exit(3)
+
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\.pyw|\.exe)?$', '', sys.argv[0])
+    sys.exit(main())
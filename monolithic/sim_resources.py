@@ -0,0 +1,168 @@
+'''
+Allocation of host resources (CPU sets and ports) for concurrent simulations.
+
+CPUs are taken from the CPUs this process may run on and ordered by the
+machine's topology (``/sys/devices/system/cpu``): sets of one CPU are spread
+over the physical cores first, larger sets are filled with hyper-threads of
+the same core. Ports are free TCP ports picked by the operating system.
+Listening ports are read from ``/proc/net/tcp``, without connecting to them.
+'''
+import multiprocessing
+import os
+import pathlib
+import socket
+from collections import defaultdict
+
+
+SYS_CPU_DIR = '/sys/devices/system/cpu'
+PROC_NET_TCP = ('/proc/net/tcp', '/proc/net/tcp6')
+TCP_LISTEN = '0A'  # State of listening sockets in /proc/net/tcp
+
+
+def parse_cpuset(cpuset):
+    '''
+    Parse a CPU list like '0-3,8' (as used by ``--cpuset-cpus``).
+
+    :param cpuset: CPU list (string)
+    :return: CPU numbers (set of ints)
+    '''
+    cpus = set()
+    for part in str(cpuset).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpuset(cpus):
+    '''
+    Format CPU numbers as CPU list for ``--cpuset-cpus``, e.g. [0, 1, 2, 8] -> '0-2,8'.
+    '''
+    parts = []
+    for cpu in sorted(cpus):
+        if parts and parts[-1][1] == cpu - 1:
+            parts[-1][1] = cpu
+        else:
+            parts.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in parts)
+
+
+def available_cpus():
+    '''
+    Return the CPUs this process may run on (sorted list of ints).
+    '''
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return list(range(multiprocessing.cpu_count()))
+
+
+def cpu_topology(cpus=None):
+    '''
+    Group *cpus* (default: all available CPUs) by physical core.
+
+    :return: list of CPU lists, one per core, ordered by package and core ID
+    '''
+    cores = defaultdict(list)
+    for cpu in cpus if cpus is not None else available_cpus():
+        topology = pathlib.Path(SYS_CPU_DIR, 'cpu{}'.format(cpu), 'topology')
+        try:
+            key = (int((topology / 'physical_package_id').read_text()), int((topology / 'core_id').read_text()))
+        except (OSError, ValueError):
+            key = (0, cpu)  # No topology information, treat every CPU as a core of its own
+        cores[key].append(cpu)
+    return [sorted(cores[key]) for key in sorted(cores)]
+
+
+def allocate_cpusets(count, cpus_per_set=1, exclude=(), cpus=None):
+    '''
+    Allocate *count* disjoint CPU sets of *cpus_per_set* CPUs each.
+
+    :param count: number of CPU sets (int)
+    :param cpus_per_set: CPUs per set (int)
+    :param exclude: CPUs that are already in use (iterable of ints)
+    :param cpus: CPUs to allocate from (default: all available CPUs)
+    :return: CPU lists (list of strings, see :func:`format_cpuset`)
+    :raise ValueError: if *count* or *cpus_per_set* is less than 1
+    :raise RuntimeError: if there are not enough free CPUs
+    '''
+    if count < 1 or cpus_per_set < 1:
+        raise ValueError('Need at least one CPU set of at least one CPU, got {} of {}'.format(count, cpus_per_set))
+    exclude = set(exclude)
+    # Untouched cores first, so that no set shares a core with a running simulation while there are idle cores
+    # (sorting is stable and keeps the topology order otherwise).
+    topology = sorted(cpu_topology(cpus), key=lambda core: sum(cpu in exclude for cpu in core))
+    cores = [[cpu for cpu in core if cpu not in exclude] for core in topology]
+    cores = [core for core in cores if core]
+    if cpus_per_set == 1:
+        # One thread of every core before using the hyper-threads.
+        depth = max((len(core) for core in cores), default=0)
+        order = [core[i] for i in range(depth) for core in cores if i < len(core)]
+    else:
+        order = [cpu for core in cores for cpu in core]
+
+    needed = count * cpus_per_set
+    if needed > len(order):
+        raise RuntimeError('Cannot allocate {} CPU sets of {} CPUs, only {} free CPUs'.format(
+            count, cpus_per_set, len(order)))
+    return [format_cpuset(order[i:i + cpus_per_set]) for i in range(0, needed, cpus_per_set)]
+
+
+def free_ports(count, exclude=(), host=''):
+    '''
+    Return *count* distinct TCP ports that are currently free on *host*.
+
+    The ports are only reserved until this function returns, so they should be
+    bound soon after.
+
+    :param exclude: ports that must not be used, e.g. ports assigned to simulations that are not running yet
+    :return: port numbers (list of ints)
+    '''
+    exclude = set(exclude)
+    sockets = []
+    ports = []
+    try:
+        while len(ports) < count:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(sock)
+            sock.bind((host, 0))
+            port = sock.getsockname()[1]
+            if port not in exclude:
+                ports.append(port)
+    finally:
+        for sock in sockets:
+            sock.close()
+    return ports
+
+
+def parse_listening(text):
+    '''
+    Return the ports of the listening sockets in *text*, the contents of ``/proc/net/tcp`` or ``/proc/net/tcp6``.
+
+    :return: port numbers (set of ints)
+    '''
+    ports = set()
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) > 3 and fields[3] == TCP_LISTEN:
+            ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+    return ports
+
+
+def listening_ports():
+    '''
+    Return the TCP ports that are listening on this host (in this network namespace).
+
+    Simulators started with ``--remote`` accept only one connection, so readiness is checked this way instead of
+    connecting to them.
+    '''
+    ports = set()
+    for path in PROC_NET_TCP:
+        try:
+            with open(path) as f:
+                ports |= parse_listening(f.read())
+        except OSError:
+            pass
+    return ports
@@ -0,0 +1,235 @@
+'''
+Parallel simulator startup with readiness probes.
+
+mosaik starts the simulators one by one, in ``world.start()``: a simulator
+with a ``'cmd'`` (e.g. WebVis) is spawned only then, and mosaik waits for the
+new process to connect back, while a ``'connect'`` simulator gets exactly one
+connection attempt, which fails if the simulator is still starting (e.g. its
+container or the process launched next to the orchestrator is not listening
+yet).
+
+:func:`prestart` does both before the scenario is built, in parallel:
+
+* ``'cmd'`` simulators are spawned right away with ``--remote``, listening on
+  a free local port, so that they start up while the scenario is created,
+* the pre-spawned and the ``'connect'`` simulators are connected to in
+  background threads, retrying with exponential backoff (:func:`backoff`)
+  until they accept or READY_TIMEOUT has passed.
+
+Connecting is the readiness probe: the simulators accept only one connection,
+so a separate probe would use it up. The established connections are handed
+to mosaik by the starter :func:`start_ready`, which makes the ``init()`` call
+on them when the scenario calls ``world.start()``. The pre-spawned processes
+are stopped by mosaik at the end of the run like the ones it spawns itself.
+
+Like rpc_batch.py, this relies on the internals of the pinned mosaik version
+(see requirements.txt).
+'''
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sim_resources import free_ports
+
+
+logger = logging.getLogger('sim_startup')
+
+STARTER = 'ready'  # Key of the starter of pre-started simulators in the sim config
+READY_TIMEOUT = 60  # Seconds to wait for a simulator to accept the connection
+BACKOFF_INITIAL = 0.01  # First delay between connection attempts [s]
+BACKOFF_MAX = 0.1  # Longest delay, bounds how late a simulator is seen ready [s]
+CONNECT_TIMEOUT = 5  # Timeout of one connection attempt [s]
+MAX_PACKET_SIZE = 10 * 1024 * 1024  # Like mosaik
+
+
+def backoff(timeout, initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX, factor=2):
+    '''
+    Yield the delays of an exponential backoff, doubling from *initial* up to *maximum*, until *timeout* seconds
+    have passed.
+    '''
+    deadline = time.monotonic() + timeout
+    delay = initial
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield min(delay, remaining)
+        delay = min(delay * factor, maximum)
+
+
+def connect(addr, timeout=READY_TIMEOUT, proc=None):
+    '''
+    Connect to the simulator listening on *addr* ((host, port)), retrying with backoff while it is not ready.
+
+    :param proc: process of the simulator (subprocess.Popen), to give up as soon as it exits
+    :return: connected socket
+    :raise OSError: if the simulator did not accept within *timeout* seconds or its process exited
+    '''
+    delays = backoff(timeout)
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            sock = socket.create_connection(addr, timeout=CONNECT_TIMEOUT)
+            sock.settimeout(None)
+            return sock
+        except OSError as err:  # Refused, or the host name of a container that is not up yet is unknown
+            error = err
+        if proc is not None and proc.poll() is not None:
+            raise OSError('Process exited with code {} before listening on {}:{}'.format(proc.returncode, *addr))
+        delay = next(delays, None)
+        if delay is None:
+            raise OSError('Not ready after {} s ({} attempts) on {}:{}: {}'.format(timeout, attempts, *addr, error))
+        time.sleep(delay)
+
+
+def parse_addr(addr):
+    host, port = addr.strip().rsplit(':', 1)
+    return host, int(port)
+
+
+def spawn(name, entry, host='127.0.0.1'):
+    '''
+    Spawn the ``'cmd'`` simulator *name* of the sim config *entry* listening on a free port of *host*.
+
+    :return: tuple of (process (subprocess.Popen), (host, port))
+    '''
+    port = free_ports(1, host=host)[0]
+    cmd = entry['cmd'] % {'addr': '{}:{}'.format(host, port), 'python': sys.executable}
+    env = dict(os.environ, **entry.get('env', {}))
+    proc = subprocess.Popen(shlex.split(cmd, posix=(os.name != 'nt')) + ['--remote'], cwd=entry.get('cwd', '.'),
+                            env=env, bufsize=1, universal_newlines=True)
+    logger.info('Pre-spawned %s (pid %d) on %s:%d', name, proc.pid, host, port)
+    return proc, (host, port)
+
+
+class Pending:
+    '''
+    Connection to a pre-started simulator that is being established in the background.
+    '''
+
+    def __init__(self, name, future, proc=None):
+        self.name = name
+        self.future = future
+        self.proc = proc
+        self.used = False
+
+    def result(self):
+        self.used = True
+        return self.future.result()
+
+    def discard(self):
+        '''
+        Close the connection and stop the process if the simulator was not started.
+        '''
+        if self.used:
+            return
+        self.used = True
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+        if not self.future.cancel():  # Connected or still trying
+            self.future.add_done_callback(lambda future: future.exception() is None and future.result().close())
+
+
+class Startup:
+    '''
+    The simulators pre-started by :func:`prestart`. Use as context manager around building the scenario, so that
+    the simulators it did not start are closed.
+    '''
+
+    def __init__(self, pending, executor):
+        self.pending = pending  # name -> Pending
+        self._executor = executor
+
+    def close(self):
+        for pending in self.pending.values():
+            pending.discard()
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def prestart(sim_config, names, timeout=READY_TIMEOUT):
+    '''
+    Pre-spawn the ``'cmd'`` simulators among *names* and connect to them and to the ``'connect'`` simulators among
+    *names* in the background.
+
+    :param sim_config: mosaik sim config, with one way to start every simulator (see main.get_sim_config())
+    :param names: simulators the scenario starts once each (iterable of strings)
+    :return: tuple of (sim config for the world, :class:`Startup`)
+    '''
+    from mosaik.simmanager import StarterCollection
+
+    StarterCollection()[STARTER] = start_ready
+    names = [name for name in dict.fromkeys(names)
+             if name in sim_config and ('cmd' in sim_config[name] or 'connect' in sim_config[name])
+             and 'python' not in sim_config[name]]
+    config = dict(sim_config)
+    executor = ThreadPoolExecutor(max_workers=max(len(names), 1), thread_name_prefix='prestart')
+    pending = {}
+    for name in names:
+        entry = sim_config[name]
+        proc = None
+        if 'cmd' in entry:
+            proc, addr = spawn(name, entry)
+        else:
+            addr = parse_addr(entry['connect'])
+        pending[name] = Pending(name, executor.submit(connect, addr, timeout, proc), proc)
+        config[name] = {STARTER: pending[name], 'fallback': entry}
+    return config, Startup(pending, executor)
+
+
+def start_ready(world, sim_name, sim_config, sim_id, time_resolution, sim_params):
+    '''
+    mosaik starter of the simulators of :func:`prestart`: wait for the connection and make the ``init()`` call.
+
+    :return: proxy of the simulator (mosaik.simmanager.RemoteProcess)
+    '''
+    from mosaik.exceptions import SimulationError
+    from mosaik.simmanager import RemoteProcess, StarterCollection
+    from mosaik.util import sync_process
+    from simpy.io import select as backend
+    from simpy.io.json import JSON as JSON_RPC
+    from simpy.io.packet import PacketUTF8 as Packet
+
+    pending = sim_config[STARTER]
+    if pending.used:
+        # Started again: start the next instance the usual way
+        fallback = sim_config['fallback']
+        kind = next(kind for kind in StarterCollection() if kind in fallback)
+        return StarterCollection()[kind](world, sim_name, fallback, sim_id, time_resolution, sim_params)
+    t0 = time.perf_counter()
+    try:
+        sock = pending.result()
+    except OSError as err:
+        if pending.proc is not None:
+            pending.proc.kill()
+            pending.proc.wait()
+        raise SimulationError('Simulator "%s" could not be started: %s' % (sim_name, err)) from None
+    waited = time.perf_counter() - t0
+    if waited > 0.01:
+        logger.info('Waited %.2f s for %s', waited, sim_name)
+    start_timeout = world.env.timeout(world.config['start_timeout'])
+
+    def greeter():
+        rpc_con = JSON_RPC(Packet(backend.TCPSocket(world.env, sock), max_packet_size=MAX_PACKET_SIZE))
+        init = rpc_con.remote.init(sim_id, time_resolution=time_resolution, **sim_params)
+        try:
+            results = yield init | start_timeout
+        except ConnectionError as e:
+            raise SimulationError('Simulator "%s" closed its connection during the init() call.' % sim_name, e)
+        if start_timeout in results:
+            raise SimulationError('Simulator "%s" did not reply to the init() call in time.' % sim_name)
+        return RemoteProcess(sim_name, sim_id, results[init], pending.proc, rpc_con, world)
+
+    return sync_process(greeter(), world)
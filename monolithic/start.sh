@@ -1,6 +1,44 @@
 #!/bin/sh
 
+# Starts the container server and, once it listens on SERVER_PORT, the TaskSimulator that puts load on it. The
+# container runs as long as the server; if the server does not come up, the script exits with an error instead of
+# leaving the container half started.
+
 echo "running start.sh file"
 
+SERVER_PORT=${SERVER_PORT:-5567}
+READY_TIMEOUT=${READY_TIMEOUT:-60}  # Seconds to wait for the server to listen
+
+# True if a socket listens on TCP port $1, read from /proc/net like sim_resources.py (a probe connection would count
+# as a client of the server)
+listening() {
+    grep -Eqi "^ *[0-9]+: [0-9A-F]+:$(printf '%04X' "$1") [0-9A-F]+:0000 0A " /proc/net/tcp /proc/net/tcp6 2>/dev/null
+}
+
+java -jar server.jar "$SERVER_PORT" &
+server=$!
+
+# Exponential backoff from 0.05 s to 1 s
+delay=5
+start=$(date +%s)
+until listening "$SERVER_PORT"; do
+    if ! kill -0 "$server" 2>/dev/null; then
+        wait "$server"
+        status=$?
+        echo "server exited with code $status before listening on port $SERVER_PORT"
+        exit "$status"
+    fi
+    if [ $(($(date +%s) - start)) -ge "$READY_TIMEOUT" ]; then
+        echo "server not listening on port $SERVER_PORT after $READY_TIMEOUT s"
+        kill "$server"
+        exit 1
+    fi
+    sleep "$((delay / 100)).$(printf '%02d' $((delay % 100)))"
+    delay=$((delay * 2 > 100 ? 100 : delay * 2))
+done
+echo "server listening on port $SERVER_PORT"
+
 java -cp app.jar org.example.TaskSimulator 180 &
-java -jar server.jar 5567
\ No newline at end of file
+
+# The container runs as long as the server
+wait "$server"
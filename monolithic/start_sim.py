@@ -1,19 +1,32 @@
 import json
+import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from mosaik_docker._config import ORCH_IMAGE_NAME_TEMPLATE
 from mosaik_docker.util.config_data import ConfigData
 from mosaik_docker.util.create_unique_id import create_unique_id
 from mosaik_docker.util.execute import execute
 
+from sim_registry import FAILED, UP, open_registry
+from sim_resources import allocate_cpusets, free_ports
 
-def start_sim(setup_dir, id=None):
+
+# Docker CLI to use, can be replaced by a stand-in with the same interface (e.g. for testing).
+DOCKER = os.environ.get('DOCKER', 'docker')
+# Ports the orchestrator listens on inside the container. Each is published on a free host port.
+CONTAINER_PORTS = [5567]  # <-- Yazan
+
+
+def start_sim(setup_dir, id=None, cpus_per_sim=1, docker=DOCKER):
     '''
     Start a new simulation.
 
     :param setup_dir: path to simulation setup (string)
     :param id: ID of new simulation (string, default: None)
+    :param cpus_per_sim: number of CPUs the simulation gets (int, default: 1)
+    :param docker: Docker CLI executable (string)
     :return: on success, return new simulation ID (int)
     '''
 
@@ -22,8 +35,32 @@ def start_sim(setup_dir, id=None):
     if not id == None and not isinstance(id, str):
         raise TypeError('Parameter \'id\' must be of type \'str\'')
 
-    if id == None:
-        id = 'mosaik_container_' + create_unique_id()
+    return start_sims(setup_dir, 1, ids=None if id is None else [id], cpus_per_sim=cpus_per_sim, docker=docker)[0]
+
+
+def start_sims(setup_dir, count, ids=None, cpus_per_sim=1, docker=DOCKER):
+    '''
+    Start *count* simulations concurrently.
+
+    Every simulation gets its own CPU set and its own host ports for the ports in CONTAINER_PORTS, both chosen among
+    the resources that are not assigned to an active simulation yet (see sim_resources.py). The simulations and their
+    assignments are recorded in the simulation registry (see sim_registry.py), which lists them in the setup config for
+    mosaik-docker's tools once the whole batch has been started.
+
+    :param setup_dir: path to simulation setup (string)
+    :param count: number of simulations (int)
+    :param ids: IDs of the new simulations (list of strings, default: None)
+    :param cpus_per_sim: number of CPUs every simulation gets (int, default: 1)
+    :param docker: Docker CLI executable (string)
+    :return: on success, return new simulation IDs (list of strings)
+    '''
+
+    if count < 1:
+        raise ValueError('Need at least one simulation to start, got {}'.format(count))
+    if ids is None:
+        ids = ['mosaik_container_' + create_unique_id() for _ in range(count)]
+    if len(ids) != count or len(set(ids)) != count:
+        raise ValueError('Need {} distinct simulation IDs, got {}'.format(count, ids))
 
     # Retrieve simulation setup configuration.
     config_data = ConfigData(setup_dir)
@@ -34,53 +71,76 @@ def start_sim(setup_dir, id=None):
     server_jar = config_data_orch['server_jar'].strip()
     app_jar = config_data_orch['app_jar'].strip()
 
-    sim_ids_up = config_data['sim_ids_up']
-    sim_ids_down = config_data['sim_ids_down']
-
-    if id in sim_ids_up or id in sim_ids_down:
-        raise RuntimeError('Simulation ID \'{}\' has already been used'.format(id))
+    # Allocate resources that are not used by active simulations and register the new simulations, atomically with
+    # respect to other launchers.
+    def allocate(used_cpus, used_ports):
+        cpusets = allocate_cpusets(count, cpus_per_sim, exclude=used_cpus)
+        host_ports = iter(free_ports(count * len(CONTAINER_PORTS), exclude=used_ports))
+        return {
+            id: dict(
+                cpuset=cpuset,
+                cpus=cpus_per_sim,
+                ports={str(port): next(host_ports) for port in CONTAINER_PORTS},
+            )
+            for id, cpuset in zip(ids, cpusets)
+        }
+
+    with open_registry(setup_dir) as registry:
+        assignments = registry.reserve(ids, allocate)
 
     # Define Docker image name.
     docker_image_name = ORCH_IMAGE_NAME_TEMPLATE.format(sim_setup_id.lower())
 
-    command = [
-        'docker', 'run',  # Docker run command.
-        '--detach',  # Run container in background.
-        # '--rm', # Only for debugging.
-        # '-it',  # Only for debugging.
-        '--name', id,  # Specify container name as simulation id.
-        '--cpus', '1', # how many CPUs the docker gets
-        '--cpuset-cpus', '0', # which CPU the docker gets. 8 CPUs (indexed 0-7)
-        '--env', 'START_FILE={}'.format(start_file),  # Specify shell start file. <-- Yazan
-        '--env', 'SERVER_JAR={}'.format(server_jar),  # <-- Yazan
-        '--env', 'APP_JAR={}'.format(app_jar),  # <-- Yazan
-        '--net', 'mosaik-net',
-        # Specify docker network to connect to <-- Yazan # todo: is it needed? given that everything is run in one docker for now. If still needed then make it configurable in mosaik-docker.json
-        # '-p', '8000:8000',  # Specify port forwarding <-- Yazan
-        '-p', '5567:5567',  # <-- Yazan
-    ]
-
-    # with open(nodes_config_file) as f:
-    #     json_dict = json.load(f)
-    #     print('json config file: ' + json.dumps(json_dict, indent=4))
-    #     for i in json_dict['workerNodes']:
-    #         command.append('-p')
-    #         command.append(i['port'] + ':' + i['port'])
-
-    command.append(docker_image_name)  # Specify the Docker image.
-
-    print('going to execute command: ' + command.__str__())
-
-    execute(command)
-
-    # Update sim setup config.
-    sim_ids_up.append(id)
-
-    # Save simulation setup configuration.
-    config_data.write()
-
-    # On success, return new simulation ID.
-    return id
+    def run(id):
+        resources = assignments[id]
+        command = [
+            docker, 'run',  # Docker run command.
+            '--detach',  # Run container in background.
+            # '--rm', # Only for debugging.
+            # '-it',  # Only for debugging.
+            '--name', id,  # Specify container name as simulation id.
+            '--cpus', str(resources['cpus']),  # how many CPUs the docker gets
+            '--cpuset-cpus', resources['cpuset'],  # which CPUs the docker gets
+            '--env', 'START_FILE={}'.format(start_file),  # Specify shell start file. <-- Yazan
+            '--env', 'SERVER_JAR={}'.format(server_jar),  # <-- Yazan
+            '--env', 'APP_JAR={}'.format(app_jar),  # <-- Yazan
+            '--net', 'mosaik-net',
+            # Specify docker network to connect to <-- Yazan # todo: is it needed? given that everything is run in one docker for now. If still needed then make it configurable in mosaik-docker.json
+            # '-p', '8000:8000',  # Specify port forwarding <-- Yazan
+        ]
+        for port, host_port in resources['ports'].items():
+            command += ['-p', '{}:{}'.format(host_port, port)]  # <-- Yazan
+
+        # with open(nodes_config_file) as f:
+        #     json_dict = json.load(f)
+        #     print('json config file: ' + json.dumps(json_dict, indent=4))
+        #     for i in json_dict['workerNodes']:
+        #         command.append('-p')
+        #         command.append(i['port'] + ':' + i['port'])
+
+        command.append(docker_image_name)  # Specify the Docker image.
+
+        print('going to execute command: ' + command.__str__())
+
+        execute(command)
+
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        futures = {id: executor.submit(run, id) for id in ids}
+    errors = {id: future.exception() for id, future in futures.items() if future.exception() is not None}
+
+    # Update simulation registry.
+    with open_registry(setup_dir) as registry:
+        registry.set_status([id for id in ids if id not in errors], UP)
+        registry.set_status(list(errors), FAILED)
+        # Once per batch, see sim_registry.py
+        registry.sync()
+
+    if errors:
+        raise RuntimeError('Starting simulations failed:\n' + '\n'.join(
+            '{}: {}'.format(id, err) for id, err in errors.items()))
+
+    # On success, return new simulation IDs.
+    return ids
 
 
 def main():
@@ -108,12 +168,39 @@ def main():
         help='simulation ID (Docker container name)'
     )
 
+    parser.add_argument(
+        '-n', '--count',
+        type=int,
+        default=1,
+        metavar='K',
+        help='number of simulations to start concurrently (default: 1, ID must not be given for K > 1)'
+    )
+
+    parser.add_argument(
+        '--cpus',
+        type=int,
+        default=1,
+        metavar='N',
+        help='number of CPUs per simulation (default: 1)'
+    )
+
+    parser.add_argument(
+        '--docker',
+        default=DOCKER,
+        metavar='DOCKER',
+        help='Docker CLI executable (default: $DOCKER or "docker")'
+    )
+
     args = parser.parse_args()
 
     try:
-        sim_id = start_sim(args.setup_dir, args.id)
+        if args.count > 1 and args.id is not None:
+            raise ValueError('Cannot use one ID for {} simulations'.format(args.count))
+        sim_ids = start_sims(args.setup_dir, args.count, ids=None if args.id is None else [args.id],
+                             cpus_per_sim=args.cpus, docker=args.docker)
 
-        print('Started new simulation with ID = {}'.format(sim_id))
+        for sim_id in sim_ids:
+            print('Started new simulation with ID = {}'.format(sim_id))
         sys.exit(0)
 
     except Exception as err:
@@ -0,0 +1,141 @@
+'''
+Adaptive step sizes.
+
+By default every simulator steps at a fixed ``step_size``. In adaptive mode
+the PV simulator, which knows its input data in advance, plans the step times
+of the scenario (see :func:`plan_steps`): consecutive base steps are merged
+into one longer step as long as the PV values of the merged base steps differ
+by at most a tolerance. All simulators then step at these times
+(:class:`StepPlan`) and integrate over the actual step duration.
+
+The battery follows the grid's command of the previous step, so after every
+change the scenario keeps stepping at the base step size for a few steps
+(``settle_steps``) before it starts merging steps.
+
+The tolerance only bounds the deviation of the PV input. Within a merged step
+the net power of a site deviates from fixed stepping by up to the PV
+deviation, once directly and once more through the battery lag, whose energy
+is carried over to later steps as well. :func:`pv_error_rate` turns this into
+an error bound on the grid energy per merged step, and ``max_error`` limits
+the merged steps so that the sum of these bounds stays within it.
+
+The bound only covers the error driven by the PV input. The compute nodes
+draw their base power per base step, as with fixed steps, and consume the mean
+of the draws of a merged step, so their energy does not change by merging;
+but the battery keeps the command of the step before and does not follow the
+draws within a merged step. That error grows with the length of the merged
+steps, not with the tolerance, and is neither bounded nor part of
+``max_error``; ``max_step`` limits it.
+'''
+from bisect import bisect_right
+
+import numpy as np
+
+
+class StepPlan:
+    '''
+    Step times of a simulator.
+
+    :param step_size: step size used without or after the planned step times [s] (int)
+    :param step_times: planned step times in ascending order, starting at 0 (list of ints, optional)
+    '''
+
+    def __init__(self, step_size, step_times=None):
+        self.step_size = step_size
+        self.step_times = list(step_times) if step_times else []
+
+    def next(self, time):
+        '''
+        Return the step time after *time*.
+        '''
+        i = bisect_right(self.step_times, time)
+        if i < len(self.step_times):
+            return self.step_times[i]
+        return time + self.step_size
+
+    def duration(self, time):
+        '''
+        Return the duration of the step at *time* [s].
+        '''
+        return self.next(time) - time
+
+    def base_steps(self, time):
+        '''
+        Return the number of base steps merged into the step at *time* (int).
+        '''
+        return max(self.duration(time) // self.step_size, 1)
+
+
+def pv_error_rate(pv_units):
+    '''
+    Return the rate of the grid energy error bound of a merged step per W of deviation of the PV input: the largest
+    deviation of the net power of all sites from fixed stepping, times 3 (directly, through the battery lag and
+    through the battery energy carried over).
+    '''
+    return 3.0 * pv_units
+
+
+def plan_steps(values, step_size, tolerance, max_steps, breaks=(), settle_steps=2, error_rates=None, max_error=None):
+    '''
+    Merge base steps whose values stay within *tolerance* of each other.
+
+    The error bound of a merged step is ``sum(error_rates * deviation) * duration``. With
+    *max_error*, the merged steps that save the fewest steps per error are split into base steps again until the
+    summed bound is within *max_error*.
+
+    :param values: value of each base step, one row per base step and one column per attribute (2D array)
+    :param step_size: duration of a base step [s] (int)
+    :param tolerance: maximum difference between the values of merged base steps (float)
+    :param max_steps: maximum number of base steps merged into one step (int)
+    :param breaks: times that must be step times (iterable of ints)
+    :param settle_steps: number of base steps at the start of a quiescent interval that are not merged (int)
+    :param error_rates: output error per unit of deviation of each column [W] (sequence of floats, optional)
+    :param max_error: bound on the summed output error of the merged steps [Wh] (float, optional)
+    :return: tuple of (step times (list of ints), largest difference within a merged step per column (array),
+             output error bound of every merged step [Wh] (list of floats))
+    '''
+    values = np.asarray(values, dtype=float).reshape(len(values), -1)
+    rates = np.zeros(values.shape[1]) if error_rates is None else np.asarray(error_rates, dtype=float)
+    breaks = {t // step_size for t in breaks if t % step_size == 0}
+    times = []
+    merged = []  # (first base step, number of base steps, difference per column) of the merged steps
+    settled = False  # True if the values did not change at i, i.e. the last step was only split because of its length
+    i = 0
+    while i < len(values):
+        low = high = values[i]
+        j = i + 1
+        while j < len(values) and j - i < max_steps and j not in breaks:
+            new_low = np.minimum(low, values[j])
+            new_high = np.maximum(high, values[j])
+            if np.any(new_high - new_low > tolerance):
+                break
+            low, high = new_low, new_high
+            j += 1
+        settle = 0 if settled else settle_steps
+        if j - i > settle + 1:
+            times.extend(k * step_size for k in range(i, i + settle + 1))
+            merged.append((i + settle, j - i - settle, high - low))
+        else:
+            times.extend(k * step_size for k in range(i, j))
+        settled = j < len(values) and not np.any(np.maximum(high, values[j]) - np.minimum(low, values[j]) > tolerance)
+        i = j
+
+    errors = [float(rates @ spread) * n * step_size / 3600 for _, n, spread in merged]
+    if max_error is not None and sum(errors) > max_error:
+        budget = max_error
+        kept = []
+        for m in sorted(range(len(merged)), key=lambda m: errors[m] / (merged[m][1] - 1)):
+            if errors[m] <= budget:
+                budget -= errors[m]
+                kept.append(m)
+            else:
+                first, n, _ = merged[m]
+                times.extend(k * step_size for k in range(first + 1, first + n))
+        times.sort()
+        kept.sort()
+        merged = [merged[m] for m in kept]
+        errors = [errors[m] for m in kept]
+    deviation = np.zeros(values.shape[1])
+    for _, _, spread in merged:
+        deviation = np.maximum(deviation, spread)
+    return times, deviation, errors
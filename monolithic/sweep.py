@@ -0,0 +1,322 @@
+'''
+Parameter sweeps of the demo scenario on a local process pool.
+
+A sweep is a grid of scenario parameters, e.g.::
+
+    {
+        "battery_capacity": [5000, 7500, 10000],
+        "consumption_range": [[40, 200], [100, 300]],
+        "step_size": [900]
+    }
+
+Parameters are named after the constants of ``main.py`` they set (see
+PARAMS), e.g. ``"pv_profile": ["season", "synthetic"], "pv_seed": [0, 1, 2]``
+for PV input over horizons longer than the PV data file, ``"compute_seed":
+[0, 1, 2]`` for repetitions with other compute loads, or
+``"scenario": ["scenarios/demo.json", "scenarios/other.json"]`` for variants
+of the scenario (see scenario_spec.py).
+
+Every combination (cell) runs ``main.py`` headless in a worker process of its
+own, with its own mosaik port and output directory. Parameters that are not
+given keep the values of ``main.py``.
+
+Results are memoised by a content hash of the complete parameters of a cell,
+the other constants of ``main.py`` that change its results (see
+:func:`settings`) and the contents of its PV data file, grid file and
+scenario file. Cells always run in-process, headless and at fixed step size
+(PINNED), whatever the environment of the sweep sets. Layout of the output
+directory::
+
+    <out>/<hash>/cell.json      parameters, hash, run time and KPIs of the cell
+    <out>/<hash>/results.<ext>  results of the cell (see result_sink.py)
+    <out>/<hash>/kpis.json      KPIs and statistics of the cell (see kpi_sink.py)
+
+``cell.json`` is written last, so a cell counts as done only if it completed.
+Cells that are done are skipped, so re-running a partly completed sweep only
+computes the missing cells. dispatch.py runs sweeps on several hosts into the
+same layout.
+'''
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import shutil
+import sys
+import time
+
+
+logger = logging.getLogger('sweep')
+
+# Sweep parameters and the constants of main.py they set. 'consumption_range' is a [min, max] pair.
+PARAMS = {
+    'start': 'START',
+    'end': 'END',
+    'step_size': 'STEP_SIZE',
+    'battery_capacity': 'BATTERY_CAPACITY',
+    'consumption_range': ('MIN_CONSUMPTION', 'MAX_CONSUMPTION'),
+    'pv_data': 'PV_DATA',
+    'pv_profile': 'PV_PROFILE',
+    'pv_seed': 'PV_SEED',
+    'compute_seed': 'COMPUTE_SEED',
+    'scenario': 'SCENARIO',
+}
+# Settings of main.py every cell runs with, instead of the ones from the environment
+PINNED = {
+    'SIM_MODE': 'python',
+    'HEADLESS': True,
+    'TELEMETRY': None,
+    'PROFILE': None,
+    'CHECKPOINT_DIR': None,
+    'RESTORE': None,
+    'RESOURCE_INTERVAL': None,
+    'ADAPTIVE_TOLERANCE': None,
+    'ADAPTIVE_MAX_ERROR': None,
+}
+# Constants of main.py that do not change the results of a cell. All other constants are part of its hash.
+UNHASHED = ('RESULT_FILE', 'KPI_FILE', 'SIM_ADDRS', 'PRESTART', 'RESOURCE_CGROUPS', 'CHECKPOINT_EVERY',
+            'TELEMETRY_ATTRS', 'TELEMETRY_MODE', 'TELEMETRY_EVERY', 'TELEMETRY_MIN_INTERVAL')
+CELL_FILE_NAME = 'cell.json'
+RESULT_FILE_NAME = 'results'
+KPI_FILE_NAME = 'kpis.json'
+HASH_VERSION = 4  # Increase to invalidate all memoised results
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def default_params():
+    '''
+    Return the values of all sweep parameters in main.py (dict).
+    '''
+    import main as scenario
+
+    params = {}
+    for name, constant in PARAMS.items():
+        if isinstance(constant, tuple):
+            params[name] = [getattr(scenario, c) for c in constant]
+        else:
+            params[name] = getattr(scenario, constant)
+    return params
+
+
+def settings():
+    '''
+    Return the constants of main.py that are no sweep parameters and change the results of a cell, with the values
+    the cells run with (dict).
+    '''
+    import main as scenario
+
+    swept = {c for constant in PARAMS.values() for c in (constant if isinstance(constant, tuple) else (constant,))}
+    values = {name: value for name, value in vars(scenario).items()
+              if name.isupper() and name not in swept and name not in UNHASHED}
+    values.update(PINNED)
+    return values
+
+
+def expand_grid(grid, defaults=None):
+    '''
+    Return all cells of the parameter *grid*.
+
+    :param grid: {param: list of values} (dict)
+    :param defaults: values of the parameters not in *grid* (default: :func:`default_params`)
+    :return: complete parameters of every cell (list of dicts)
+    '''
+    unknown = set(grid) - set(PARAMS)
+    if unknown:
+        raise ValueError('Unknown sweep parameters: {}, expected some of {}'.format(
+            ', '.join(sorted(unknown)), ', '.join(PARAMS)))
+    defaults = default_params() if defaults is None else defaults
+    names = sorted(grid)
+    cells = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        cell = dict(defaults)
+        cell.update(zip(names, values))
+        cells.append(cell)
+    return cells
+
+
+def file_digest(path, cache):
+    '''
+    Return the SHA-256 digest of the file *path*, cached in *cache* by path, size and modification time.
+    '''
+    path = pathlib.Path(path).resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key not in cache:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        cache[key] = digest.hexdigest()
+    return cache[key]
+
+
+def cell_hash(params, settings, digests):
+    '''
+    Return the content hash of a cell: its parameters, the *settings* of :func:`settings` and the contents of its PV
+    data file, grid file and scenario file.
+
+    :param digests: cache for :func:`file_digest` (dict)
+    '''
+    content = {
+        'version': HASH_VERSION,
+        'params': params,
+        'settings': settings,
+        'pv_data': file_digest(params['pv_data'], digests),
+        'grid_file': file_digest(settings['GRID_FILE'], digests),
+        'scenario': file_digest(params['scenario'], digests),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def is_done(out_dir, key):
+    return pathlib.Path(out_dir, key, CELL_FILE_NAME).is_file()
+
+
+def load_cells(out_dir):
+    '''
+    Return the contents of the ``cell.json`` files of all completed cells in *out_dir* (list of dicts).
+    '''
+    cells = []
+    for path in sorted(pathlib.Path(out_dir).glob('*/' + CELL_FILE_NAME)):
+        with open(path) as f:
+            cells.append(json.load(f))
+    return cells
+
+
+def run_cell(task):
+    '''
+    Run one cell in the current (worker) process. Called by :func:`run_sweep`.
+
+    :param task: tuple of (output directory, hash, parameters)
+    :return: tuple of (hash, error message or None, wall time [s])
+    '''
+    out_dir, key, params = task
+    partial_dir = pathlib.Path(out_dir, key + '.partial')
+    final_dir = pathlib.Path(out_dir, key)
+    t0 = time.perf_counter()
+    try:
+        import main as scenario
+        from sim_resources import free_ports
+
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        partial_dir.mkdir(parents=True)
+
+        for name, constant in PARAMS.items():
+            if isinstance(constant, tuple):
+                for c, value in zip(constant, params[name]):
+                    setattr(scenario, c, value)
+            else:
+                setattr(scenario, constant, params[name])
+        # Cells run in-process and headless, without any other output than their results.
+        for name, value in PINNED.items():
+            setattr(scenario, name, value)
+        extension = 'hdf5' if scenario.RESULT_FORMAT == 'hdf5' else 'parquet'
+        scenario.RESULT_FILE = str(pathlib.Path(partial_dir, RESULT_FILE_NAME + '.' + extension))
+        scenario.KPI_FILE = str(pathlib.Path(partial_dir, KPI_FILE_NAME))
+
+        # Every worker gets its own port for the mosaik world, so that cells can run side by side.
+        port = free_ports(1, host='127.0.0.1')[0]
+        scenario.main(mosaik_config={'addr': ('127.0.0.1', port)})
+
+        elapsed = time.perf_counter() - t0
+        with open(scenario.KPI_FILE) as f:
+            kpis = json.load(f)['kpis']
+        with open(pathlib.Path(partial_dir, CELL_FILE_NAME), 'w') as f:
+            json.dump({'hash': key, 'params': params, 'wall_time': elapsed, 'kpis': kpis}, f, indent=2)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(partial_dir, final_dir)
+        return key, None, elapsed
+
+    except Exception as err:
+        logger.exception('Cell %s failed', key)
+        return key, '{}: {}'.format(type(err).__name__, err), time.perf_counter() - t0
+
+
+def run_sweep(grid, out_dir, jobs=None, defaults=None, force=False, out_stream=print):
+    '''
+    Run all cells of the parameter *grid* that have no results in *out_dir* yet on *jobs* worker processes.
+
+    :param grid: {param: list of values}, see PARAMS (dict)
+    :param jobs: number of worker processes (default: number of CPUs)
+    :param defaults: values of the parameters not in *grid* (default: :func:`default_params`)
+    :param force: also re-run cells that are done (bool)
+    :return: {hash: error message or None} for the cells that were run (dict)
+    '''
+    out_dir = pathlib.Path(out_dir).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    cells = expand_grid(grid, defaults)
+    values = settings()
+    digests = {}
+    tasks = {}
+    for params in cells:
+        key = cell_hash(params, values, digests)
+        if key not in tasks and (force or not is_done(out_dir, key)):
+            tasks[key] = (str(out_dir), key, params)
+
+    out_stream('{} cells, {} done, {} to run'.format(len(cells), len(cells) - len(tasks), len(tasks)))
+    if not tasks:
+        return {}
+
+    errors = {}
+    jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+    # One fresh process per cell: a mosaik world can only run once and main.py keeps its settings in globals.
+    with multiprocessing.get_context('spawn').Pool(jobs, maxtasksperchild=1) as pool:
+        for key, error, elapsed in pool.imap_unordered(run_cell, tasks.values()):
+            errors[key] = error
+            out_stream('{} {} ({:.1f} s){}'.format(key[:12], 'failed' if error else 'done', elapsed,
+                                                   ': ' + error if error else ''))
+    return errors
+
+
+def main():
+    import argparse
+
+    # Command line parser.
+    parser = argparse.ArgumentParser(
+        description='Run a parameter sweep of the demo scenario on a local process pool.'
+    )
+
+    parser.add_argument(
+        'grid',
+        metavar='GRID',
+        help='JSON file with the parameter grid ({param: [values]}, params: %s)' % ', '.join(PARAMS)
+    )
+
+    parser.add_argument(
+        '-o', '--out-dir',
+        default='sweep',
+        metavar='DIR',
+        help='output directory (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        metavar='N',
+        help='number of worker processes (default: number of CPUs)'
+    )
+
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='re-run cells that already have results'
+    )
+
+    args = parser.parse_args()
+
+    try:
+        with open(args.grid) as f:
+            grid = json.load(f)
+        errors = run_sweep(grid, args.out_dir, jobs=args.jobs, force=args.force)
+        sys.exit(3 if any(errors.values()) else 0)
+
+    except Exception as err:
+
+        print(str(err))
+        sys.exit(3)
+
+
+if __name__ == '__main__':
+    main()
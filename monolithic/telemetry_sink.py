@@ -0,0 +1,223 @@
+'''
+Lightweight telemetry sink for headless runs.
+
+Instead of pushing every value of every entity to the browser like
+``mosaik-web``, this simulator streams a small JSON message per entity type
+and attribute (mean, min, max and the mean of the last step) to a UDP socket
+or appends it to a JSON lines file.
+
+Two modes reduce the load on the simulation:
+
+* ``sample``: the sink only steps every ``every`` steps, so mosaik fetches
+  and forwards its inputs only at these steps.
+* ``aggregate``: the sink steps with the scenario and aggregates all values
+  of ``every`` steps into one message.
+
+Steps are the planned steps of the scenario in adaptive mode (see
+step_plan.py).
+
+Additionally, ``min_interval`` limits the number of messages per wall-clock
+second; values of suppressed messages are aggregated into the next one.
+
+Targets are given as ``udp://<host>:<port>`` or ``file://<path>``.
+'''
+import json
+import logging
+import socket
+import time
+
+import mosaik_api
+
+from step_plan import StepPlan
+
+
+logger = logging.getLogger('telemetry_sink')
+
+MODES = ('sample', 'aggregate')
+
+META = {
+    'type': 'time-based',
+    'models': {
+        'Monitor': {
+            'public': True,
+            'any_inputs': True,
+            'params': [
+                'target',  # 'udp://<host>:<port>' or 'file://<path>'
+            ],
+            'attrs': [],
+        },
+    },
+}
+
+
+class UdpTarget:
+    def __init__(self, address):
+        host, _, port = address.rpartition(':')
+        self.address = (host, int(port))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, message):
+        try:
+            self.sock.sendto(message, self.address)
+        except OSError as err:
+            # Telemetry must never stop the simulation.
+            logger.debug('Could not send telemetry: %s', err)
+
+    def close(self):
+        self.sock.close()
+
+
+class FileTarget:
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+
+    def send(self, message):
+        self.file.write(message + b'\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+TARGETS = {
+    'udp': UdpTarget,
+    'file': FileTarget,
+}
+
+
+def open_target(target):
+    '''
+    Open the telemetry target *target* ('udp://<host>:<port>' or 'file://<path>').
+    '''
+    scheme, sep, address = target.partition('://')
+    if not sep or scheme not in TARGETS:
+        raise ValueError('Invalid telemetry target "{}", expected one of {}'.format(
+            target, ', '.join('{}://...'.format(s) for s in TARGETS)))
+    return TARGETS[scheme](address)
+
+
+class Stats:
+    '''
+    Running statistics of one attribute of one entity type.
+    '''
+    __slots__ = ('count', 'total', 'min', 'max', 'last_total', 'last_count')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.last_total = 0.0
+        self.last_count = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last_total += value
+        self.last_count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        return {
+            'mean': self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'last': self.last_total / self.last_count if self.last_count else None,
+            'n': self.count,
+        }
+
+
+class TelemetrySink(mosaik_api.Simulator):
+    def __init__(self):
+        super().__init__(META)
+        self.eid = 'monitor'
+        self.plan = None
+        self.every = None
+        self.mode = None
+        self.min_interval = None
+        self.time_offset = None
+        self.target = None
+        self.types = {}
+        self.stats = {}
+        self.step_count = 0
+        self.last_sent = None
+
+    def init(self, sid, time_resolution=1., step_size=900, step_times=None, every=4, mode='sample', min_interval=0.0,
+             time_offset=0):
+        if mode not in MODES:
+            raise ValueError('Unknown mode "{}", expected one of {}'.format(mode, MODES))
+        self.plan = StepPlan(step_size, step_times)
+        self.every = max(int(every), 1)
+        self.mode = mode
+        self.min_interval = min_interval
+        self.time_offset = time_offset
+        return self.meta
+
+    def create(self, num, model, target):
+        if num != 1 or self.target is not None:
+            raise ValueError('Can only create one monitor.')
+        self.target = open_target(target)
+        return [{'eid': self.eid, 'type': model, 'rel': []}]
+
+    def setup_done(self):
+        data = yield self.mosaik.get_related_entities()
+        self.types = {full_id: node['type'] for full_id, node in data['nodes'].items()}
+
+    def step(self, time, inputs, max_advance):
+        for stats in self.stats.values():
+            stats.last_total = 0.0
+            stats.last_count = 0
+
+        for attr, values in inputs.get(self.eid, {}).items():
+            for src_id, value in values.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                key = (self.types.get(src_id, src_id.split('.', 1)[0]), attr)
+                stats = self.stats.get(key)
+                if stats is None:
+                    stats = self.stats[key] = Stats()
+                stats.add(value)
+
+        self.step_count += 1
+        if self.mode == 'sample':
+            self._send(time)
+            next_time = time
+            for _ in range(self.every):
+                next_time = self.plan.next(next_time)
+            return next_time
+
+        if self.step_count % self.every == 0:
+            self._send(time)
+        return self.plan.next(time)
+
+    def finalize(self):
+        if self.target is not None:
+            if any(stats.count for stats in self.stats.values()):
+                self._send(None, force=True)
+            self.target.close()
+
+    def _send(self, time_, force=False):
+        now = time.monotonic()
+        if not force and self.last_sent is not None and now - self.last_sent < self.min_interval:
+            return
+
+        data = {}
+        for (etype, attr), stats in self.stats.items():
+            if stats.count:
+                data.setdefault(etype, {})[attr] = stats.as_dict()
+        if time_ is not None:
+            time_ += self.time_offset
+        self.target.send(json.dumps({'time': time_, 'data': data}, separators=(',', ':')).encode())
+        self.stats = {}
+        self.last_sent = now
+
+
+def main():
+    return mosaik_api.start_simulation(TelemetrySink(), 'Telemetry sink')
+
+
+if __name__ == '__main__':
+    main()
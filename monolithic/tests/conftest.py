@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# The modules of the package are imported by name, like main.py does.
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
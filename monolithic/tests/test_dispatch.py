@@ -0,0 +1,77 @@
+import collections
+
+from dispatch import CostModel, Scheduler
+
+
+def cell(steps):
+    return {'end': 900 * steps, 'step_size': 900}
+
+
+TASKS = {'k{}'.format(n): cell(n) for n in (2, 3, 4, 10)}
+
+
+def test_plan_longest_first():
+    scheduler = Scheduler(TASKS, {'a': 'h1', 'b': 'h2'}, CostModel())
+    assert list(scheduler.queues['a']) == ['k10']
+    assert list(scheduler.queues['b']) == ['k4', 'k3', 'k2']
+
+
+def test_run_until_done():
+    model = CostModel()
+    scheduler = Scheduler({'k2': cell(2)}, {'a': 'h1'}, model)
+    assert scheduler.next('a') == 'k2'
+    scheduler.done('a', 'k2', 4.0)
+    assert scheduler.next('a') is None
+    assert scheduler.results == {'k2': None}
+    assert model.rate('h1') == 2.0
+
+
+def test_steal_last_cell_of_busiest_slot():
+    scheduler = Scheduler(TASKS, {'a': 'h1', 'b': 'h2'}, CostModel())
+    scheduler.queues['a'].clear()
+    assert scheduler.next('b') == 'k4'
+    # b starts k2 after about 4 + 3 s, a finishes it in 2 s
+    assert scheduler.next('a') == 'k2'
+    assert scheduler.steals == 1
+    assert list(scheduler.queues['b']) == ['k3']
+
+
+def test_no_steal_by_slower_host():
+    model = CostModel()
+    model.add('h1', cell(1), 100.0)  # 100 s per step
+    model.add('h2', cell(1), 1.0)
+    scheduler = Scheduler(TASKS, {'a': 'h1', 'b': 'h2'}, model)
+    scheduler.queues = {'a': collections.deque(), 'b': collections.deque(['k4', 'k3', 'k2'])}
+    assert scheduler.next('b') == 'k4'
+    assert scheduler._steal('a') is None
+    assert scheduler.steals == 0
+
+
+def test_retry_on_other_host():
+    scheduler = Scheduler({'k2': cell(2)}, {'a': 'h1', 'b': 'h2'}, CostModel(), retries=2)
+    slot = 'a' if scheduler.queues['a'] else 'b'
+    other = 'b' if slot == 'a' else 'a'
+    assert scheduler.next(slot) == 'k2'
+    assert scheduler.failed(slot, 'k2', 'boom')
+    assert list(scheduler.queues[other]) == ['k2']
+
+    assert scheduler.next(other) == 'k2'
+    assert scheduler.failed(other, 'k2', 'boom')  # Failed on both hosts, retried on either
+    retry = 'a' if scheduler.queues['a'] else 'b'
+    assert scheduler.next(retry) == 'k2'
+    assert not scheduler.failed(retry, 'k2', 'boom')
+    assert scheduler.results == {'k2': 'boom'}
+    assert scheduler.next('a') is None
+
+
+def test_drop_hands_queue_to_other_slots():
+    scheduler = Scheduler(TASKS, {'a': 'h1', 'b': 'h2', 'c': 'h3'}, CostModel())
+    queued = set(scheduler.queues['a'])
+    scheduler.drop('a')
+    assert scheduler.next('a') is None
+    assert not scheduler.queues['a']
+    assert queued <= set(scheduler.queues['b']) | set(scheduler.queues['c'])
+
+    scheduler.drop('b')
+    scheduler.drop('c')
+    assert scheduler.results == dict.fromkeys(TASKS, 'No worker left')
@@ -0,0 +1,106 @@
+import csv
+import types
+
+import pytest
+
+import resource_monitor
+from resource_monitor import COLUMNS, Sampler, read_cgroup
+
+
+def write_files(directory, files):
+    for name, text in files.items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+
+def write_v2(directory, usage_usec, memory=1024):
+    write_files(directory, {
+        'cpu.stat': 'usage_usec {}\nuser_usec 0\nsystem_usec 0\nnr_periods 10\nnr_throttled 2\n'
+                    'throttled_usec 500000\n'.format(usage_usec),
+        'memory.current': '{}\n'.format(memory),
+        'memory.max': 'max\n',
+    })
+
+
+def test_read_cgroup_v2(tmp_path):
+    write_v2(tmp_path, 2500000)
+    assert read_cgroup(str(tmp_path)) == {
+        'cpu_usage': 2.5,
+        'nr_throttled': 2,
+        'throttled': 0.5,
+        'memory': 1024,
+        'memory_limit': None,
+    }
+
+
+V1_FILES = {
+    'cpu.stat': 'nr_periods 10\nnr_throttled 3\nthrottled_time 2000000000\n',
+    'cpuacct.usage': '1500000000\n',
+    'memory.usage_in_bytes': '4096\n',
+    'memory.limit_in_bytes': '8192\n',
+}
+V1_COUNTERS = {
+    'cpu_usage': 1.5,
+    'nr_throttled': 3,
+    'throttled': 2.0,
+    'memory': 4096,
+    'memory_limit': 8192,
+}
+
+
+def test_read_cgroup_v1(tmp_path):
+    write_files(tmp_path, V1_FILES)
+    assert read_cgroup(str(tmp_path)) == V1_COUNTERS
+
+
+def test_read_cgroup_v1_per_controller(tmp_path):
+    controllers = {'cpu.stat': 'cpu', 'cpuacct.usage': 'cpuacct', 'memory.usage_in_bytes': 'memory',
+                   'memory.limit_in_bytes': 'memory'}
+    write_files(tmp_path, {controllers[name] + '/' + name: text for name, text in V1_FILES.items()})
+    assert read_cgroup(str(tmp_path)) == V1_COUNTERS
+
+
+def test_read_cgroup_missing(tmp_path):
+    assert set(read_cgroup(str(tmp_path)).values()) == {None}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=100.0)
+    monkeypatch.setattr(resource_monitor, 'time', types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def read_rows(filename):
+    with open(filename, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_sampler(tmp_path, clock):
+    a, b = tmp_path / 'a', tmp_path / 'b'
+    write_v2(a, 1000000)
+    write_v2(b, 0)
+    filename = tmp_path / 'resources.csv'
+    sampler = Sampler(str(filename), {'a': str(a), 'b': str(b)}, 3600, 3)
+
+    sampler.sim_time = 0
+    sampler.sample()
+    assert read_rows(filename) == []  # 2 samples, batches of 3
+
+    clock.now += 2
+    write_v2(a, 4000000)  # 3 s of CPU time in 2 s
+    write_v2(b, 1000000)
+    sampler.sim_time = 900
+    sampler.sample()
+    rows = read_rows(filename)
+    assert len(rows) == 4
+    assert list(rows[0]) == list(COLUMNS)
+    assert [(row['container'], row['sim_time'], row['cpu_cores']) for row in rows] == [
+        ('a', '0', ''), ('b', '0', ''), ('a', '900', '1.5'), ('b', '900', '0.5')]
+
+    sampler.start()
+    sampler.close()
+    rows = read_rows(filename)
+    assert len(rows) == 6
+    assert [row['cpu_cores'] for row in rows[4:]] == ['', '']  # No time has passed
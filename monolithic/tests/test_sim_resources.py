@@ -0,0 +1,41 @@
+import pytest
+
+import sim_resources
+from sim_resources import allocate_cpusets, format_cpuset, parse_cpuset
+
+
+@pytest.fixture
+def hyperthreads(monkeypatch):
+    # 8 cores with 2 threads each, CPU i and i + 8 share a core
+    monkeypatch.setattr(sim_resources, 'cpu_topology', lambda cpus=None: [[i, i + 8] for i in range(8)])
+
+
+def test_cpuset_round_trip():
+    assert format_cpuset([0, 1, 2, 8]) == '0-2,8'
+    assert parse_cpuset('0-2,8') == {0, 1, 2, 8}
+
+
+def test_single_cpus_spread_over_cores(hyperthreads):
+    assert allocate_cpusets(8) == [str(i) for i in range(8)]
+    assert allocate_cpusets(10)[8:] == ['8', '9']
+
+
+def test_idle_cores_before_siblings_of_busy_cores(hyperthreads):
+    assert allocate_cpusets(2, exclude={0, 1, 2}) == ['3', '4']
+    assert allocate_cpusets(5, exclude={0, 1, 2}) == ['3', '4', '5', '6', '7']
+    assert allocate_cpusets(8, exclude={0, 1, 2})[5:] == ['8', '9', '10']
+
+
+def test_sets_of_hyperthreads_keep_to_whole_cores(hyperthreads):
+    assert allocate_cpusets(2, cpus_per_set=2, exclude={0}) == ['1,9', '2,10']
+    assert allocate_cpusets(7, cpus_per_set=2, exclude={0})[-1] == '7,15'
+
+
+def test_not_enough_cpus(hyperthreads):
+    with pytest.raises(RuntimeError):
+        allocate_cpusets(9, cpus_per_set=2)
+
+
+def test_count_below_one(hyperthreads):
+    with pytest.raises(ValueError):
+        allocate_cpusets(0)
@@ -0,0 +1,127 @@
+'''
+Typed attribute schemas and compact encoding of the messages to remote simulators.
+
+mosaik talks to remote simulators with JSON text messages. Simulators of this
+package declare in their meta data
+
+* ``'codecs'``: the binary codecs they can decode (currently ``msgpack`` if
+  the optional ``msgpack`` package is installed), and
+* ``'attr_types'`` per model: the type of numeric attributes (``'float'``,
+  ``'int'``) and of the remaining string attributes (``'str'``).
+
+After the simulators have been started, :func:`negotiate_codecs` switches the
+connection of every remote simulator that offers a codec the scenario also
+supports from JSON to that codec. Simulators answer in the encoding of the
+request (:func:`accept_codecs`). Messages that the binary codec cannot encode
+are sent as JSON, and both sides detect the encoding of every message, so
+JSON stays the fallback, e.g. for simulators written in other languages.
+
+The switch relies on the internals of the pinned mosaik and simpy.io versions
+(see requirements.txt), like scenario_util.py.
+'''
+import logging
+
+import mosaik_api
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+logger = logging.getLogger('wire')
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+CODECS = [MSGPACK] if msgpack is not None else []  # Binary codecs of this process, most preferred first
+JSON_START = tuple(b'[{" \t\r\n')  # First bytes of JSON messages, msgpack arrays start with 0x9X or 0xdc/0xdd
+NUMERIC_TYPES = ('float', 'int')
+
+
+class AutoCodec:
+    '''
+    simpy.io codec that decodes JSON and binary messages and encodes with *preferred* codec.
+
+    :param json_codec: the JSON codec of the connection (simpy.io.codec.JSON)
+    :param preferred: codec for outgoing messages, None to use the codec of the last incoming message (string)
+    '''
+
+    def __init__(self, json_codec, preferred=None):
+        self.json_codec = json_codec
+        self.preferred = preferred
+        self.last = JSON
+
+    def encode(self, obj):
+        codec = self.preferred or self.last
+        if codec == MSGPACK:
+            try:
+                return msgpack.packb(obj, use_bin_type=True)
+            except (TypeError, ValueError, OverflowError):
+                pass  # E.g. objects only the JSON codec knows how to box
+        return self.json_codec.encode(obj).encode()
+
+    def decode(self, data):
+        if data[:1] and data[0] not in JSON_START:
+            self.last = MSGPACK
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        self.last = JSON
+        return self.json_codec.decode(data.decode())
+
+
+def _to_bytes(packet):
+    # Messages encoded before the switch are still text.
+    return packet.encode() if isinstance(packet, str) else packet
+
+
+def install_codec(channel, preferred=None):
+    '''
+    Replace the codec of the simpy.io message *channel* by an :class:`AutoCodec`.
+    '''
+    if not isinstance(channel.codec, AutoCodec):
+        channel.codec = AutoCodec(channel.codec, preferred)
+        channel.socket.encode = _to_bytes
+        channel.socket.decode = None
+    else:
+        channel.codec.preferred = preferred
+
+
+def accept_codecs(simulator):
+    '''
+    Let *simulator* (a mosaik_api.Simulator) decode binary requests and answer in their encoding. Call from
+    ``init()``, does nothing for simulators running in-process.
+    '''
+    proxy = getattr(simulator, 'mosaik', None)
+    if CODECS and isinstance(proxy, mosaik_api.MosaikProxy):
+        install_codec(proxy._channel)
+
+
+def negotiate_codecs(world, codecs=None):
+    '''
+    Switch the connections to all remote simulators of *world* that offer one of *codecs* (default: CODECS).
+
+    :return: {sid: codec} for every remote simulator (dict)
+    '''
+    codecs = CODECS if codecs is None else codecs
+    chosen = {}
+    for sid, sim in world.sims.items():
+        rpc_con = getattr(sim, '_rpc_con', None)
+        if rpc_con is None:
+            continue  # In-process simulator, nothing is encoded
+        offered = sim.meta.get('codecs', [])
+        codec = next((c for c in codecs if c in offered), JSON)
+        if codec != JSON:
+            install_codec(rpc_con.message, codec)
+        chosen[sid] = codec
+        logger.debug('Encoding of %s: %s', sid, codec)
+    return chosen
+
+
+def attr_type(meta, model, attr):
+    '''
+    Return the declared type of *attr* of *model* in the simulator meta data *meta*, or None.
+    '''
+    return meta['models'].get(model, {}).get('attr_types', {}).get(attr)
+
+
+def is_numeric(meta, model, attr):
+    return attr_type(meta, model, attr) in NUMERIC_TYPES